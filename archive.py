@@ -0,0 +1,82 @@
+"""Module to read emails from local mbox files and Maildir directories."""
+
+import os
+import time
+import logging
+import mailbox
+from typing import Iterator, Optional
+
+from imap_tools import MailAttachment
+from imap_tools.message import MailMessage
+
+logger = logging.getLogger("mail2blog")
+
+
+class ImportProgress:
+    """
+    Counts the messages and bytes read from an archive, logging the
+    throughput at most every `interval` seconds.
+    """
+
+    def __init__(self, interval: float = 10.0):
+        self.interval = interval
+        self.messages = 0
+        self.bytes = 0
+        self._start = time.perf_counter()
+        self._last_log = self._start
+
+    def add(self, nbytes: int):
+        """Count one message of nbytes bytes."""
+        self.messages += 1
+        self.bytes += nbytes
+        now = time.perf_counter()
+        if now - self._last_log >= self.interval:
+            self._last_log = now
+            self.log()
+
+    def log(self):
+        elapsed = max(time.perf_counter() - self._start, 1e-9)
+        megabytes = self.bytes / 1e6
+        logger.info(
+            f"Read {self.messages} emails ({megabytes:.1f} MB) in {elapsed:.1f}s: "
+            f"{self.messages / elapsed:.1f} emails/s, {megabytes / elapsed:.2f} MB/s"
+        )
+
+
+def _open_archive(path: str) -> mailbox.Mailbox:
+    """Open a Maildir directory or an mbox file."""
+    if os.path.isdir(path):
+        return mailbox.Maildir(path, factory=None, create=False)
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"No mbox file or Maildir directory at {path}")
+    return mailbox.mbox(path, factory=None, create=False)
+
+
+def read_archive(
+    path: str, progress: Optional[ImportProgress] = None
+) -> Iterator[tuple[MailMessage, dict[str, MailAttachment]]]:
+    """
+    Yields the emails of an mbox file or a Maildir directory, in the order of
+    the mbox file or of the Maildir's file names, which start with the second
+    of delivery. Emails are read and parsed one at a time, so the archive
+    never has to fit in memory.
+    """
+    archive = _open_archive(path)
+    try:
+        keys = archive.keys()
+        if isinstance(archive, mailbox.Maildir):
+            keys.sort()
+        for key in keys:
+            raw_message = archive.get_bytes(key)
+            if progress is not None:
+                progress.add(len(raw_message))
+            mail = MailMessage.from_bytes(raw_message)
+            del raw_message
+
+            cid_to_att = {}
+            for att in mail.attachments:
+                cid_to_att[att.content_id] = att
+
+            yield mail, cid_to_att
+    finally:
+        archive.close()
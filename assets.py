@@ -0,0 +1,154 @@
+"""Module to deduplicate post assets by their content."""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from typing import Iterable, Optional
+
+logger = logging.getLogger("mail2blog")
+
+
+class AssetStore:
+    """
+    Content-addressed index of the files in the assets directory, so that an
+    attachment seen before is linked to its existing file instead of being
+    converted and stored again.
+
+    The index is kept in a JSON Lines journal: each asset recorded appends
+    one record, and the journal is compacted when loaded once it holds
+    records of assets recorded again. Keys are claimed before their asset is
+    converted, so that an asset of messages converted concurrently is only
+    converted once.
+    """
+
+    M2B_ASSET_INDEX_FILEPATH = "./.asset_index.jsonl"
+    # asset index written by earlier versions, migrated on first use
+    M2B_LEGACY_ASSET_INDEX_FILEPATH = "./.asset_index.json"
+    # compact the journal once it holds this many records per asset
+    COMPACTION_RATIO = 2
+
+    def __init__(self):
+        self.index = self._load()
+        # serialises index updates across pipeline threads
+        self._lock = threading.Lock()
+        # notified whenever a claimed key is recorded or released
+        self._released = threading.Condition(self._lock)
+        # keys of the assets being converted
+        self._claimed = set()
+
+    def _load(self) -> dict:
+        """Read the journal, migrating a legacy JSON asset index if needed."""
+        index = {}
+        if not os.path.exists(self.M2B_ASSET_INDEX_FILEPATH):
+            if os.path.exists(self.M2B_LEGACY_ASSET_INDEX_FILEPATH):
+                with open(
+                    self.M2B_LEGACY_ASSET_INDEX_FILEPATH, "r", encoding="utf-8"
+                ) as f:
+                    index = json.load(f)
+                self._rewrite_journal(index)
+            return index
+
+        records = 0
+        valid_size = 0
+        with open(self.M2B_ASSET_INDEX_FILEPATH, "rb") as f:
+            for line in f:
+                # a record without a newline was cut short by a crash
+                if not line.endswith(b"\n"):
+                    break
+                record = json.loads(line)
+                index[record.pop("key")] = record
+                records += 1
+                valid_size += len(line)
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+        if valid_size < size:
+            logger.warning("Dropping incomplete record at the end of the asset index")
+            with open(self.M2B_ASSET_INDEX_FILEPATH, "r+b") as f:
+                f.truncate(valid_size)
+        if records > self.COMPACTION_RATIO * len(index):
+            self._rewrite_journal(index)
+        return index
+
+    def _rewrite_journal(self, index: dict):
+        """Atomically replace the journal with one record per asset."""
+        tmp_path = self.M2B_ASSET_INDEX_FILEPATH + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for key, entry in index.items():
+                f.write(self._journal_record(key, entry))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.M2B_ASSET_INDEX_FILEPATH)
+
+    @staticmethod
+    def _journal_record(key: str, entry: dict) -> str:
+        return json.dumps(dict(key=key, **entry)) + "\n"
+
+    @classmethod
+    def key(cls, payload: bytes, *params) -> str:
+        """
+        Hash an attachment's payload together with the parameters of its
+        conversion, as the same payload converted differently is another asset.
+        """
+        return cls.key_chunks((payload,), *params)
+
+    @staticmethod
+    def key_chunks(chunks: Iterable[bytes], *params) -> str:
+        """Like key, for a payload read in chunks."""
+        digest = hashlib.sha256(repr(params).encode("utf-8"))
+        for chunk in chunks:
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    def lookup(self, key: str, assets_dir: str) -> Optional[tuple[str, list]]:
+        """
+        Return the filename, relative to assets_dir, and the variants of the
+        asset stored under key, or None if there is none or any of its files
+        no longer exists.
+        """
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        filename, variants = entry["filename"], entry["variants"]
+        filenames = [filename] + [variant[0] for variant in variants]
+        if all(os.path.exists(os.path.join(assets_dir, f)) for f in filenames):
+            return filename, variants
+        return None
+
+    def claim(self, key: str, assets_dir: str) -> Optional[tuple[str, list]]:
+        """
+        Like lookup, but waiting for the asset if another caller claimed key,
+        and claiming key when no asset is stored under it. The caller must
+        then record the converted asset, or release key if converting it
+        failed. Callers claiming several keys must claim them in sorted
+        order, so that they cannot wait on each other.
+        """
+        with self._lock:
+            while key in self._claimed:
+                self._released.wait()
+            stored = self.lookup(key, assets_dir)
+            if stored is None:
+                self._claimed.add(key)
+            return stored
+
+    def release(self, key: str):
+        """Give up a claim of key without recording an asset."""
+        with self._lock:
+            if key in self._claimed:
+                self._claimed.discard(key)
+                self._released.notify_all()
+
+    def record(self, key: str, filename: str, variants=()):
+        """
+        Record the filename, relative to the assets directory, of an asset and
+        the (filename, width, MIME type) of each of its responsive variants,
+        releasing its key.
+        """
+        with self._lock:
+            entry = {"filename": filename, "variants": list(variants)}
+            with open(self.M2B_ASSET_INDEX_FILEPATH, "a", encoding="utf-8") as f:
+                f.write(self._journal_record(key, entry))
+            self.index[key] = entry
+            self._claimed.discard(key)
+            self._released.notify_all()
@@ -0,0 +1,215 @@
+"""Module to publish posts to the sites of several static site generators."""
+
+import os
+import re
+import json
+import shutil
+
+import metrics
+from manifest import MANIFEST
+from converter import jekyll_asset_url
+from jekyll import JekyllPost, _slugify
+
+# converted content links to its assets through placeholders, delimited by
+# private use characters, which each backend replaces with the URLs of its own site
+_ASSET_PLACEHOLDER = "\ue000{}\ue001"
+_ASSET_PLACEHOLDER_PATTERN = re.compile("\ue000([^\ue001]*)\ue001")
+
+
+def asset_placeholder(filename: str) -> str:
+    """Link to a file in the assets directory, for Backend.post to resolve."""
+    return _ASSET_PLACEHOLDER.format(filename)
+
+
+def referenced_assets(content: str) -> set[str]:
+    """The filenames of the assets content links to through placeholders."""
+    return set(_ASSET_PLACEHOLDER_PATTERN.findall(content))
+
+
+def _post_slug(post) -> str:
+    """
+    The slug of a post: the stem of the filename it was saved under, which no
+    other post of the site has, or before it is saved, its slugified title.
+    """
+    if post.filename:
+        return os.path.splitext(post.filename)[0]
+    return _slugify(post.title)
+
+
+class HugoPost(JekyllPost):
+    """Post with YAML front matter for Hugo."""
+
+    def _generate_front_matter(self):
+        fm = [
+            "---",
+            f"title: {json.dumps(self.title)}",
+            f"author: {json.dumps(self.author)}",
+            f"date: {self.date.isoformat()}",
+            f"slug: {json.dumps(_post_slug(self))}",
+        ]
+        if self.categories:
+            fm.append(f"categories: {json.dumps(self.categories)}")
+        if self.tags:
+            fm.append(f"tags: {json.dumps(self.tags)}")
+        if self.message_id:
+            fm.append(f"message_id: {json.dumps(self.message_id)}")
+        fm.append("---\n")
+        return "\n".join(fm)
+
+
+class EleventyPost(JekyllPost):
+    """Post with YAML front matter for Eleventy."""
+
+    def _generate_front_matter(self):
+        fm = [
+            "---",
+            f"layout: {self.layout}",
+            f"title: {json.dumps(self.title)}",
+            f"author: {json.dumps(self.author)}",
+            f"date: {self.date.isoformat()}",
+        ]
+        # Eleventy builds its collections from tags
+        if self.tags:
+            fm.append(f"tags: {json.dumps(self.tags)}")
+        if self.message_id:
+            fm.append(f"message_id: {json.dumps(self.message_id)}")
+        fm.append("---\n")
+        return "\n".join(fm)
+
+
+class PelicanPost(JekyllPost):
+    """Post with the "Key: value" metadata of Pelican's Markdown reader."""
+
+    def _generate_front_matter(self):
+        fm = [
+            f"Title: {self.title}",
+            f"Date: {self.date.strftime('%Y-%m-%d %H:%M:%S')}",
+            f"Author: {self.author}",
+            f"Slug: {_post_slug(self)}",
+        ]
+        if self.categories:
+            fm.append(f"Category: {self.categories[0]}")
+        if self.tags:
+            fm.append(f"Tags: {', '.join(self.tags)}")
+        if self.message_id:
+            fm.append(f"message_id: {self.message_id}")
+        fm.append("\n")
+        return "\n".join(fm)
+
+
+class Backend:
+    """
+    A site posts are published to: its posts and assets directories, and the
+    kind of post and asset URLs its generator expects.
+    """
+
+    post_class = None
+
+    def __init__(self, post_dir=None, assets_dir=None):
+        self.post_dir = post_dir
+        self.assets_dir = assets_dir
+
+    def asset_url(self, filename: str) -> str:
+        """Link to a file in the assets directory."""
+        return f"/{os.path.basename(self.assets_dir)}/{filename}"
+
+    def post(self, title, author, date, content, message_id):
+        """Build a post of content whose asset placeholders link to this site."""
+        content = _ASSET_PLACEHOLDER_PATTERN.sub(
+            lambda match: self.asset_url(match.group(1)), content
+        )
+        return self.post_class(
+            title=title,
+            author=author,
+            date=date,
+            content=content,
+            message_id=message_id,
+        )
+
+    def save(self, post) -> str:
+        """Save a post to the posts directory, returning its filepath."""
+        filepath = post.save(directory=self.post_dir)
+        MANIFEST.add(filepath, "post")
+        return filepath
+
+    def import_assets(self, filenames, source_dir: str):
+        """
+        Hard link the asset files converted into source_dir into the assets
+        directory, copying them where linking is not possible, so that they
+        are converted only once for all sites.
+        """
+        if os.path.abspath(source_dir) == os.path.abspath(self.assets_dir):
+            return
+        for filename in filenames:
+            dest_path = os.path.join(self.assets_dir, filename)
+            if os.path.exists(dest_path):
+                continue
+            source_path = os.path.join(source_dir, filename)
+            with metrics.stage("asset_link", os.path.getsize(source_path)):
+                try:
+                    os.link(source_path, dest_path)
+                except OSError:
+                    # e.g. across filesystems
+                    shutil.copy2(source_path, dest_path)
+            MANIFEST.add(dest_path, "asset")
+
+
+class JekyllBackend(Backend):
+    post_class = JekyllPost
+
+    def asset_url(self, filename: str) -> str:
+        return jekyll_asset_url(self.assets_dir, filename)
+
+
+class HugoBackend(Backend):
+    """Assets are expected in a directory of Hugo's static directory."""
+
+    post_class = HugoPost
+
+
+class EleventyBackend(Backend):
+    """Assets are expected in a directory Eleventy passes through to the site root."""
+
+    post_class = EleventyPost
+
+
+class PelicanBackend(Backend):
+    """Assets are expected in one of Pelican's STATIC_PATHS."""
+
+    post_class = PelicanPost
+
+    def asset_url(self, filename: str) -> str:
+        return f"{{static}}/{os.path.basename(self.assets_dir)}/{filename}"
+
+
+BACKENDS = {
+    "jekyll": JekyllBackend,
+    "hugo": HugoBackend,
+    "eleventy": EleventyBackend,
+    "pelican": PelicanBackend,
+}
+
+
+def make_backend(generator="jekyll", post_dir=None, assets_dir=None) -> Backend:
+    """Create the backend of a site built by the named generator."""
+    try:
+        backend_class = BACKENDS[generator.lower()]
+    except KeyError:
+        raise ValueError(f"Unknown site generator: {generator}") from None
+    return backend_class(post_dir=post_dir, assets_dir=assets_dir)
+
+
+def backends_for(config) -> list[Backend]:
+    """
+    The sites a mailbox publishes to, as listed in its config's sites or else
+    its single site. The first site is the one attachments are converted for
+    and the post history points to.
+    """
+    sites = config.sites or [
+        {
+            "generator": config.generator,
+            "post_dir": config.post_dir,
+            "assets_dir": config.assets_dir,
+        }
+    ]
+    return [make_backend(**site) for site in sites]
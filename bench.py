@@ -0,0 +1,659 @@
+#!/usr/bin/env python3
+"""
+Standalone benchmarks for mail2blog.
+
+Run all benchmarks with `python bench.py`, or pick some by name, e.g.
+`python bench.py image_workers`. With `--output FILE`, the results are also
+written as JSON Lines, one record per measurement tagged with the current
+commit, and with `--compare FILE` they are compared against such a file
+from an earlier run.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import datetime
+import tempfile
+import shutil
+import hashlib
+import resource
+import tracemalloc
+import mailbox
+import subprocess
+import email.policy
+from email.message import EmailMessage
+from concurrent.futures import ProcessPoolExecutor
+from unittest.mock import patch
+
+from imap_tools import MailAttachment
+from markdownify import markdownify
+from PIL import Image
+
+import mail
+import converter
+import sanitize
+from fake_imap import FakeImapServer
+from jekyll import JekyllPost
+from assets import AssetStore
+from main import PostManager, import_archive
+
+BENCHMARKS = {}
+# the results of the benchmarks run so far
+RESULTS = []
+
+
+def benchmark(func):
+    """Register a benchmark under its function name."""
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def _timed(func, *args, **kwargs):
+    """Call func and return its result and the elapsed wall-clock time."""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def _report(name: str, params: dict, **metrics):
+    """Print and keep a benchmark's measurements for the given parameters."""
+    fields = {**params, **metrics}
+    print(
+        f"{name}: "
+        + " ".join(
+            f"{key}={round(value, 4) if isinstance(value, float) else value}"
+            for key, value in fields.items()
+        )
+    )
+    RESULTS.append({"benchmark": name, "params": params, "metrics": metrics})
+
+
+def _jpeg_payload(width: int, height: int, seed: int = 0) -> bytes:
+    """Build a photo-like JPEG with some detail, so encoders have real work."""
+    img = Image.effect_noise((width, height), 64 + seed % 32).convert("RGB")
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=90)
+    return buf.getvalue()
+
+
+def _attachment(payload: bytes, maintype: str, subtype: str, filename: str):
+    """Build an imap_tools MailAttachment of a base64-encoded MIME part."""
+    part = EmailMessage()
+    part.set_content(payload, maintype, subtype, filename=filename)
+    return MailAttachment(part)
+
+
+def _image_attachments(count: int, width: int, height: int) -> dict:
+    """Build imap_tools MailAttachment objects holding JPEGs."""
+    return {
+        f"img{i}": _attachment(
+            _jpeg_payload(width, height, seed=i), "image", "jpeg", f"photo{i}.jpg"
+        )
+        for i in range(count)
+    }
+
+
+def _digest_dir(directory: str) -> str:
+    """Hash the names and contents of all files in a directory."""
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(directory)):
+        digest.update(name.encode())
+        with open(os.path.join(directory, name), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+@benchmark
+def image_workers():
+    """Time html_to_blog_md on a post with many photos against worker count."""
+    attachments = _image_attachments(count=16, width=3000, height=2000)
+    html = "".join(f'<img src="cid:{cid}">' for cid in attachments)
+    digests = set()
+    for workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+        with tempfile.TemporaryDirectory() as assets_dir:
+            os.environ["M2B_BLOG_ASSETS_DIR"] = assets_dir
+            if workers > 1:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    # start the worker processes outside of the timed region
+                    list(executor.map(abs, range(workers)))
+                    _, elapsed = _timed(
+                        converter.html_to_blog_md, html, attachments, executor=executor
+                    )
+            else:
+                _, elapsed = _timed(converter.html_to_blog_md, html, attachments)
+            digests.add(_digest_dir(assets_dir))
+        _report("image_workers", {"workers": workers}, seconds=elapsed)
+    _report("image_workers", {}, identical_output=len(digests) == 1)
+
+
+def _peak_rss_growth(func, *args, **kwargs):
+    """
+    Call func and return its elapsed time and how far it raised the process's
+    peak RSS, in MiB. Run it in a fresh process for a meaningful baseline.
+    """
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    _, elapsed = _timed(func, *args, **kwargs)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux
+    return elapsed, (peak - baseline) / 1024
+
+
+@benchmark
+def jpeg_draft():
+    """Compare full and draft-mode decoding of large phone photos."""
+    with tempfile.TemporaryDirectory() as assets_dir:
+        output_path = os.path.join(assets_dir, "out.jpeg")
+        for width, height in ((4000, 3000), (8000, 6000)):
+            payload = _jpeg_payload(width, height)
+            for draft in (False, True):
+                # a fresh process per run, so peak RSS is not shared between runs
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    elapsed, peak_mib = executor.submit(
+                        _peak_rss_growth,
+                        converter._convert_image_to_jpeg,
+                        payload,
+                        output_path,
+                        draft=draft,
+                    ).result()
+                _report(
+                    "jpeg_draft",
+                    {"size": f"{width}x{height}", "draft": draft},
+                    seconds=elapsed,
+                    peak_rss_mib=peak_mib,
+                )
+
+
+@benchmark
+def sanitize_html():
+    """Compare converting newsletters to Markdown with and without sanitising."""
+    for sections in (2, 20, 200):
+        html = _newsletter_html(sections)
+        runs = max(1, 200 // sections)
+        raw_md, raw = _timed(lambda: [converter.md(html) for _ in range(runs)])
+        sanitized_md, sanitized = _timed(
+            lambda: [converter.md(sanitize.sanitize_html(html)[0]) for _ in range(runs)]
+        )
+        _report(
+            "sanitize_html",
+            {"sections": sections, "html_kib": round(len(html) / 1024, 1)},
+            raw_ms=1000 * raw / runs,
+            sanitized_ms=1000 * sanitized / runs,
+            raw_md_kib=len(raw_md[0]) / 1024,
+            sanitized_md_kib=len(sanitized_md[0]) / 1024,
+        )
+
+
+def _rewrite_cids_loop(content: str, urls: dict) -> str:
+    """The former cid rewriting: one pass over the content per attachment."""
+    for cid, url in urls.items():
+        content = content.replace(f"cid:{cid}", url)
+    return content
+
+
+@benchmark
+def cid_rewrite():
+    """Compare single-pass and per-attachment cid rewriting of long posts."""
+    for count in (10, 100, 1000):
+        cids = [f"part{i}.{i * 7919:08x}@example.com" for i in range(count)]
+        urls = {
+            cid: f"{{{{ site.baseurl }}}}/assets/{cid}.photo.jpg.jpeg" for cid in cids
+        }
+        # a newsletter with a few paragraphs of text around each image
+        content = "".join(
+            f"{'Lorem ipsum dolor sit amet. ' * 20}\n\n![photo](cid:{cid})\n\n"
+            for cid in cids
+        )
+        loop_result, loop_elapsed = _timed(_rewrite_cids_loop, content, urls)
+        result, elapsed = _timed(converter._rewrite_cids, content, urls, {})
+        _report(
+            "cid_rewrite",
+            {"attachments": count, "chars": len(content)},
+            loop_seconds=loop_elapsed,
+            single_pass_seconds=elapsed,
+            identical_output=result == loop_result,
+        )
+
+
+def _newsletter_html(sections: int) -> str:
+    """
+    Build HTML shaped like a marketing newsletter: a style sheet, a hidden
+    preheader, nested layout tables with Outlook conditional comments,
+    per-section headings, text, links and images, and a tracking pixel.
+    """
+    style = "<style>" + "".join(
+        f"td.c{i} {{ padding: 4px; color: #333; }}" for i in range(400)
+    )
+    paragraph = (
+        'Lorem <b>ipsum</b> dolor sit amet, <a href="https://example.com/">'
+        "consectetur</a>. "
+    ) * 8
+    body = "".join(
+        '<tr><td><!--[if mso]><table width="600"><tr><td><![endif]-->'
+        f'<table role="presentation"><tr><td class="c{i % 50}">'
+        f"<h2>Section {i}</h2><p>{paragraph}</p>"
+        f'<img src="cid:img{i}" alt="photo {i}"></td></tr></table>'
+        "<!--[if mso]></td></tr></table><![endif]--></td></tr>"
+        for i in range(sections)
+    )
+    return (
+        f"<html><head>{style}</style></head><body>"
+        '<div style="display:none">Our latest news</div>'
+        f"<table>{body}</table>"
+        '<img src="https://t.example.com/open.gif" width="1" height="1">'
+        "</body></html>"
+    )
+
+
+@benchmark
+def markdown_conversion():
+    """
+    Compare the shared converter against markdownify's per-call one across
+    email sizes, and the plain-text path against wrapping text in HTML.
+    """
+    for sections in (2, 20, 200):
+        html = _newsletter_html(sections)
+        runs = max(1, 200 // sections)
+        _, per_call = _timed(lambda: [markdownify(html) for _ in range(runs)])
+        _, shared = _timed(lambda: [converter.md(html) for _ in range(runs)])
+        _report(
+            "markdown_conversion",
+            {
+                "parser": converter.HTML_PARSER,
+                "html_kib": round(len(html) / 1024, 1),
+            },
+            per_call_ms=1000 * per_call / runs,
+            shared_ms=1000 * shared / runs,
+        )
+    text = "Lorem ipsum dolor sit amet, consectetur adipiscing elit.\n\n" * 200
+    html = "".join(f"<p>{line}</p>" for line in text.split("\n\n"))
+    _, as_html = _timed(lambda: [converter.md(html) for _ in range(20)])
+    _, as_text = _timed(lambda: [converter.text_to_md(text) for _ in range(20)])
+    _report(
+        "markdown_conversion",
+        {"text_kib": round(len(text) / 1024, 1)},
+        as_html_ms=1000 * as_html / 20,
+        plain_text_ms=1000 * as_text / 20,
+    )
+
+
+def _raw_email(number: int, html: str, images: dict) -> bytes:
+    """Build a raw HTML email with the given images inline, keyed by cid."""
+    message = EmailMessage(policy=email.policy.SMTP)
+    message["Subject"] = f"Newsletter {number}"
+    message["From"] = "Newsletter <news@example.com>"
+    message["Date"] = "Sun, 01 Jan 2023 12:00:00 +0000"
+    message["Message-ID"] = f"<{number}@example.com>"
+    message.set_content(html, subtype="html")
+    for cid, image in images.items():
+        message.add_related(
+            image.payload, "image", "jpeg", cid=f"<{cid}>", filename=image.filename
+        )
+    return message.as_bytes()
+
+
+@benchmark
+def read_mail():
+    """Time fetching new mail from a local fake IMAP server."""
+    for count, sections, images in ((200, 2, 0), (20, 200, 0), (20, 5, 5)):
+        attachments = _image_attachments(images, width=1600, height=1200)
+        raw_messages = [
+            _raw_email(i, _newsletter_html(sections), attachments) for i in range(count)
+        ]
+        mib = sum(len(raw_message) for raw_message in raw_messages) / 2**20
+        with tempfile.TemporaryDirectory() as state_dir, patch.object(
+            mail.SyncState,
+            "M2B_SYNC_STATE_FILEPATH",
+            os.path.join(state_dir, "sync_state.json"),
+        ), FakeImapServer(raw_messages) as server:
+            config = mail.MailboxConfig(
+                host="127.0.0.1", port=server.port, user="user", password="pass"
+            )
+            config.ssl = False
+            fetched, elapsed = _timed(
+                lambda: sum(1 for _ in mail.read_mail(config=config))
+            )
+        assert fetched == count
+        _report(
+            "read_mail",
+            {"messages": count, "sections": sections, "images": images},
+            seconds=elapsed,
+            messages_per_second=count / elapsed,
+            mib_per_second=mib / elapsed,
+        )
+
+
+@benchmark
+def html_to_blog_md():
+    """Time converting emails of various sizes and inline image counts."""
+    for sections, images, width, height in (
+        (2, 0, 0, 0),
+        (200, 0, 0, 0),
+        (20, 10, 1600, 1200),
+        (10, 10, 4000, 3000),
+        (50, 50, 800, 600),
+    ):
+        html = _newsletter_html(sections)
+        attachments = _image_attachments(images, width, height)
+        with tempfile.TemporaryDirectory() as assets_dir:
+            _, elapsed = _timed(
+                converter.html_to_blog_md, html, attachments, assets_dir=assets_dir
+            )
+        _report(
+            "html_to_blog_md",
+            {
+                "html_kib": round(len(html) / 1024, 1),
+                "images": images,
+                "size": f"{width}x{height}",
+            },
+            seconds=elapsed,
+        )
+
+
+def _write_whole_payload(att, dest_path: str):
+    """Write an attachment the way it was written before streaming."""
+    with open(dest_path, "wb") as dest_file:
+        dest_file.write(att.part.get_payload(decode=True))
+
+
+@benchmark
+def attachment_write():
+    """Compare the memory of writing large attachments whole and streamed."""
+    for mib in (10, 100):
+        att = _attachment(os.urandom(mib * 2**20), "application", "pdf", "doc.pdf")
+        with tempfile.TemporaryDirectory() as assets_dir:
+            for mode, write in (
+                ("whole", _write_whole_payload),
+                ("streamed", converter._write_attachment),
+            ):
+                dest_path = os.path.join(assets_dir, f"{mode}.pdf")
+                tracemalloc.start()
+                _, elapsed = _timed(write, att, dest_path)
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                assert os.path.getsize(dest_path) == mib * 2**20
+                _report(
+                    "attachment_write",
+                    {"mib": mib, "mode": mode},
+                    seconds=elapsed,
+                    peak_traced_mib=peak / 2**20,
+                )
+
+
+def _gif_payload(frames: int, width: int, height: int) -> bytes:
+    """
+    Build a looping GIF of moving noise, like a phone screen recording, in
+    which every other frame is shown twice.
+    """
+    noise = Image.effect_noise((width, height), 64).convert("RGB")
+    images = []
+    for index in range(frames):
+        frame = noise.transform(
+            noise.size, Image.AFFINE, (1, 0, (index // 2) * 4, 0, 1, 0)
+        )
+        images.append(frame.quantize(64))
+    buf = io.BytesIO()
+    # without optimize, Pillow would drop the repeated frames itself
+    images[0].save(
+        buf,
+        "GIF",
+        save_all=True,
+        append_images=images[1:],
+        duration=40,
+        loop=0,
+        optimize=False,
+        disposal=1,
+    )
+    return buf.getvalue()
+
+
+@benchmark
+def gif_conversion():
+    """
+    Compare the size of animated GIFs kept as they are with their conversion
+    to each format, and the memory of converting GIFs of growing length.
+    """
+    gif_formats = ["gif", "webp"]
+    if shutil.which("ffmpeg"):
+        gif_formats += ["mp4", "webm"]
+    with tempfile.TemporaryDirectory() as assets_dir:
+        for frames in (20, 80):
+            payload = _gif_payload(frames, 1080, 1080)
+            _report(
+                "gif_conversion", {"frames": frames}, original_mib=len(payload) / 2**20
+            )
+            for gif_format in gif_formats:
+                output_path = os.path.join(assets_dir, f"out.{gif_format}")
+                # a fresh process per run, so peak RSS is not shared between runs
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    elapsed, peak_mib = executor.submit(
+                        _peak_rss_growth,
+                        converter._convert_gif,
+                        payload,
+                        output_path,
+                        gif_format,
+                    ).result()
+                _report(
+                    "gif_conversion",
+                    {"frames": frames, "format": gif_format},
+                    seconds=elapsed,
+                    peak_rss_mib=peak_mib,
+                    size_ratio=os.path.getsize(output_path) / len(payload),
+                )
+
+
+@benchmark
+def jpeg_conversion():
+    """Time converting single photos of common resolutions to JPEG."""
+    with tempfile.TemporaryDirectory() as assets_dir:
+        output_path = os.path.join(assets_dir, "out.jpeg")
+        for width, height in ((640, 480), (1920, 1080), (4000, 3000)):
+            payload = _jpeg_payload(width, height)
+            runs = 5
+            _, elapsed = _timed(
+                lambda: [
+                    converter._convert_image_to_jpeg(payload, output_path)
+                    for _ in range(runs)
+                ]
+            )
+            _report(
+                "jpeg_conversion",
+                {"size": f"{width}x{height}"},
+                ms_per_image=1000 * elapsed / runs,
+            )
+
+
+@benchmark
+def jekyll_save():
+    """
+    Time saving posts of small and large content, into an empty directory
+    and into one already holding 30k posts, including one of each title.
+    """
+    for content_kib, existing in ((1, 0), (100, 0), (1, 30000)):
+        content = "Lorem ipsum dolor sit amet.\n" * (content_kib * 1024 // 28)
+        posts = [
+            JekyllPost(
+                title=f"Post {i}",
+                author="Author",
+                date=datetime.datetime(2023, 1, 1),
+                content=content,
+            )
+            for i in range(200)
+        ]
+        with tempfile.TemporaryDirectory() as post_dir:
+            for i in range(existing):
+                open(os.path.join(post_dir, f"2023-01-01-post-{i}.md"), "w").close()
+            _, elapsed = _timed(
+                lambda: [post.save(directory=post_dir) for post in posts]
+            )
+        _report(
+            "jekyll_save",
+            {"posts": len(posts), "content_kib": content_kib, "existing": existing},
+            ms_per_post=1000 * elapsed / len(posts),
+        )
+
+
+@benchmark
+def post_manager():
+    """Time loading and appending to post histories of growing length."""
+    for entries in (10, 1000, 10000, 100000):
+        with tempfile.TemporaryDirectory() as state_dir:
+            journal_path = os.path.join(state_dir, "post_history.jsonl")
+            with open(journal_path, "w", encoding="utf-8") as f:
+                for i in range(entries):
+                    f.write(
+                        PostManager._journal_record(
+                            f"<{i}@example.com>", f"_posts/2023-01-01-post-{i}.md"
+                        )
+                    )
+            with patch.object(PostManager, "M2B_POST_HISTORY_FILEPATH", journal_path):
+                post_manager = PostManager()
+                _, load = _timed(post_manager.previously_posted, "<new@example.com>")
+                records = 50
+                _, record = _timed(
+                    lambda: [
+                        post_manager.record_posting(
+                            f"<new{i}@example.com>", f"_posts/new-{i}.md"
+                        )
+                        for i in range(records)
+                    ]
+                )
+        _report(
+            "post_manager",
+            {"entries": entries},
+            load_ms=1000 * load,
+            ms_per_record=1000 * record / records,
+        )
+
+
+@benchmark
+def history_batches():
+    """Time recording a backlog of posts with the history committed in batches."""
+    records = 2000
+    for batch_size in (1, 10, 100):
+        with tempfile.TemporaryDirectory() as state_dir, patch.object(
+            PostManager,
+            "M2B_POST_HISTORY_FILEPATH",
+            os.path.join(state_dir, "post_history.jsonl"),
+        ):
+            post_manager = PostManager(batch_size=batch_size)
+
+            def record_all():
+                for i in range(records):
+                    post_manager.record_posting(f"<{i}@example.com>", f"post-{i}.md")
+                post_manager.close()
+
+            _, elapsed = _timed(record_all)
+        _report(
+            "history_batches",
+            {"records": records, "batch_size": batch_size},
+            seconds=elapsed,
+        )
+
+
+@benchmark
+def archive_import():
+    """Time importing an mbox archive of newsletters into posts, end to end."""
+    count = 200
+    attachments = _image_attachments(2, width=1600, height=1200)
+    with tempfile.TemporaryDirectory() as work_dir:
+        mbox_path = os.path.join(work_dir, "archive.mbox")
+        archive = mailbox.mbox(mbox_path)
+        for i in range(count):
+            archive.add(_raw_email(i, _newsletter_html(20), attachments))
+        archive.close()
+        mib = os.path.getsize(mbox_path) / 2**20
+        for workers in (1, 4):
+            run_dir = os.path.join(work_dir, f"run{workers}")
+            for name in ("_posts", "assets"):
+                os.makedirs(os.path.join(run_dir, name))
+            env = {
+                "M2B_BLOG_POST_DIR": os.path.join(run_dir, "_posts"),
+                "M2B_BLOG_ASSETS_DIR": os.path.join(run_dir, "assets"),
+                "M2B_PIPELINE_WORKERS": str(workers),
+            }
+            with patch.dict("os.environ", env), patch.object(
+                PostManager,
+                "M2B_POST_HISTORY_FILEPATH",
+                os.path.join(run_dir, "post_history.jsonl"),
+            ), patch.object(
+                AssetStore,
+                "M2B_ASSET_INDEX_FILEPATH",
+                os.path.join(run_dir, "asset_index.jsonl"),
+            ):
+                _, elapsed = _timed(import_archive, mbox_path)
+            assert len(os.listdir(env["M2B_BLOG_POST_DIR"])) == count
+            _report(
+                "archive_import",
+                {"emails": count, "workers": workers},
+                seconds=elapsed,
+                emails_per_second=count / elapsed,
+                mib_per_second=mib / elapsed,
+            )
+
+
+def _git_commit():
+    """The commit of the working tree, or None outside of a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _compare(baseline_path: str):
+    """Print the ratio of each numeric result to the same one in a baseline."""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {
+            (record["benchmark"], json.dumps(record["params"], sort_keys=True)): record
+            for record in map(json.loads, f)
+        }
+    for result in RESULTS:
+        params = json.dumps(result["params"], sort_keys=True)
+        base = baseline.get((result["benchmark"], params))
+        if base is None:
+            continue
+        for metric, value in result["metrics"].items():
+            base_value = base["metrics"].get(metric)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            if not base_value:
+                continue
+            print(
+                f"{result['benchmark']} {params} {metric}: "
+                f"{base_value:.4g} -> {value:.4g} ({value / base_value:.2f}x)"
+            )
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("names", nargs="*", help="benchmarks to run, by default all")
+    parser.add_argument("--output", help="write the results as JSON Lines to a file")
+    parser.add_argument("--compare", help="compare with the results of an earlier run")
+    args = parser.parse_args(argv)
+    # keep per-email logging out of the results
+    logging.getLogger("mail2blog").setLevel(logging.WARNING)
+
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name]()
+
+    if args.output:
+        commit = _git_commit()
+        timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        with open(args.output, "w", encoding="utf-8") as f:
+            for result in RESULTS:
+                record = dict(result, commit=commit, timestamp=timestamp)
+                f.write(json.dumps(record) + "\n")
+    if args.compare:
+        _compare(args.compare)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,45 +1,671 @@
+import io
 import os
-from markdownify import markdownify as md
+import math
+import shutil
+import hashlib
+import logging
+import importlib.util
+import re
+import threading
+import subprocess
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import partial, reduce
+from html import escape
+from typing import Callable, Optional
+from markdownify import MarkdownConverter
 from imap_tools import MailAttachment
-from PIL import Image
+from PIL import GifImagePlugin, Image, ImageSequence
+from assets import AssetStore
+from policy import AttachmentPolicy, iter_payload, read_payload
+from sanitize import sanitize_html
+import metrics
+from manifest import MANIFEST
 
+logger = logging.getLogger("mail2blog")
 
-def _convert_image_to_jpeg(input_path, output_path, max_width=600):
-    with Image.open(input_path) as img:
+JPEG_MAX_WIDTH = 600
+
+# parse HTML with lxml when it is installed, as it is much faster than html.parser
+HTML_PARSER = "lxml" if importlib.util.find_spec("lxml") else "html.parser"
+
+# one converter shared by all emails, rather than a new one per email
+_markdown_converter = MarkdownConverter(bs4_options=HTML_PARSER)
+
+# extra responsive image formats, by name, to Pillow format and MIME type
+IMAGE_FORMATS = {
+    "webp": ("WEBP", "image/webp"),
+    "avif": ("AVIF", "image/avif"),
+}
+
+# formats animated GIFs can be converted to, by name and file extension, to MIME type
+GIF_FORMATS = {
+    "gif": "image/gif",
+    "webp": "image/webp",
+    "mp4": "video/mp4",
+    "webm": "video/webm",
+}
+
+# ffmpeg output options of the GIF formats encoded as video
+VIDEO_CODECS = {
+    "mp4": ["-c:v", "libx264", "-crf", "28", "-movflags", "+faststart"],
+    "webm": ["-c:v", "libvpx-vp9", "-crf", "40", "-b:v", "0"],
+}
+
+# browsers show GIF frames of less than 20 ms for 100 ms
+GIF_MIN_DURATION = 20
+GIF_DEFAULT_DURATION = 100
+
+
+def md(html: str) -> str:
+    """Convert HTML to Markdown."""
+    return _markdown_converter.convert(html)
+
+
+def text_to_md(text: str) -> str:
+    """
+    Convert a plain-text email body to Markdown without parsing it as HTML,
+    escaping the characters that would otherwise be read as Markdown.
+    """
+    return _markdown_converter.escape(text.replace("\r\n", "\n"), set()).strip()
+
+
+def _resize_to_width(img, width, height, target_width):
+    """Resize img, decoded from a width x height source, to target_width."""
+    if target_width >= width:
+        return img
+    new_height = int(height * target_width / width)
+    return img.resize((target_width, new_height), Image.LANCZOS)
+
+
+def _draft(img, width, height, decode_width, draft=True, min_scale=1):
+    """
+    With draft, have a JPEG decoded at the smallest DCT scale (1/2, 1/4 or
+    1/8) that is still at least decode_width wide, and in any case at no more
+    than 1/min_scale of its size. A no-op for formats other than JPEG.
+    """
+    request = (width, height)
+    if draft and decode_width < width:
+        request = (decode_width, int(height * decode_width / width))
+    if min_scale > 1:
+        request = (
+            min(request[0], width // min_scale),
+            min(request[1], height // min_scale),
+        )
+    if request != (width, height):
+        img.draft(None, request)
+
+
+def _write_atomically(output_path, write):
+    """
+    Write a file with write(path) to a temporary path next to output_path and
+    rename it into place, so a failed conversion leaves no partial file behind.
+    """
+    # a hidden file, so the site generator never copies a partial asset;
+    # unlike tempfile.mkstemp, a new path keeps the default permissions of files
+    directory, filename = os.path.split(output_path)
+    tmp_path = os.path.join(
+        directory, f".{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    )
+    try:
+        with metrics.stage("image_encode") as measurement:
+            write(tmp_path)
+            measurement.bytes = os.path.getsize(tmp_path)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _save_atomically(img, output_path, image_format):
+    """Save img with Pillow, like _write_atomically."""
+    _write_atomically(output_path, partial(img.save, format=image_format))
+
+
+def _convert_image_to_jpeg(
+    payload: bytes, output_path, max_width=JPEG_MAX_WIDTH, draft=True, min_scale=1
+):
+    """
+    Decode an image from its raw bytes and save it as a JPEG, no wider than
+    max_width, without ever writing the original to disk.
+
+    With draft, JPEG sources are decoded at the smallest DCT scale (1/2, 1/4
+    or 1/8) that is still at least the target size before being resized.
+    JPEGs are decoded at no more than 1/min_scale of their size.
+    """
+    with Image.open(io.BytesIO(payload)) as img:
+        with metrics.stage("image_decode", len(payload)):
+            width, height = img.size
+            _draft(img, width, height, max_width, draft, min_scale)
+            img.load()
+        with metrics.stage("image_resize"):
+            img = _resize_to_width(img, width, height, max_width).convert("RGB")
+        _save_atomically(img, output_path, "JPEG")
+
+
+def _convert_image_variants(
+    payload: bytes,
+    output_path,
+    widths,
+    formats=(),
+    max_width=JPEG_MAX_WIDTH,
+    draft=True,
+    min_scale=1,
+) -> list[tuple[str, int, str]]:
+    """
+    Decode an image once and save it as a JPEG no wider than max_width, like
+    _convert_image_to_jpeg, plus a variant at each of the given widths as a
+    JPEG and in each of the extra formats. Widths above the image's own are
+    capped to it rather than upscaled.
+
+    Returns the (filename, width, MIME type) of each variant.
+    """
+    base_path, _ = os.path.splitext(output_path)
+    with Image.open(io.BytesIO(payload)) as img:
+        with metrics.stage("image_decode", len(payload)):
+            width, height = img.size
+            variant_widths = sorted({min(w, width) for w in widths}, reverse=True)
+            decode_width = max(variant_widths + [min(max_width, width)])
+            _draft(img, width, height, decode_width, draft, min_scale)
+            img.load()
+
+        with metrics.stage("image_resize"):
+            resized = _resize_to_width(img, width, height, max_width).convert("RGB")
+        _save_atomically(resized, output_path, "JPEG")
+        variants = []
+        for variant_width in variant_widths:
+            with metrics.stage("image_resize"):
+                resized = _resize_to_width(img, width, height, variant_width)
+            variant_path = f"{base_path}.{variant_width}w.jpeg"
+            _save_atomically(resized.convert("RGB"), variant_path, "JPEG")
+            variants.append(
+                (os.path.basename(variant_path), variant_width, "image/jpeg")
+            )
+            for name in formats:
+                image_format, mime_type = IMAGE_FORMATS[name]
+                mode = "RGBA" if "A" in resized.getbands() else "RGB"
+                variant_path = f"{base_path}.{variant_width}w.{name}"
+                _save_atomically(resized.convert(mode), variant_path, image_format)
+                variants.append(
+                    (os.path.basename(variant_path), variant_width, mime_type)
+                )
+    return variants
+
+
+def _unique_frames(img) -> tuple[list[int], list[int]]:
+    """
+    The index and duration, in milliseconds, of each frame of an animated
+    image that differs from the frame before it. The durations of the frames
+    dropped as duplicates are added to the frame they repeat. Only one frame
+    is decoded at a time.
+    """
+    indexes = []
+    durations = []
+    previous = None
+    for index, frame in enumerate(ImageSequence.Iterator(img)):
+        duration = frame.info.get("duration", 0)
+        if duration < GIF_MIN_DURATION:
+            duration = GIF_DEFAULT_DURATION
+        digest = hashlib.blake2b(frame.convert("RGBA").tobytes()).digest()
+        if digest == previous:
+            durations[-1] += duration
+            continue
+        previous = digest
+        indexes.append(index)
+        durations.append(duration)
+    return indexes, durations
+
+
+def _resized_frames(img, indexes: list[int], size: tuple[int, int], mode: str):
+    """
+    Yield the frames of an animated image at the given indexes, converted to
+    mode and resized to size, decoding each only when it is asked for.
+    """
+    for index in indexes:
+        img.seek(index)
+        with metrics.stage("image_resize"):
+            frame = img.convert(mode)
+            if frame.size != size:
+                frame = frame.resize(size, Image.LANCZOS)
+        yield frame
+
+
+class _ResizedFrames(Image.Image):
+    """
+    The frames of _resized_frames as a multi-frame image, for Pillow's WebP
+    save_all writer, which seeks through each image it is given rather than
+    taking frames from an iterator. A frame is only decoded and resized when
+    seeked to, so one frame is held at a time.
+
+    Like Pillow's own image plugins, it sets the mode, size and image core of
+    the current frame itself, which needs Pillow 11 or later.
+    """
+
+    def __init__(self, img, indexes: list[int], size: tuple[int, int], mode: str):
+        super().__init__()
+        self._source = img
+        self._indexes = indexes
+        self._size = size
+        self._mode = mode
+        self.n_frames = len(indexes)
+        self.seek(0)
+
+    def seek(self, frame: int):
+        if not 0 <= frame < self.n_frames:
+            raise EOFError("no more frames")
+        index = self._indexes[frame]
+        self.im = next(_resized_frames(self._source, [index], self.size, self.mode)).im
+        self._frame = frame
+
+    def tell(self) -> int:
+        return self._frame
+
+
+def _gif_frame(frame):
+    """Reduce an RGBA frame to a palette, with index 255 as its transparency."""
+    alpha = frame.getchannel("A")
+    if alpha.getextrema()[0] >= 128:
+        return frame.convert("RGB").quantize(256), {}
+    paletted = frame.convert("RGB").quantize(255)
+    palette = paletted.getpalette()
+    paletted.putpalette(palette + [0] * (768 - len(palette)))
+    paletted.paste(255, mask=alpha.point(lambda a: 255 if a < 128 else 0))
+    # each frame is drawn in full, so transparent pixels must not show the last
+    return paletted, {"transparency": 255, "disposal": 2}
+
+
+def _write_gif(frames, durations, path):
+    """Write frames as a looping GIF, encoding one frame at a time."""
+    with open(path, "xb") as fp:
+        for index, frame in enumerate(frames):
+            paletted, params = _gif_frame(frame)
+            if index == 0:
+                header, _ = GifImagePlugin.getheader(
+                    paletted, info={"loop": 0, "optimize": False}
+                )
+                fp.write(b"".join(header))
+            data = GifImagePlugin.getdata(
+                paletted,
+                duration=durations[index],
+                include_color_table=True,
+                **params,
+            )
+            fp.write(b"".join(data))
+        fp.write(b";")
+
+
+def _write_webp(frames, durations, path):
+    """Write frames as a looping animated WebP, encoding one frame at a time."""
+    frames.save(path, "WEBP", save_all=True, duration=durations, loop=0)
+
+
+def _write_video(frames, durations, path, size, video_format):
+    """
+    Write frames as a looping MP4 or WebM video with ffmpeg, piping it one
+    raw frame at a time. Frames are repeated at a constant frame rate to last
+    their duration.
+    """
+    tick = reduce(math.gcd, durations)
+    width, height = size
+    command = [
+        shutil.which("ffmpeg") or "ffmpeg",
+        "-v",
+        "error",
+        "-n",
+        "-f",
+        "rawvideo",
+        "-pix_fmt",
+        "rgb24",
+        "-s",
+        f"{width}x{height}",
+        "-framerate",
+        f"1000/{tick}",
+        "-i",
+        "-",
+        "-an",
+        # yuv420p, which players expect, needs an even width and height
+        "-vf",
+        "scale=trunc(iw/2)*2:trunc(ih/2)*2",
+        "-pix_fmt",
+        "yuv420p",
+        *VIDEO_CODECS[video_format],
+        "-f",
+        video_format,
+        path,
+    ]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    try:
+        for index, frame in enumerate(frames):
+            data = frame.tobytes()
+            for _ in range(durations[index] // tick):
+                process.stdin.write(data)
+    except BrokenPipeError:
+        # ffmpeg failed, as its exit status tells
+        pass
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = process.wait()
+    if returncode != 0:
+        raise OSError(f"ffmpeg exited with status {returncode}")
+
+
+def _convert_gif(
+    payload: bytes, output_path, gif_format="gif", max_width=JPEG_MAX_WIDTH
+):
+    """
+    Convert an animated GIF from its raw bytes to gif_format, one of
+    GIF_FORMATS, no wider than max_width, dropping each frame that repeats
+    the one before it. Frames are decoded, resized and encoded one at a
+    time, so memory does not grow with their number. MP4 and WebM videos are
+    encoded by ffmpeg.
+    """
+    with Image.open(io.BytesIO(payload)) as img:
+        with metrics.stage("image_decode", len(payload)):
+            indexes, durations = _unique_frames(img)
         width, height = img.size
-        if width > max_width:
-            new_height = int(height * max_width / width)
-            img = img.resize((max_width, new_height), Image.LANCZOS)
-        img.convert("RGB").save(output_path, "JPEG")
+        target_width = min(width, max_width)
+        size = (target_width, max(1, int(height * target_width / width)))
+        if gif_format in VIDEO_CODECS:
+            frames = _resized_frames(img, indexes, size, "RGB")
+            write = partial(_write_video, size=size, video_format=gif_format)
+        elif gif_format == "webp":
+            frames = _ResizedFrames(img, indexes, size, "RGBA")
+            write = _write_webp
+        else:
+            frames = _resized_frames(img, indexes, size, "RGBA")
+            write = _write_gif
+        _write_atomically(output_path, partial(write, frames, durations))
+
+
+def _write_attachment(att: MailAttachment, dest_path: str):
+    """
+    Save an attachment as it is, decoding its MIME part and writing it in
+    chunks rather than holding it in memory as a whole.
+    """
+    with metrics.stage("attachment_write") as measurement:
+        with open(dest_path, "wb") as dest_file:
+            for chunk in iter_payload(att):
+                dest_file.write(chunk)
+            measurement.bytes = dest_file.tell()
+
+
+# a Markdown image, as markdownify renders it, whose source is a cid: reference
+MD_IMAGE_PATTERN = r'!\[(?P<alt>[^\]]*)\]\(cid:{cid}(?: "(?P<title>[^"]*)")?\)'
+
+
+def jekyll_asset_url(assets_dir: str, att_filename: str) -> str:
+    """Link to a file in the assets directory, relative to the Jekyll site base URL."""
+    return f"{{{{ site.baseurl }}}}/{os.path.basename(assets_dir)}/{att_filename}"
+
+
+def _video_html(alt: str, title: Optional[str], src: str) -> str:
+    """Build a <video> element playing like an animated image in its place."""
+    title_attr = f' title="{escape(title)}"' if title else ""
+    return (
+        f'<video src="{src}" autoplay loop muted playsinline '
+        f'aria-label="{escape(alt)}"{title_attr}></video>'
+    )
+
+
+def _picture_html(alt: str, title: Optional[str], src: str, srcsets: dict) -> str:
+    """Build a <picture> element offering the srcset of each MIME type."""
+    sources = "".join(
+        f'<source type="{mime_type}" srcset="{srcset}">'
+        for mime_type, srcset in srcsets.items()
+        if mime_type != "image/jpeg"
+    )
+    title_attr = f' title="{escape(title)}"' if title else ""
+    return (
+        f"<picture>{sources}"
+        f'<img src="{src}" srcset="{srcsets["image/jpeg"]}" alt="{escape(alt)}"{title_attr}>'
+        "</picture>"
+    )
 
 
-def html_to_blog_md(html: str, attachments_dict: dict[str, MailAttachment]) -> str:
-    # convert HTML content to markdown
-    content = md(html)
+def _rewrite_cids(
+    content: str, urls: dict, pictures: dict, videos: Optional[set] = None
+) -> str:
+    """
+    Replace every cid: reference in content with the URL of its attachment in
+    a single scan. Markdown images of the cids in `pictures` become <picture>
+    elements with the given srcset per MIME type instead, and those of the
+    cids in `videos` become looping <video> elements.
+    """
+    videos = videos or set()
+    if not urls:
+        return content
+
+    def alternation(cids):
+        # longest first, so a cid that is a prefix of another does not win
+        return "|".join(re.escape(cid) for cid in sorted(cids, key=len, reverse=True))
+
+    pattern = f"cid:(?P<cid>{alternation(urls)})"
+    if pictures or videos:
+        image_pattern = MD_IMAGE_PATTERN.format(
+            cid=f"(?P<image_cid>{alternation(set(pictures) | videos)})"
+        )
+        pattern = f"{image_pattern}|{pattern}"
+
+    def replace(match):
+        if match.group("cid") is not None:
+            return urls[match.group("cid")]
+        cid = match.group("image_cid")
+        if cid in videos:
+            return _video_html(match.group("alt"), match.group("title"), urls[cid])
+        return _picture_html(
+            match.group("alt"), match.group("title"), urls[cid], pictures[cid]
+        )
+
+    return re.sub(pattern, replace, content)
+
+
+def html_to_blog_md(
+    html: str,
+    attachments_dict: dict[str, MailAttachment],
+    executor: Optional[Executor] = None,
+    asset_store: Optional[AssetStore] = None,
+    image_widths=(),
+    image_formats=(),
+    assets_dir: Optional[str] = None,
+    text: Optional[str] = None,
+    asset_url: Optional[Callable[[str], str]] = None,
+    policy: Optional[AttachmentPolicy] = None,
+    gif_format: Optional[str] = None,
+) -> str:
+    """
+    Convert an email's HTML to Markdown and save its attachments as assets.
+
+    The HTML is first stripped of markup without content by
+    sanitize.sanitize_html. Image conversions are submitted to `executor`
+    when one is given, and otherwise run one after another in the current
+    process. With an `asset_store`, attachments that were stored before with
+    the same content and conversion, or are being stored for another email,
+    are linked to the existing file instead.
+    With `image_widths`, images also get variants at those widths, in JPEG
+    and each of `image_formats`, and are embedded as <picture> elements with
+    a srcset. Assets are saved to `assets_dir`, by default
+    M2B_BLOG_ASSETS_DIR, and linked to by `asset_url(filename)`, by default
+    the Jekyll URL of the file. With a `policy`, attachments are skipped,
+    capped or streamed to disk as it decides. With a `gif_format`, one of
+    GIF_FORMATS, GIFs are resized and converted to it rather than saved as
+    they are, and those converted to video are embedded as looping <video>
+    elements. An email without HTML is converted from its plain `text`
+    instead.
+    """
+    if html or not text:
+        # strip markup without content, then convert HTML content to markdown
+        with metrics.stage("sanitize", len(html)):
+            html, removed = sanitize_html(html)
+        if removed:
+            removed = ", ".join(f"{rule}={count}" for rule, count in removed.items())
+            logger.info(f"Removed from email HTML: {removed}")
+        with metrics.stage("markdown", len(html)):
+            content = md(html)
+    else:
+        with metrics.stage("markdown", len(text)):
+            content = text_to_md(text)
     # save each of the attachments to the target assets directory
-    assets_dir = os.environ.get("M2B_BLOG_ASSETS_DIR")
+    assets_dir = assets_dir or os.environ.get("M2B_BLOG_ASSETS_DIR")
+    # the same file is only reused within the same assets directory
+    image_params = (assets_dir, "jpeg", JPEG_MAX_WIDTH)
+    if image_widths:
+        image_params += (tuple(image_widths), tuple(image_formats))
+    gif_params = (assets_dir, gif_format, JPEG_MAX_WIDTH)
+    att_filenames = {}
+    att_variants = {}
+    conversions = []
+    new_assets = {}
+    # the files written, rather than reused
+    saved_filenames = []
+    gif_cids = set()
+    attachments = []
     for cid, att in attachments_dict.items():
         # add cid to filename to mitigate conflicts
         att_filename = f"{cid}.{att.filename}"
         is_image = att.content_type.split("/")[0] == "image"
         is_gif = att.content_type.lower() == "image/gif"
+        convert_gif = is_gif and gif_format is not None
 
-        # Only add .jpeg extension if it's an image but not a GIF
+        # Only add .jpeg extension if it's an image but not a GIF, and the
+        # extension of the format GIFs are converted to
         if is_image and not is_gif:
             att_filename += ".jpeg"
+        elif convert_gif and gif_format != "gif":
+            att_filename += f".{gif_format}"
+        if is_gif:
+            gif_cids.add(cid)
 
-        dest_path = os.path.join(assets_dir, att_filename)
-        with open(dest_path, "wb") as dest_file:
-            dest_file.write(att.payload)
+        decision = policy.decide(att) if policy is not None else None
+        if decision is not None and decision.action == "skip":
+            continue
+        # only images to convert are decoded as a whole, and not cached on
+        # the attachment, so they are freed once converted
+        payload = None
+        if (is_image and not is_gif) or convert_gif:
+            payload = read_payload(att)
 
-        # Only convert to JPEG if it's an image but not a GIF
-        if is_image and not is_gif:
-            _convert_image_to_jpeg(dest_path, dest_path)
+        key = None
+        if asset_store is not None:
+            if convert_gif:
+                key = asset_store.key(payload, *gif_params)
+            elif payload is not None:
+                key = asset_store.key(payload, *image_params)
+            else:
+                key = asset_store.key_chunks(iter_payload(att), assets_dir)
+        attachments.append((cid, att, att_filename, decision, payload, key))
 
-        # update the cid src to the path of the attachment file relative to the site base URL and the assets directory
-        # TODO: make this generator agnostic; presently specific to jekyll
-        att_rel_path = (
-            f"{{{{ site.baseurl }}}}/{os.path.basename(assets_dir)}/{att_filename}"
-        )
-        content = content.replace(f"cid:{cid}", att_rel_path)
-    return content
+    stored_assets = {}
+    try:
+        # claim the assets in key order, as other messages may claim them too
+        if asset_store is not None:
+            for key in sorted({attachment[-1] for attachment in attachments}):
+                stored_assets[key] = asset_store.claim(key, assets_dir)
+
+        for cid, att, att_filename, decision, payload, key in attachments:
+            is_image = att.content_type.split("/")[0] == "image"
+            is_gif = att.content_type.lower() == "image/gif"
+            convert_gif = is_gif and gif_format is not None
+            if key is not None:
+                if key in new_assets:
+                    att_filenames[cid] = new_assets[key]
+                    continue
+                stored = stored_assets[key]
+                if stored:
+                    att_filenames[cid], att_variants[stored[0]] = stored
+                    continue
+                new_assets[key] = att_filename
+
+            dest_path = os.path.join(assets_dir, att_filename)
+            convert = None
+            # Only convert to JPEG if it's an image but not a GIF; images are
+            # decoded from memory so only the converted file is ever written
+            if is_image and not is_gif and image_widths:
+                convert = _convert_image_variants
+                args = (payload, dest_path, image_widths, image_formats)
+            elif is_image and not is_gif:
+                convert = _convert_image_to_jpeg
+                args = (payload, dest_path)
+            elif convert_gif:
+                convert = _convert_gif
+                args = (payload, dest_path, gif_format)
+            else:
+                _write_attachment(att, dest_path)
+            if convert is not None:
+                if decision is not None and decision.min_scale > 1:
+                    convert = partial(convert, min_scale=decision.min_scale)
+                conversions.append((att_filename, convert, args))
+            att_filenames[cid] = att_filename
+            saved_filenames.append(att_filename)
+
+        if executor is None:
+            results = [
+                (att_filename, convert(*args))
+                for att_filename, convert, args in conversions
+            ]
+        elif isinstance(executor, ProcessPoolExecutor):
+            futures = [
+                (att_filename, executor.submit(metrics.measured, convert, *args))
+                for att_filename, convert, args in conversions
+            ]
+            # wait for every conversion, re-raising the first failure, and collect
+            # the stages measured in the worker processes
+            results = []
+            for att_filename, future in futures:
+                result, stages = future.result()
+                metrics.METRICS.merge(stages)
+                results.append((att_filename, result))
+        else:
+            futures = [
+                (att_filename, executor.submit(convert, *args))
+                for att_filename, convert, args in conversions
+            ]
+            # wait for every conversion, re-raising the first failure
+            results = [
+                (att_filename, future.result()) for att_filename, future in futures
+            ]
+        if image_widths:
+            # GIFs have no variants
+            att_variants.update(
+                (att_filename, variants)
+                for att_filename, variants in results
+                if variants is not None
+            )
+
+        for key, att_filename in new_assets.items():
+            asset_store.record(key, att_filename, att_variants.get(att_filename, []))
+    finally:
+        # give up the claims of the assets that were not recorded
+        for key, stored in stored_assets.items():
+            if stored is None:
+                asset_store.release(key)
+
+    for att_filename in saved_filenames:
+        MANIFEST.add(os.path.join(assets_dir, att_filename), "asset")
+        for variant_filename, _, _ in att_variants.get(att_filename, []):
+            MANIFEST.add(os.path.join(assets_dir, variant_filename), "asset")
+
+    # update the cid src to the URL of the attachment file
+    if asset_url is None:
+        asset_url = partial(jekyll_asset_url, assets_dir)
+    urls = {}
+    pictures = {}
+    videos = set()
+    for cid, att_filename in att_filenames.items():
+        urls[cid] = asset_url(att_filename)
+        extension = os.path.splitext(att_filename)[1][1:]
+        if cid in gif_cids and extension in VIDEO_CODECS:
+            videos.add(cid)
+        variants = att_variants.get(att_filename)
+        if variants:
+            srcsets = {}
+            for variant_filename, width, mime_type in variants:
+                srcsets.setdefault(mime_type, []).append(
+                    f"{asset_url(variant_filename)} {width}w"
+                )
+            pictures[cid] = {
+                mime_type: ", ".join(srcset) for mime_type, srcset in srcsets.items()
+            }
+    return _rewrite_cids(content, urls, pictures, videos)
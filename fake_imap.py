@@ -0,0 +1,193 @@
+"""
+A minimal in-process IMAP server standing in for a real one in tests and
+benchmarks. It serves one folder over plain TCP and implements just the
+commands mail2blog uses: CAPABILITY, LOGIN, SELECT, STATUS, UID SEARCH,
+UID FETCH, IDLE, NOOP and LOGOUT.
+"""
+
+import re
+import socket
+import threading
+import socketserver
+
+
+class FakeImapServer:
+    """
+    Serves the given raw RFC822 messages, with UIDs starting at 1, to clients
+    logging in with `user` and `password`.
+    """
+
+    def __init__(
+        self, messages=(), user="user", password="pass", uidvalidity=1, idle=True
+    ):
+        self.messages = list(messages)
+        self.user = user
+        self.password = password
+        self.uidvalidity = uidvalidity
+        self.idle = idle
+        self.logins = 0
+        self._lock = threading.Lock()
+        self._handlers = set()
+        self._server = socketserver.ThreadingTCPServer(
+            ("127.0.0.1", 0), _make_handler(self)
+        )
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.drop_connections()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_message(self, raw_message: bytes):
+        """Deliver a message, notifying clients that are idling."""
+        with self._lock:
+            self.messages.append(raw_message)
+            handlers = list(self._handlers)
+        for handler in handlers:
+            handler.notify_exists()
+
+    def drop_connections(self):
+        """Close every client connection, as a server restart would."""
+        with self._lock:
+            handlers = list(self._handlers)
+        for handler in handlers:
+            handler.drop()
+
+
+def _make_handler(server: FakeImapServer):
+    class Handler(socketserver.StreamRequestHandler):
+        def setup(self):
+            super().setup()
+            # answer without waiting for delayed ACKs, as a real server would
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.write_lock = threading.Lock()
+            self.idling = False
+            with server._lock:
+                server._handlers.add(self)
+
+        def finish(self):
+            with server._lock:
+                server._handlers.discard(self)
+            try:
+                super().finish()
+            except OSError:
+                pass
+
+        def send(self, data: bytes):
+            with self.write_lock:
+                self.wfile.write(data)
+                self.wfile.flush()
+
+        def notify_exists(self):
+            if self.idling:
+                try:
+                    self.send(b"* %d EXISTS\r\n" % len(server.messages))
+                except OSError:
+                    # the connection was dropped
+                    pass
+
+        def drop(self):
+            try:
+                self.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+        def handle(self):
+            capabilities = b"IMAP4rev1 IDLE" if server.idle else b"IMAP4rev1"
+            self.send(b"* OK [CAPABILITY " + capabilities + b"] fake IMAP ready\r\n")
+            while True:
+                try:
+                    line = self.rfile.readline()
+                except OSError:
+                    return
+                if not line:
+                    return
+                tag, _, rest = line.rstrip(b"\r\n").partition(b" ")
+                command, _, args = rest.partition(b" ")
+                command = command.upper()
+                if command == b"UID":
+                    uid_command, _, args = args.partition(b" ")
+                    command += b" " + uid_command.upper()
+                if command == b"CAPABILITY":
+                    self.send(b"* CAPABILITY " + capabilities + b"\r\n")
+                elif command == b"LOGIN":
+                    credentials = [arg.strip(b'"') for arg in args.split(b" ")]
+                    if credentials != [server.user.encode(), server.password.encode()]:
+                        self.send(tag + b" NO LOGIN failed\r\n")
+                        continue
+                    server.logins += 1
+                elif command == b"SELECT":
+                    self.send(
+                        b"* %d EXISTS\r\n* OK [UIDVALIDITY %d]\r\n"
+                        % (len(server.messages), server.uidvalidity)
+                    )
+                elif command == b"STATUS":
+                    folder = args.rpartition(b" (")[0]
+                    self.send(
+                        b"* STATUS %s (UIDVALIDITY %d)\r\n"
+                        % (folder, server.uidvalidity)
+                    )
+                elif command == b"UID SEARCH":
+                    uids = self._search(args)
+                    self.send(b"* SEARCH " + b" ".join(b"%d" % uid for uid in uids))
+                    self.send(b"\r\n")
+                elif command == b"UID FETCH":
+                    self._fetch(args)
+                elif command == b"IDLE":
+                    self.idling = True
+                    self.send(b"+ idling\r\n")
+                    done = self.rfile.readline()
+                    self.idling = False
+                    if not done:
+                        return
+                elif command == b"LOGOUT":
+                    self.send(b"* BYE logging out\r\n" + tag + b" OK LOGOUT done\r\n")
+                    return
+                elif command != b"NOOP":
+                    self.send(tag + b" BAD unknown command\r\n")
+                    continue
+                self.send(tag + b" OK " + command + b" done\r\n")
+
+        def _search(self, args: bytes):
+            uids = list(range(1, len(server.messages) + 1))
+            match = re.search(rb"UID (\d+):(\d+|\*)", args)
+            if not match or not uids:
+                return uids
+            first = int(match.group(1))
+            if match.group(2) == b"*":
+                # "n:*" always matches the message with the highest UID
+                return [uid for uid in uids if uid >= first] or [uids[-1]]
+            return [uid for uid in uids if first <= uid <= int(match.group(2))]
+
+        def _fetch(self, args: bytes):
+            uid_set, _, parts = args.partition(b" ")
+            headers_only = b"HEADER" in parts
+            for uid in _parse_uid_set(uid_set):
+                if not 1 <= uid <= len(server.messages):
+                    continue
+                raw_message = server.messages[uid - 1]
+                section = b"BODY[HEADER]" if headers_only else b"BODY[]"
+                data = raw_message
+                if headers_only:
+                    data = raw_message.split(b"\r\n\r\n", 1)[0] + b"\r\n\r\n"
+                self.send(
+                    b"* %d FETCH (UID %d FLAGS () RFC822.SIZE %d %s {%d}\r\n"
+                    % (uid, uid, len(raw_message), section, len(data))
+                    + data
+                    + b")\r\n"
+                )
+
+    return Handler
+
+
+def _parse_uid_set(uid_set: bytes) -> list[int]:
+    uids = []
+    for item in uid_set.split(b","):
+        first, _, last = item.partition(b":")
+        uids.extend(range(int(first), int(last or first) + 1))
+    return uids
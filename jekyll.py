@@ -2,7 +2,12 @@
 
 import os
 import re
+import json
 import datetime
+import threading
+from typing import Optional
+
+import metrics
 
 
 def _slugify(title: str) -> str:
@@ -11,6 +16,49 @@ def _slugify(title: str) -> str:
     return slug
 
 
+class PostIndex:
+    """
+    Filenames in a posts directory, listed once with os.scandir so that name
+    collisions are checked in memory rather than on the disk.
+    """
+
+    # the index of each directory used by the process
+    _indexes = {}
+    _indexes_lock = threading.Lock()
+
+    def __init__(self, directory: str):
+        try:
+            with os.scandir(directory) as entries:
+                self.filenames = {entry.name for entry in entries}
+        except FileNotFoundError:
+            self.filenames = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_directory(cls, directory: str) -> "PostIndex":
+        """The index of a directory, listed when first used by the process."""
+        directory = os.path.abspath(directory)
+        with cls._indexes_lock:
+            if directory not in cls._indexes:
+                cls._indexes[directory] = cls(directory)
+            return cls._indexes[directory]
+
+    def claim(self, filename: str) -> str:
+        """
+        Reserve filename, or if it is taken the first free one with a -2, -3,
+        ... suffix, so that same-titled posts of a day never overwrite each other.
+        """
+        stem, extension = os.path.splitext(filename)
+        with self._lock:
+            candidate = filename
+            suffix = 1
+            while candidate in self.filenames:
+                suffix += 1
+                candidate = f"{stem}-{suffix}{extension}"
+            self.filenames.add(candidate)
+            return candidate
+
+
 class JekyllPost:
     """JekyllPost with YAML front matter for Jekyll blog posts."""
 
@@ -23,6 +71,7 @@ class JekyllPost:
         categories=None,
         tags=None,
         content="",
+        message_id=None,
     ):
         self.title = title or "Untitled"
         self.author = author or "Unknown"
@@ -31,6 +80,11 @@ class JekyllPost:
         self.categories = categories if categories is not None else []
         self.tags = tags if tags is not None else []
         self.content = content
+        # the email the post was made from, recorded so posts can be reconciled
+        # with the post history
+        self.message_id = message_id
+        # the filename claimed for the post when it is saved
+        self.filename = None
 
     def _generate_filename(self):
         """Generate a filename in the format YYYY-MM-DD-title.md."""
@@ -51,6 +105,8 @@ class JekyllPost:
             fm.append(f"categories: [{', '.join(self.categories)}]")
         if self.tags:
             fm.append(f"tags: [{', '.join(self.tags)}]")
+        if self.message_id:
+            fm.append(f"message_id: {json.dumps(self.message_id)}")
         fm.append("---\n")
         return "\n".join(fm)
 
@@ -58,12 +114,54 @@ class JekyllPost:
         """Combine the front matter and content."""
         return self._generate_front_matter() + self.content
 
-    def save(self, directory="."):
-        """Save the post to the given directory."""
-        filename = self._generate_filename()
+    def save(self, directory=".", index: Optional[PostIndex] = None):
+        """
+        Save the post to the given directory under a filename no other file
+        there has, going by index, by default the directory's PostIndex.
+        """
         # Expand the "~" to an absolute path.
         directory = os.path.expanduser(directory)
+        index = index or PostIndex.for_directory(directory)
+        filename = self.filename = index.claim(self._generate_filename())
         filepath = os.path.join(directory, filename)
-        with open(filepath, "w", encoding="utf-8") as f:
-            f.write(self.generate_post())
+        with metrics.stage("render") as measurement:
+            post = self.generate_post()
+            measurement.bytes = len(post.encode("utf-8"))
+        with metrics.stage("write", measurement.bytes):
+            # write a hidden temporary file and rename it into place, so the
+            # site generator never sees a partial post
+            tmp_path = os.path.join(directory, f".{filename}.{os.getpid()}.tmp")
+            tmp_file = open(tmp_path, "x", encoding="utf-8")
+            try:
+                with tmp_file:
+                    tmp_file.write(post)
+                os.replace(tmp_path, filepath)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
         return filepath
+
+
+def read_message_id(filepath: str) -> Optional[str]:
+    """
+    Read the message_id from the YAML front matter of a saved post, or from
+    the metadata lines of a Pelican post, if it has one.
+    """
+    with open(filepath, "r", encoding="utf-8") as f:
+        line = f.readline().rstrip("\n")
+        if line.startswith("Title: "):
+            # Pelican metadata ends at the first blank line
+            while line:
+                if line.startswith("message_id: "):
+                    return line[len("message_id: ") :]
+                line = f.readline().rstrip("\n")
+            return None
+        if line != "---":
+            return None
+        for line in f:
+            line = line.rstrip("\n")
+            if line == "---":
+                break
+            if line.startswith("message_id: "):
+                return json.loads(line[len("message_id: ") :])
+    return None
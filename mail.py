@@ -1,37 +1,374 @@
 """Module to interact with the mailbox."""
 
 import os
+import json
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-from typing import Optional
+from typing import Callable, Iterator, Optional
 
-from imap_tools import MailBox, MailAttachment
+from imap_tools import AND, U, MailBox, MailBoxUnencrypted, MailAttachment
 from imap_tools.message import MailMessage
 
+import metrics
 
-def read_mail() -> (
-    list[tuple[Optional[MailMessage], Optional[dict[str, MailAttachment]]]]
-):
-    """Reads latest emails from the mailbox configured by environment variables."""
-    mailbox = MailBox(
-        os.environ.get("M2B_IMAP_HOST", "localhost"),
-        os.environ.get("M2B_IMAP_PORT", "993"),
-    ).login(
-        os.environ.get("M2B_MAILBOX_USER", ""), os.environ.get("M2B_MAILBOX_PASS", "")
+logger = logging.getLogger("mail2blog")
+
+
+class SyncState:
+    """
+    Tracks the highest processed UID of each mailbox folder, keyed by the
+    folder's MailboxConfig.sync_key.
+
+    The UIDs of messages handed out for processing are pending until they are
+    reported processed, and the recorded UID never passes a pending one. Once
+    a folder is done, the UIDs still pending are recorded as failed and the
+    recorded UID moves past them; failed messages are fetched again on the
+    following runs, up to `M2B_MAX_ATTEMPTS` attempts in all.
+    """
+
+    M2B_SYNC_STATE_FILEPATH = "./.mail_sync_state.json"
+
+    def __init__(self):
+        # read sync state from json file
+        if os.path.exists(self.M2B_SYNC_STATE_FILEPATH):
+            with open(self.M2B_SYNC_STATE_FILEPATH, "r", encoding="utf-8") as f:
+                self.state = json.load(f)
+        else:
+            self.state = {}
+        # serialises updates from mailboxes read concurrently
+        self._lock = threading.Lock()
+        # the [uidvalidity, pending UIDs, highest UID read] of each folder
+        self._progress = {}
+
+    def last_uid(self, sync_key: str, uidvalidity: int) -> int:
+        """
+        Return the last processed UID of the folder, or 0 if the folder has not
+        been synced yet or its UIDVALIDITY changed since the last sync.
+        """
+        folder_state = self.state.get(sync_key)
+        if not folder_state or folder_state["uidvalidity"] != uidvalidity:
+            return 0
+        return folder_state["last_uid"]
+
+    def record_uid(self, sync_key: str, uidvalidity: int, uid: int):
+        """Record the last processed UID of the folder."""
+        with self._lock:
+            self._record_uid(sync_key, uidvalidity, uid)
+
+    def _record_uid(self, sync_key: str, uidvalidity: int, uid: int):
+        folder_state = {"uidvalidity": uidvalidity, "last_uid": uid}
+        failed = self._failed(sync_key, uidvalidity)
+        if failed:
+            folder_state["failed"] = failed
+        self.state[sync_key] = folder_state
+        self._save()
+
+    def _save(self):
+        """Atomically replace the sync state file with the current state."""
+        tmp_path = f"{self.M2B_SYNC_STATE_FILEPATH}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, indent=4)
+        os.replace(tmp_path, self.M2B_SYNC_STATE_FILEPATH)
+
+    def _failed(self, sync_key: str, uidvalidity: int) -> dict:
+        """Return the attempts of each failed UID of the folder, by UID string."""
+        folder_state = self.state.get(sync_key)
+        if not folder_state or folder_state["uidvalidity"] != uidvalidity:
+            return {}
+        return folder_state.get("failed", {})
+
+    def failed_uids(self, sync_key: str, uidvalidity: int) -> list[int]:
+        """Return the UIDs of the folder's failed messages to fetch again."""
+        return sorted(int(uid) for uid in self._failed(sync_key, uidvalidity))
+
+    def _folder_progress(self, sync_key: str, uidvalidity: int) -> list:
+        progress = self._progress.get(sync_key)
+        if progress is None or progress[0] != uidvalidity:
+            progress = self._progress[sync_key] = [uidvalidity, set(), 0]
+        return progress
+
+    def _advance(self, sync_key: str):
+        """Record the highest UID read below every pending one."""
+        uidvalidity, pending, highest = self._progress[sync_key]
+        uid = min(pending) - 1 if pending else highest
+        folder_state = self.state.get(sync_key)
+        if (
+            not folder_state
+            or folder_state["uidvalidity"] != uidvalidity
+            or folder_state["last_uid"] < uid
+        ):
+            self._record_uid(sync_key, uidvalidity, uid)
+
+    def pending(self, sync_key: str, uidvalidity: int, uid: int):
+        """Hold back the recorded UID of the folder until uid is processed."""
+        with self._lock:
+            progress = self._folder_progress(sync_key, uidvalidity)
+            progress[1].add(uid)
+            progress[2] = max(progress[2], uid)
+
+    def read_up_to(self, sync_key: str, uidvalidity: int, uid: int):
+        """
+        Record that every message of the folder up to uid was read, recording
+        it as processed unless a message before it is still pending.
+        """
+        with self._lock:
+            progress = self._folder_progress(sync_key, uidvalidity)
+            progress[2] = max(progress[2], uid)
+            self._advance(sync_key)
+
+    def processed(self, sync_key: str, uid):
+        """Record that the message with uid was processed, posted or not."""
+        with self._lock:
+            folder_state = self.state.get(sync_key)
+            if folder_state and folder_state.get("failed", {}).pop(str(uid), None):
+                self._save()
+            progress = self._progress.get(sync_key)
+            if progress is None or int(uid) not in progress[1]:
+                return
+            progress[1].discard(int(uid))
+            self._advance(sync_key)
+
+    def finish(self, sync_key: str):
+        """
+        Record the messages of the folder still pending as failed, so they no
+        longer hold back its recorded UID, and give up on those that failed
+        `M2B_MAX_ATTEMPTS` times.
+        """
+        max_attempts = int(os.environ.get("M2B_MAX_ATTEMPTS", "3"))
+        with self._lock:
+            progress = self._progress.pop(sync_key, None)
+            if progress is None:
+                return
+            uidvalidity, pending, highest = progress
+            failed = dict(self._failed(sync_key, uidvalidity))
+            for uid in sorted(pending):
+                attempts = failed.pop(str(uid), 0) + 1
+                if attempts < max_attempts:
+                    failed[str(uid)] = attempts
+                else:
+                    logger.error(
+                        f"Giving up on message UID {uid} of {sync_key} "
+                        f"after {attempts} failed attempts"
+                    )
+            folder_state = self.state.get(sync_key)
+            if folder_state and folder_state["uidvalidity"] == uidvalidity:
+                highest = max(highest, folder_state["last_uid"])
+            self.state[sync_key] = {"uidvalidity": uidvalidity, "last_uid": highest}
+            if failed:
+                self.state[sync_key]["failed"] = failed
+            self._save()
+
+
+class MailboxConfig:
+    """
+    A mailbox folder to read posts from and the blog directories they go to,
+    built by the given site generator. Posts can instead go to several
+    `sites`, given as dicts of the generator, post_dir and assets_dir of each.
+    """
+
+    def __init__(
+        self,
+        host="localhost",
+        port="993",
+        user="",
+        password="",
+        folder="Blog",
+        post_dir=None,
+        assets_dir=None,
+        ssl=True,
+        generator="jekyll",
+        sites=None,
+    ):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.folder = folder
+        self.post_dir = post_dir
+        self.assets_dir = assets_dir
+        self.ssl = ssl
+        self.generator = generator
+        self.sites = sites
+
+    @classmethod
+    def from_env(cls) -> "MailboxConfig":
+        """Build the config of the mailbox set by environment variables."""
+        sites = None
+        sites_config = os.environ.get("M2B_BLOG_SITES_CONFIG", None)
+        if sites_config:
+            with open(sites_config, "r", encoding="utf-8") as f:
+                sites = json.load(f)
+        return cls(
+            host=os.environ.get("M2B_IMAP_HOST", "localhost"),
+            port=os.environ.get("M2B_IMAP_PORT", "993"),
+            user=os.environ.get("M2B_MAILBOX_USER", ""),
+            password=os.environ.get("M2B_MAILBOX_PASS", ""),
+            folder=os.environ.get("M2B_MAILBOX_FOLDER", "Blog"),
+            post_dir=os.environ.get("M2B_BLOG_POST_DIR", None),
+            assets_dir=os.environ.get("M2B_BLOG_ASSETS_DIR", None),
+            ssl=os.environ.get("M2B_IMAP_SSL", "1") != "0",
+            generator=os.environ.get("M2B_BLOG_GENERATOR", "jekyll"),
+            sites=sites,
+        )
+
+    @property
+    def sync_key(self) -> str:
+        """Identifies the folder in the sync state."""
+        return f"{self.user}@{self.host}:{self.port}/{self.folder}"
+
+
+def load_mailbox_configs(path: str) -> list[MailboxConfig]:
+    """
+    Read mailbox configs from a JSON file holding a list of objects with the
+    keyword arguments of MailboxConfig.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return [MailboxConfig(**config) for config in json.load(f)]
+
+
+def _message_id(mail: MailMessage) -> Optional[str]:
+    """Return the Message-ID header of a message, if it has one."""
+    message_ids = mail.headers.get("message-id")
+    return message_ids[0] if message_ids else None
+
+
+@contextmanager
+def mailbox_session(config: MailboxConfig) -> Iterator[MailBox]:
+    """
+    Logs in to the mailbox, selects the folder and logs out once the block
+    is done.
+    """
+    mailbox_class = MailBox if config.ssl else MailBoxUnencrypted
+    mailbox = mailbox_class(config.host, config.port).login(
+        config.user, config.password
     )
+    try:
+        mailbox.folder.set(config.folder)
+        yield mailbox
+    finally:
+        mailbox.logout()
+
 
-    mailbox.folder.set(os.environ.get("M2B_MAILBOX_FOLDER", "Blog"))
+def read_mail(
+    previously_posted: Optional[Callable[[str], bool]] = None,
+    config: Optional[MailboxConfig] = None,
+    sync_state: Optional[SyncState] = None,
+) -> Iterator[tuple[MailMessage, dict[str, MailAttachment]]]:
+    """
+    Logs in to the mailbox, by default the one configured by environment
+    variables, and yields its new emails as read by read_new_mail.
+    """
+    config = config or MailboxConfig.from_env()
+    with mailbox_session(config) as mailbox:
+        yield from read_new_mail(
+            mailbox, config, sync_state or SyncState(), previously_posted
+        )
 
-    # NOTE: tune program invocation frequency against post limit
-    FETCH_POST_LIMIT = 10
-    mails = list(mailbox.fetch(limit=FETCH_POST_LIMIT, reverse=True))
 
-    ret_mails = []
-    for mail in mails:
-        cid_to_att = {}
+def read_new_mail(
+    mailbox: MailBox,
+    config: MailboxConfig,
+    sync_state: SyncState,
+    previously_posted: Optional[Callable[[str], bool]] = None,
+) -> Iterator[tuple[MailMessage, dict[str, MailAttachment]]]:
+    """
+    Yields the new emails of a mailbox session.
 
-        for att in mail.attachments:
-            cid_to_att[att.content_id] = att
+    Only messages with a UID above the last one processed in the folder, and
+    the messages that failed before, are read, oldest first and in batches of `M2B_FETCH_BATCH_SIZE`. Each batch is
+    fetched in two phases: first only the headers, then the full bodies of
+    the messages whose Message-ID is not reported as already posted by
+    `previously_posted`. Full messages are fetched and yielded one at a time,
+    and the caller reports each one processed with `sync_state.processed`
+    once its post is saved. Until then, its UID is not recorded; the caller
+    calls `sync_state.finish` once done, which records the messages it did not
+    report processed as failed, to be read again on the next runs.
+    """
+    # a changed UIDVALIDITY invalidates the recorded UID and forces a full rescan
+    status = mailbox.folder.status(config.folder, ["UIDVALIDITY"])
+    uidvalidity = status["UIDVALIDITY"]
+    last_uid = sync_state.last_uid(config.sync_key, uidvalidity)
+
+    # "n:*" always matches the newest message, even if its UID is below n
+    uids = {
+        int(uid)
+        for uid in mailbox.uids(AND(uid=U(last_uid + 1, "*")))
+        if int(uid) > last_uid
+    }
+    retried_uids = set(sync_state.failed_uids(config.sync_key, uidvalidity))
+    uids = sorted(uids | retried_uids)
+
+    batch_size = int(os.environ.get("M2B_FETCH_BATCH_SIZE", "50"))
+    for start in range(0, len(uids), batch_size):
+        batch = [str(uid) for uid in uids[start : start + batch_size]]
+        headers = metrics.METRICS.iterate(
+            "fetch_headers",
+            mailbox.fetch(
+                uid_list=batch, headers_only=True, mark_seen=False, bulk=True
+            ),
+        )
+        new_uids = []
+        # failed messages that were deleted or posted since are not retried
+        done_uids = retried_uids.intersection(int(uid) for uid in batch)
+        for header in headers:
+            message_id = _message_id(header)
+            if previously_posted and message_id and previously_posted(message_id):
+                continue
+            done_uids.discard(int(header.uid))
+            new_uids.append(header.uid)
+        for uid in done_uids:
+            sync_state.processed(config.sync_key, uid)
+
+        # without bulk, imap_tools fetches one message per command
+        mails = mailbox.fetch(uid_list=new_uids) if new_uids else []
+        mails = metrics.METRICS.iterate(
+            "fetch", mails, size=lambda mail: mail.size_rfc822
+        )
+        for mail in mails:
+            cid_to_att = {}
+
+            for att in mail.attachments:
+                cid_to_att[att.content_id] = att
+
+            sync_state.pending(config.sync_key, uidvalidity, int(mail.uid))
+            yield mail, cid_to_att
+
+            # drop the payloads before fetching the next message
+            del mail, cid_to_att
+
+        sync_state.read_up_to(config.sync_key, uidvalidity, int(batch[-1]))
+
+
+async def poll_mailboxes(
+    configs: list[MailboxConfig],
+    process_mailbox: Callable[[MailboxConfig], None],
+    max_connections_per_host: int = 2,
+):
+    """
+    Run the blocking `process_mailbox` for each mailbox config concurrently,
+    each in its own worker thread, while keeping at most
+    `max_connections_per_host` connections open to the same IMAP host.
+    An error in one mailbox is logged without affecting the others.
+    """
+    loop = asyncio.get_running_loop()
+    host_semaphores = {}
 
-        ret_mails.append((mail, cid_to_att))
+    async def poll(config, executor):
+        semaphore = host_semaphores.setdefault(
+            config.host, asyncio.Semaphore(max_connections_per_host)
+        )
+        async with semaphore:
+            try:
+                await loop.run_in_executor(executor, process_mailbox, config)
+            except Exception as e:
+                logger.error(
+                    f"Error reading mailbox {config.sync_key}: {str(e)}",
+                    exc_info=True,
+                )
 
-    return ret_mails
+    with ThreadPoolExecutor(max_workers=max(len(configs), 1)) as executor:
+        await asyncio.gather(*(poll(config, executor) for config in configs))
@@ -2,10 +2,28 @@
 
 import os
 import json
+import argparse
+import asyncio
 import logging
-from jekyll import JekyllPost
+import shutil
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing, nullcontext
+from functools import partial
+from typing import Optional
+from PIL import features
+from jekyll import read_message_id
+from assets import AssetStore
+from policy import AttachmentPolicy
 import mail
+import archive
+import backends
 import converter
+import manifest
+import metrics
+import pipeline
 
 # Configure logger
 logging.basicConfig(
@@ -17,15 +35,98 @@ logger = logging.getLogger("mail2blog")
 
 
 class PostManager:
-    M2B_POST_HISTORY_FILEPATH = "./.post_history.json"
+    """
+    Post history kept as an append-only JSON Lines journal, with one
+    {"message_id", "filepath"} record per post.
 
-    def __init__(self):
-        # read post history from json file
-        if os.path.exists(self.M2B_POST_HISTORY_FILEPATH):
-            with open(self.M2B_POST_HISTORY_FILEPATH, "r", encoding="utf-8") as f:
-                self.post_history = json.load(f)
-        else:
-            self.post_history = {}
+    With a batch_size above 1, records are buffered and committed to the
+    journal together once batch_size of them are pending, or once
+    batch_seconds have passed since the last commit, and on close(). A
+    marker file flags a batched run in progress, so that after a crash the
+    next run can reconcile() the posts saved but never committed.
+    """
+
+    M2B_POST_HISTORY_FILEPATH = "./.post_history.jsonl"
+    # post history written by earlier versions, migrated on first use
+    M2B_LEGACY_POST_HISTORY_FILEPATH = "./.post_history.json"
+    # compact the journal once it holds this many records per post
+    COMPACTION_RATIO = 2
+
+    def __init__(self, batch_size: int = 1, batch_seconds: Optional[float] = None):
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        # the post history is only read when first needed
+        self._post_history = None
+        # serialises loading and recording across pipeline threads
+        self._lock = threading.RLock()
+        # journal records not committed yet
+        self._pending = []
+        self._last_commit = time.monotonic()
+        # whether the last batched run ended without committing its records
+        self._recovering = False
+        self._reconciled_dirs = set()
+
+    @property
+    def _marker_path(self) -> str:
+        return self.M2B_POST_HISTORY_FILEPATH + ".pending"
+
+    @property
+    def post_history(self) -> dict:
+        """The filepath of the post of each recorded message_id."""
+        with self._lock:
+            if self._post_history is None:
+                self._post_history = self._load()
+                self._recovering = os.path.exists(self._marker_path)
+                if self.batch_size > 1:
+                    open(self._marker_path, "w").close()
+            return self._post_history
+
+    def _load(self) -> dict:
+        """Read the journal, migrating a legacy JSON post history if needed."""
+        post_history = {}
+        if not os.path.exists(self.M2B_POST_HISTORY_FILEPATH):
+            if os.path.exists(self.M2B_LEGACY_POST_HISTORY_FILEPATH):
+                with open(
+                    self.M2B_LEGACY_POST_HISTORY_FILEPATH, "r", encoding="utf-8"
+                ) as f:
+                    post_history = json.load(f)
+                self._rewrite_journal(post_history)
+            return post_history
+
+        records = 0
+        valid_size = 0
+        with open(self.M2B_POST_HISTORY_FILEPATH, "rb") as f:
+            for line in f:
+                # a record without a newline was cut short by a crash
+                if not line.endswith(b"\n"):
+                    break
+                record = json.loads(line)
+                post_history[record["message_id"]] = record["filepath"]
+                records += 1
+                valid_size += len(line)
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+        if valid_size < size:
+            logger.warning("Dropping incomplete record at the end of the post history")
+            with open(self.M2B_POST_HISTORY_FILEPATH, "r+b") as f:
+                f.truncate(valid_size)
+        if records > self.COMPACTION_RATIO * len(post_history):
+            self._rewrite_journal(post_history)
+        return post_history
+
+    def _rewrite_journal(self, post_history: dict):
+        """Atomically replace the journal with one record per post."""
+        tmp_path = self.M2B_POST_HISTORY_FILEPATH + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for message_id, filepath in post_history.items():
+                f.write(self._journal_record(message_id, filepath))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.M2B_POST_HISTORY_FILEPATH)
+
+    @staticmethod
+    def _journal_record(message_id: str, filepath: str) -> str:
+        return json.dumps({"message_id": message_id, "filepath": filepath}) + "\n"
 
     def previously_posted(self, message_id: str) -> bool:
         """
@@ -37,45 +138,448 @@ class PostManager:
         """
         Record the message_id and the filepath of the saved post in the post history.
         """
-        self.post_history[message_id] = filepath
-        # save the updated post history to the file
-        with open(self.M2B_POST_HISTORY_FILEPATH, "w", encoding="utf-8") as f:
-            json.dump(self.post_history, f, indent=4)
+        with self._lock, metrics.stage("history") as measurement:
+            self.post_history[message_id] = filepath
+            self._pending.append(self._journal_record(message_id, filepath))
+            measurement.bytes = len(self._pending[-1])
+            if len(self._pending) >= self.batch_size or (
+                self.batch_seconds is not None
+                and time.monotonic() - self._last_commit >= self.batch_seconds
+            ):
+                self.commit()
+
+    def commit(self):
+        """Append the pending records to the journal and make sure they reached the disk."""
+        with self._lock:
+            if self._pending:
+                with open(self.M2B_POST_HISTORY_FILEPATH, "a", encoding="utf-8") as f:
+                    f.write("".join(self._pending))
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._pending = []
+            self._last_commit = time.monotonic()
+
+    def close(self):
+        """Commit the pending records, ending a batched run."""
+        with self._lock:
+            self.commit()
+            if self._post_history is not None and os.path.exists(self._marker_path):
+                os.remove(self._marker_path)
+
+    def reconcile(self, post_dir: str) -> int:
+        """
+        If the last batched run crashed, record the posts in post_dir whose
+        message_id is missing from the post history, as they were saved but
+        never committed. Returns the number of posts recorded.
+        """
+        post_dir = os.path.expanduser(post_dir)
+        with self._lock:
+            post_history = self.post_history
+            if not self._recovering or post_dir in self._reconciled_dirs:
+                return 0
+            self._reconciled_dirs.add(post_dir)
+            recorded = set(post_history.values())
+            missing = 0
+            with os.scandir(post_dir) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(".md") or entry.path in recorded:
+                        continue
+                    message_id = read_message_id(entry.path)
+                    if message_id and message_id not in post_history:
+                        self.record_posting(message_id, entry.path)
+                        missing += 1
+            self.commit()
+        if missing:
+            logger.warning(
+                f"Recovered {missing} posts missing from the post history in {post_dir}"
+            )
+        return missing
+
+
+# bounds of the delay before reconnecting to the mailbox in daemon mode, in seconds
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 300
+
+
+def _image_executor():
+    """
+    Create the process pool for image conversion, sized by M2B_IMAGE_WORKERS.
+    With a single worker, images are converted in the main process instead.
+    The workers are not forked from this process, as a fork would copy the
+    locks held by its other threads, such as the metrics lock, held forever.
+    """
+    image_workers = int(os.environ.get("M2B_IMAGE_WORKERS", "1"))
+    if image_workers > 1:
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context("forkserver")
+        else:
+            mp_context = multiprocessing.get_context("spawn")
+        return ProcessPoolExecutor(max_workers=image_workers, mp_context=mp_context)
+    return nullcontext()
+
+
+def _image_options() -> dict:
+    """
+    Read the responsive image options: the variant widths from
+    M2B_IMAGE_WIDTHS and the extra variant formats from M2B_IMAGE_FORMATS,
+    both comma-separated, and the format GIFs are converted to from
+    M2B_GIF_FORMAT. Formats this Pillow build cannot encode are skipped.
+    """
+    widths = os.environ.get("M2B_IMAGE_WIDTHS", "")
+    image_widths = tuple(int(width) for width in widths.split(",") if width.strip())
+    image_formats = []
+    for name in os.environ.get("M2B_IMAGE_FORMATS", "").split(","):
+        name = name.strip().lower()
+        if not name:
+            continue
+        if name not in converter.IMAGE_FORMATS or not features.check(name):
+            logger.warning(f"Skipping unsupported image format: {name}")
+            continue
+        image_formats.append(name)
+    return {
+        "image_widths": image_widths,
+        "image_formats": tuple(image_formats),
+        "gif_format": _gif_format(),
+    }
+
+
+def _gif_format() -> Optional[str]:
+    """
+    Read the format GIFs are converted to from M2B_GIF_FORMAT, or None to
+    keep them as they are. Videos fall back to animated WebP when ffmpeg is
+    not installed, and animated WebP to GIF when Pillow cannot encode it.
+    """
+    name = os.environ.get("M2B_GIF_FORMAT", "").strip().lower()
+    if not name:
+        return None
+    if name not in converter.GIF_FORMATS:
+        logger.warning(f"Keeping GIFs as they are for unsupported format: {name}")
+        return None
+    if name in converter.VIDEO_CODECS and not shutil.which("ffmpeg"):
+        logger.warning(f"ffmpeg not found, converting GIFs to webp rather than {name}")
+        name = "webp"
+    if name == "webp" and not features.check("webp"):
+        logger.warning("Pillow cannot encode WebP, converting GIFs to gif")
+        name = "gif"
+    return name
 
 
 def main():
     """Entry point for the mail2blog script."""
     logger.info("Starting mail2blog process")
-    post_manager = PostManager()
-    for mail_message, attachments_dict in mail.read_mail():
-        try:
-            # Extract details from the email
-            title = mail_message.subject or "Untitled"
-            message_id = mail_message.headers["message-id"][0]
+    post_manager = _post_manager()
+    sync_state = mail.SyncState()
+    try:
+        with _image_executor() as executor, closing(post_manager):
+            convert_options = _convert_options(executor)
+            process_mailbox = partial(
+                _process_mailbox,
+                post_manager=post_manager,
+                sync_state=sync_state,
+                convert_options=convert_options,
+            )
+            mailboxes_config = os.environ.get("M2B_MAILBOXES_CONFIG")
+            if mailboxes_config:
+                # poll every configured mailbox concurrently
+                asyncio.run(
+                    mail.poll_mailboxes(
+                        mail.load_mailbox_configs(mailboxes_config),
+                        process_mailbox,
+                        max_connections_per_host=int(
+                            os.environ.get("M2B_MAX_CONNECTIONS_PER_HOST", "2")
+                        ),
+                    )
+                )
+            else:
+                process_mailbox(mail.MailboxConfig.from_env())
+    finally:
+        # also after a failed run, so that the files it did save are rebuilt
+        metrics.METRICS.write()
+        manifest.MANIFEST.finish()
 
-            if post_manager.previously_posted(message_id):
-                logger.info(
-                    f"Not processing email, already posted: {title} ({message_id})"
+
+def daemon(stop_event: Optional[threading.Event] = None):
+    """
+    Entry point for the long-running mode. Keeps one connection to the
+    mailbox configured by environment variables open and turns new emails
+    into posts as they arrive, waiting for them with IMAP IDLE for up to
+    M2B_IDLE_TIMEOUT seconds at a time, or polling every M2B_POLL_INTERVAL
+    seconds on servers without IDLE. A dropped connection is re-established
+    with exponential backoff. Runs until stop_event is set.
+    """
+    logger.info("Starting mail2blog daemon")
+    stop_event = stop_event or threading.Event()
+    config = mail.MailboxConfig.from_env()
+    idle_timeout = float(os.environ.get("M2B_IDLE_TIMEOUT", "300"))
+    poll_interval = float(os.environ.get("M2B_POLL_INTERVAL", "60"))
+    post_manager = _post_manager()
+    sync_state = mail.SyncState()
+    reconnect_delay = RECONNECT_MIN_DELAY
+    with _image_executor() as executor, closing(post_manager):
+        convert_options = _convert_options(executor)
+        post_manager.reconcile(backends.backends_for(config)[0].post_dir)
+        while not stop_event.is_set():
+            try:
+                with mail.mailbox_session(config) as mailbox:
+                    logger.info(f"Connected to mailbox {config.sync_key}")
+                    reconnect_delay = RECONNECT_MIN_DELAY
+                    supports_idle = "IDLE" in mailbox.client.capabilities
+                    while not stop_event.is_set():
+                        messages = mail.read_new_mail(
+                            mailbox,
+                            config,
+                            sync_state,
+                            previously_posted=post_manager.previously_posted,
+                        )
+                        _process_messages(
+                            messages,
+                            config,
+                            post_manager,
+                            convert_options,
+                            sync_state=sync_state,
+                        )
+                        post_manager.commit()
+                        metrics.METRICS.write()
+                        manifest.MANIFEST.finish()
+                        if supports_idle:
+                            mailbox.idle.wait(timeout=idle_timeout)
+                        else:
+                            stop_event.wait(poll_interval)
+            except Exception as e:
+                logger.error(
+                    f"Mailbox connection failed: {str(e)}, "
+                    f"reconnecting in {reconnect_delay:g}s",
+                    exc_info=True,
                 )
-                continue
-
-            logger.info(f"Processing email: {title} ({message_id})")
-            content = converter.html_to_blog_md(mail_message.html, attachments_dict)
-            author = mail_message.from_values.name
-            date = mail_message.date
-
-            # Create a Jekyll post
-            post = JekyllPost(title=title, author=author, date=date, content=content)
-
-            # Save the post to the blog directory and record that it's been posted
-            post_dir = os.environ.get("M2B_BLOG_POST_DIR")
-            logger.info(f"Saving post '{title}' to {post_dir}")
-            post_filepath = post.save(directory=post_dir)
-            post_manager.record_posting(message_id, post_filepath)
-            logger.info(f"Successfully processed email: {title}")
+                stop_event.wait(reconnect_delay)
+                reconnect_delay = min(reconnect_delay * 2, RECONNECT_MAX_DELAY)
+
+
+def import_archive(path: str):
+    """
+    Entry point for importing a local mbox file or Maildir directory. Turns
+    its emails into posts like new mail from the mailbox configured by
+    environment variables, in a pipeline with M2B_PIPELINE_WORKERS converting
+    workers, by default one per CPU.
+    """
+    logger.info(f"Importing emails from {path}")
+    config = mail.MailboxConfig.from_env()
+    post_manager = _post_manager()
+    progress = archive.ImportProgress()
+    pipeline_workers = int(
+        os.environ.get("M2B_PIPELINE_WORKERS", str(os.cpu_count() or 1))
+    )
+    try:
+        with _image_executor() as executor, closing(post_manager):
+            convert_options = _convert_options(executor)
+            post_manager.reconcile(backends.backends_for(config)[0].post_dir)
+            _process_messages(
+                archive.read_archive(path, progress),
+                config,
+                post_manager,
+                convert_options,
+                pipeline_workers=pipeline_workers,
+            )
+    finally:
+        progress.log()
+        metrics.METRICS.write()
+        manifest.MANIFEST.finish()
+
+
+def _post_manager() -> PostManager:
+    """
+    Create the post manager, committing the post history in batches of
+    M2B_HISTORY_BATCH_SIZE records or every M2B_HISTORY_BATCH_SECONDS.
+    """
+    batch_seconds = os.environ.get("M2B_HISTORY_BATCH_SECONDS")
+    return PostManager(
+        batch_size=int(os.environ.get("M2B_HISTORY_BATCH_SIZE", "1")),
+        batch_seconds=float(batch_seconds) if batch_seconds else None,
+    )
+
+
+def _convert_options(executor) -> dict:
+    """Build the keyword arguments of converter.html_to_blog_md for a run."""
+    return dict(
+        executor=executor,
+        asset_store=AssetStore(),
+        policy=AttachmentPolicy.from_env(),
+        **_image_options(),
+    )
+
+
+def _process_mailbox(config, post_manager, sync_state, convert_options):
+    """Turn each new email of a mailbox into a post of its blog."""
+    post_manager.reconcile(backends.backends_for(config)[0].post_dir)
+    messages = mail.read_mail(
+        previously_posted=post_manager.previously_posted,
+        config=config,
+        sync_state=sync_state,
+    )
+    _process_messages(
+        messages, config, post_manager, convert_options, sync_state=sync_state
+    )
+
+
+def _process_messages(
+    messages,
+    config,
+    post_manager,
+    convert_options,
+    pipeline_workers=None,
+    sync_state=None,
+):
+    """
+    Turn emails into posts of the sites of their mailbox, in a pipeline with
+    pipeline_workers converting workers, by default M2B_PIPELINE_WORKERS.
+    Each email read from the mailbox is reported processed to sync_state
+    once its post is saved, or found to be posted before, and the emails left
+    unprocessed are recorded as failed at the end.
+    """
+    sites = backends.backends_for(config)
+    if sync_state is not None:
+        on_processed = partial(sync_state.processed, config.sync_key)
+    else:
+        on_processed = _ignore_processed
+    # convert once for the first site, each site then linking to its own URLs
+    convert_options = dict(
+        convert_options,
+        assets_dir=sites[0].assets_dir,
+        asset_url=backends.asset_placeholder,
+    )
+    if pipeline_workers is None:
+        pipeline_workers = int(os.environ.get("M2B_PIPELINE_WORKERS", "0"))
+    try:
+        if pipeline_workers > 0:
+            stats = pipeline.run_pipeline(
+                messages,
+                convert=partial(
+                    _convert_message,
+                    post_manager=post_manager,
+                    convert_options=convert_options,
+                    sites=sites,
+                    on_processed=on_processed,
+                ),
+                save=partial(
+                    _save_post,
+                    post_manager=post_manager,
+                    sites=sites,
+                    on_processed=on_processed,
+                ),
+                workers=pipeline_workers,
+                queue_size=2 * pipeline_workers,
+            )
+            for stage_stats in stats.values():
+                logger.info(f"Pipeline stage {stage_stats}")
+        else:
+            _process_mail(messages, post_manager, convert_options, sites, on_processed)
+    finally:
+        if sync_state is not None:
+            sync_state.finish(config.sync_key)
+
+
+def _ignore_processed(uid):
+    """Report an email processed when no sync state tracks it."""
+
+
+def _process_mail(messages, post_manager, convert_options, sites, on_processed):
+    """Turn each new email into a post, one after another."""
+    for message in messages:
+        try:
+            converted = _convert_message(
+                message, post_manager, convert_options, sites, on_processed
+            )
+            if converted is not None:
+                _save_post(converted, post_manager, sites, on_processed)
         except Exception as e:
             logger.error(f"Error processing email: {str(e)}", exc_info=True)
 
 
+def _convert_message(message, post_manager, convert_options, sites, on_processed):
+    """
+    Convert an email into a post for each site, returning its message_id, the
+    posts and its UID, or None if it was posted before.
+    """
+    mail_message, attachments_dict = message
+    # Extract details from the email
+    title = mail_message.subject or "Untitled"
+    message_id = mail_message.headers["message-id"][0]
+
+    if post_manager.previously_posted(message_id):
+        logger.info(f"Not processing email, already posted: {title} ({message_id})")
+        on_processed(mail_message.uid)
+        return None
+
+    logger.info(f"Processing email: {title} ({message_id})")
+    content = converter.html_to_blog_md(
+        mail_message.html, attachments_dict, text=mail_message.text, **convert_options
+    )
+    author = mail_message.from_values.name
+    date = mail_message.date
+
+    # the other sites share the assets converted for the first
+    filenames = backends.referenced_assets(content)
+    for site in sites[1:]:
+        site.import_assets(filenames, sites[0].assets_dir)
+    posts = [
+        site.post(
+            title=title,
+            author=author,
+            date=date,
+            content=content,
+            message_id=message_id,
+        )
+        for site in sites
+    ]
+    return message_id, posts, mail_message.uid
+
+
+def _save_post(converted, post_manager, sites, on_processed):
+    """
+    Save the converted posts to the post directory of each site and record
+    that the email has been posted, with the post of the first site.
+    """
+    message_id, posts, uid = converted
+    # emails with the same Message-ID may have been converted concurrently
+    if post_manager.previously_posted(message_id):
+        logger.info(f"Not saving post, already posted: {posts[0].title} ({message_id})")
+        on_processed(uid)
+        return
+    post_filepaths = []
+    for site, post in zip(sites, posts):
+        logger.info(f"Saving post '{post.title}' to {site.post_dir}")
+        post_filepaths.append(site.save(post))
+    post_manager.record_posting(message_id, post_filepaths[0])
+    on_processed(uid)
+    logger.info(f"Successfully processed email: {posts[0].title}")
+
+
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Publish blog posts from email.")
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running and publish new emails as soon as they arrive",
+    )
+    parser.add_argument(
+        "--import",
+        dest="archive",
+        metavar="ARCHIVE",
+        help="import the emails of a local mbox file or Maildir directory",
+    )
+    parser.add_argument(
+        "--profile", metavar="FILE", help="save cProfile stats of the run to FILE"
+    )
+    parser.add_argument(
+        "--tracemalloc",
+        metavar="FILE",
+        help="save the lines allocating the most memory during the run to FILE",
+    )
+    args = parser.parse_args()
+    with metrics.capture(args.profile, args.tracemalloc):
+        if args.archive:
+            import_archive(args.archive)
+        elif args.daemon:
+            daemon()
+        else:
+            main()
@@ -0,0 +1,95 @@
+"""Module to list the files a run created or modified and trigger a site rebuild."""
+
+import os
+import json
+import hashlib
+import logging
+import datetime
+import threading
+import subprocess
+
+logger = logging.getLogger("mail2blog")
+
+
+def _file_digest(path: str) -> str:
+    """The SHA-256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    The post and asset files created or modified since the manifest was last
+    finished, across threads.
+    """
+
+    def __init__(self):
+        # the kind, "post" or "asset", of each file
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def add(self, path: str, kind: str):
+        with self._lock:
+            self.files[path] = kind
+
+    def reset(self):
+        with self._lock:
+            self.files = {}
+
+    @staticmethod
+    def entries(files: dict) -> list[dict]:
+        """The path, kind, SHA-256 and size of each of files that still exists."""
+        entries = []
+        for path, kind in sorted(files.items()):
+            try:
+                entries.append(
+                    {
+                        "path": path,
+                        "kind": kind,
+                        "sha256": _file_digest(path),
+                        "size": os.path.getsize(path),
+                    }
+                )
+            except FileNotFoundError:
+                logger.warning(f"Leaving removed file out of the manifest: {path}")
+        return entries
+
+    def finish(self):
+        """
+        End a run: replace the JSON file named by M2B_MANIFEST_PATH with the
+        files of the run, then, if there are any, run the shell command of
+        M2B_REBUILD_COMMAND to rebuild the site, with M2B_MANIFEST_PATH in its
+        environment. Runs that changed no files trigger no rebuild.
+        """
+        with self._lock:
+            files, self.files = self.files, {}
+        manifest_path = os.environ.get("M2B_MANIFEST_PATH")
+        if manifest_path:
+            self.write(manifest_path, self.entries(files))
+        rebuild_command = os.environ.get("M2B_REBUILD_COMMAND")
+        if not files or not rebuild_command:
+            return
+        logger.info(f"Rebuilding the site for {len(files)} changed files")
+        result = subprocess.run(rebuild_command, shell=True)
+        if result.returncode != 0:
+            logger.error(f"Rebuild command failed with exit status {result.returncode}")
+
+    @staticmethod
+    def write(path: str, entries: list[dict]):
+        """Replace the manifest file, so the rebuild never reads a partial file."""
+        manifest = {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "files": entries,
+        }
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+            f.write("\n")
+        os.replace(tmp_path, path)
+
+
+# the manifest of the current run
+MANIFEST = Manifest()
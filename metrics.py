@@ -0,0 +1,225 @@
+"""Module to measure the duration, bytes and memory of each stage of a run."""
+
+import os
+import json
+import time
+import logging
+import datetime
+import tempfile
+import threading
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+from typing import Callable, Iterable, Optional
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+logger = logging.getLogger("mail2blog")
+
+
+def _peak_rss() -> int:
+    """The peak resident set size of the process so far, in bytes."""
+    if resource is None:
+        return 0
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Measurement:
+    """The bytes handled by one measured call, which the call may add to."""
+
+    __slots__ = ("bytes",)
+
+    def __init__(self, nbytes: int = 0):
+        self.bytes = nbytes
+
+
+class Metrics:
+    """
+    Totals per stage of the calls, seconds and bytes handled, and of how far
+    the stage raised the peak memory of the process, across threads.
+    """
+
+    FIELDS = ("calls", "seconds", "bytes", "peak_rss_growth_bytes")
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+        # whether anything was measured since the metrics were last written
+        self._changed = False
+
+    @contextmanager
+    def stage(self, name: str, nbytes: int = 0):
+        """
+        Measure a block as one call of a stage that handles nbytes bytes. The
+        yielded Measurement's bytes can be updated within the block.
+        """
+        measurement = Measurement(nbytes)
+        peak_before = _peak_rss()
+        start = time.perf_counter()
+        try:
+            yield measurement
+        finally:
+            self.add(
+                name,
+                calls=1,
+                seconds=time.perf_counter() - start,
+                bytes=measurement.bytes,
+                peak_rss_growth_bytes=_peak_rss() - peak_before,
+            )
+
+    def iterate(
+        self, name: str, items: Iterable, size: Optional[Callable] = None
+    ) -> Iterable:
+        """
+        Yield from items, measuring the production of each as one call of a
+        stage handling size(item) bytes.
+        """
+        iterator = iter(items)
+        while True:
+            with self.stage(name) as measurement:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                if size is not None:
+                    measurement.bytes = size(item)
+            yield item
+
+    def add(self, name: str, **values):
+        """Add to the totals of a stage."""
+        with self._lock:
+            totals = self.stages.setdefault(name, dict.fromkeys(self.FIELDS, 0))
+            for field, value in values.items():
+                totals[field] += value
+            self._changed = True
+
+    def merge(self, stages: dict):
+        """Add the totals of another Metrics' stages, e.g. from a worker process."""
+        for name, values in stages.items():
+            self.add(name, **values)
+
+    def snapshot(self) -> dict:
+        """A copy of the totals of each stage."""
+        with self._lock:
+            return {name: dict(totals) for name, totals in self.stages.items()}
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+            self._changed = False
+
+    def write(self):
+        """
+        Log the totals of each stage and write them to the files named by
+        M2B_METRICS_JSONL and M2B_METRICS_PROMETHEUS, if anything was measured
+        since they were last written.
+        """
+        with self._lock:
+            if not self._changed:
+                return
+            self._changed = False
+        stages = self.snapshot()
+        for name, totals in stages.items():
+            logger.info(
+                f"Stage {name}: {totals['calls']} calls in {totals['seconds']:.3f}s, "
+                f"{totals['bytes']} bytes, "
+                f"peak memory +{totals['peak_rss_growth_bytes']} bytes"
+            )
+        jsonl_path = os.environ.get("M2B_METRICS_JSONL")
+        if jsonl_path:
+            self.write_jsonl(jsonl_path, stages)
+        prometheus_path = os.environ.get("M2B_METRICS_PROMETHEUS")
+        if prometheus_path:
+            self.write_prometheus(prometheus_path, stages)
+
+    @staticmethod
+    def write_jsonl(path: str, stages: dict):
+        """Append a JSON Lines record with the totals of each stage."""
+        timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        with open(path, "a", encoding="utf-8") as f:
+            for name, totals in stages.items():
+                f.write(
+                    json.dumps({"timestamp": timestamp, "stage": name, **totals}) + "\n"
+                )
+
+    @staticmethod
+    def write_prometheus(path: str, stages: dict):
+        """
+        Replace a Prometheus textfile, as read by node_exporter's textfile
+        collector, with the totals of each stage.
+        """
+        lines = []
+        for field, help_text in (
+            ("calls", "Calls of each stage."),
+            ("seconds", "Time spent in each stage."),
+            ("bytes", "Bytes handled by each stage."),
+            ("peak_rss_growth_bytes", "Growth of the peak memory in each stage."),
+        ):
+            metric = f"mail2blog_stage_{field}_total"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for name, totals in stages.items():
+                lines.append(f'{metric}{{stage="{name}"}} {totals[field]}')
+        lines.append("# HELP mail2blog_peak_rss_bytes Peak memory of the process.")
+        lines.append("# TYPE mail2blog_peak_rss_bytes gauge")
+        lines.append(f"mail2blog_peak_rss_bytes {_peak_rss()}")
+        # write to a temporary file first, so the collector never reads a partial file
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp"
+        )
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+
+# the metrics of the current process
+METRICS = Metrics()
+
+
+def stage(name: str, nbytes: int = 0):
+    """Measure a block as one call of a stage of the current process."""
+    return METRICS.stage(name, nbytes)
+
+
+def measured(func, *args):
+    """
+    Call func in a worker process and return its result together with the
+    stages it measured, for the parent process to merge into its own.
+    """
+    METRICS.reset()
+    result = func(*args)
+    return result, METRICS.snapshot()
+
+
+@contextmanager
+def capture(profile_path: Optional[str] = None, tracemalloc_path: Optional[str] = None):
+    """
+    Profile the block with cProfile, saving the stats to profile_path, and
+    trace its memory allocations with tracemalloc, saving the peak and the
+    lines that allocated the most to tracemalloc_path.
+    """
+    profiler = None
+    if profile_path:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if tracemalloc_path:
+        tracemalloc.start(25)
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        if tracemalloc_path:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(tracemalloc_path, "w", encoding="utf-8") as f:
+                f.write(f"Peak traced memory: {peak} bytes\n")
+                for statistic in snapshot.statistics("lineno")[:50]:
+                    f.write(f"{statistic}\n")
@@ -0,0 +1,142 @@
+"""Module to run messages through the fetch, convert and save stages concurrently."""
+
+import queue
+import logging
+import threading
+import time
+from typing import Any, Callable, Iterable, Optional
+
+logger = logging.getLogger("mail2blog")
+
+# marks the end of the items put on a stage's queue
+_DONE = object()
+
+
+class StageStats:
+    """Throughput counters of a pipeline stage."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        """Count one item that kept the stage busy for the given time."""
+        with self._lock:
+            self.items += 1
+            self.busy_seconds += seconds
+
+    @property
+    def items_per_second(self) -> float:
+        """Items handled per busy second of the stage, summed over its workers."""
+        return self.items / self.busy_seconds if self.busy_seconds else 0.0
+
+    def __str__(self):
+        return (
+            f"{self.name}: {self.items} items in {self.busy_seconds:.2f}s "
+            f"({self.items_per_second:.2f} items/s)"
+        )
+
+
+def run_pipeline(
+    items: Iterable,
+    convert: Callable[[Any], Optional[Any]],
+    save: Callable[[Any], None],
+    workers: int,
+    queue_size: int,
+) -> dict[str, StageStats]:
+    """
+    Pull items from an iterable in a fetch thread, pass each to `convert` in
+    a pool of worker threads and each non-None result to `save` in the calling
+    thread, so saves are serialised. Results are saved in the order their
+    items were fetched, however the conversions finish, so that a run always
+    saves the same items in the same order. Stages are connected by queues
+    holding at most `queue_size` items.
+
+    Errors from `convert` and `save` are logged and the item skipped, while an
+    error from `items` stops fetching and is re-raised once the items fetched
+    so far have been processed.
+
+    Returns the throughput counters of each stage.
+    """
+    stats = {name: StageStats(name) for name in ("fetch", "convert", "save")}
+    convert_queue = queue.Queue(maxsize=queue_size)
+    save_queue = queue.Queue(maxsize=queue_size)
+    fetch_errors = []
+    # items fetched but not saved yet, bounding the results held back until
+    # the results of earlier items are saved
+    in_flight = threading.Semaphore(2 * queue_size + workers)
+
+    def fetch_stage():
+        try:
+            iterator = iter(items)
+            sequence = 0
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                stats["fetch"].add(time.perf_counter() - start)
+                in_flight.acquire()
+                convert_queue.put((sequence, item))
+                sequence += 1
+        except BaseException as e:
+            fetch_errors.append(e)
+        finally:
+            for _ in range(workers):
+                convert_queue.put(_DONE)
+
+    def convert_stage():
+        while (entry := convert_queue.get()) is not _DONE:
+            sequence, item = entry
+            start = time.perf_counter()
+            result = None
+            try:
+                result = convert(item)
+            except Exception as e:
+                logger.error(f"Error processing email: {str(e)}", exc_info=True)
+            finally:
+                stats["convert"].add(time.perf_counter() - start)
+            # skipped items are passed on too, so later results are not held back
+            save_queue.put((sequence, result))
+        save_queue.put(_DONE)
+
+    threads = [threading.Thread(target=fetch_stage, name="fetch")] + [
+        threading.Thread(target=convert_stage, name=f"convert-{i}")
+        for i in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+
+    done = 0
+    # results that arrived before those of earlier items, by sequence number
+    held_back = {}
+    next_sequence = 0
+    while done < workers:
+        entry = save_queue.get()
+        if entry is _DONE:
+            done += 1
+            continue
+        sequence, result = entry
+        held_back[sequence] = result
+        while next_sequence in held_back:
+            result = held_back.pop(next_sequence)
+            next_sequence += 1
+            in_flight.release()
+            if result is None:
+                continue
+            start = time.perf_counter()
+            try:
+                save(result)
+            except Exception as e:
+                logger.error(f"Error processing email: {str(e)}", exc_info=True)
+            finally:
+                stats["save"].add(time.perf_counter() - start)
+
+    for thread in threads:
+        thread.join()
+    if fetch_errors:
+        raise fetch_errors[0]
+    return stats
@@ -0,0 +1,254 @@
+"""Module to decide how each attachment is saved before it is fully decoded."""
+
+import io
+import os
+import binascii
+import fnmatch
+import logging
+import warnings
+from typing import Iterator, Optional
+
+from imap_tools import MailAttachment
+from PIL import Image
+
+import metrics
+
+logger = logging.getLogger("mail2blog")
+
+# bytes decoded from the start of an image to read its dimensions from its header
+HEADER_BYTES = 256 * 1024
+
+# bytes decoded at a time when streaming an attachment
+CHUNK_BYTES = 1024 * 1024
+
+# DCT scales JPEG images can be decoded at
+DRAFT_SCALES = (2, 4, 8)
+
+
+def _transfer_encoding(att: MailAttachment) -> str:
+    return str(att.part.get("content-transfer-encoding", "")).lower().strip()
+
+
+def read_payload(att: MailAttachment) -> bytes:
+    """
+    Decode an attachment as a whole, without caching the result on it as
+    its payload property does, so it is freed as soon as it is no longer used.
+    """
+    payload = att.part.get_payload(decode=True)
+    if payload:
+        return payload
+    # multipart payloads, such as forwarded emails
+    return MailAttachment(att.part).payload
+
+
+def _encoded_payload(att: MailAttachment) -> str:
+    """
+    The encoded payload of a non-multipart MIME part, as parsed. Unlike
+    get_payload(), this does not copy it whole to check it for surrogates.
+    """
+    encoded = att.part._payload
+    if isinstance(encoded, bytes):
+        encoded = encoded.decode("ascii", "surrogateescape")
+    return encoded
+
+
+def _ascii(text: str) -> bytes:
+    # raw 8-bit bytes the parser kept as surrogates are restored
+    return text.encode("ascii", "surrogateescape")
+
+
+def payload_size(att: MailAttachment) -> int:
+    """
+    An upper bound of the decoded size of an attachment, from the length of
+    its encoded MIME part, so that it is known without decoding it.
+    """
+    if att.part.is_multipart():
+        return len(read_payload(att))
+    encoded = _encoded_payload(att)
+    if _transfer_encoding(att) == "base64":
+        return len(encoded) * 3 // 4
+    return len(encoded)
+
+
+def iter_payload(att: MailAttachment, chunk_size: int = CHUNK_BYTES) -> Iterator[bytes]:
+    """
+    Decode a base64 or quoted-printable attachment from its MIME part in
+    chunks of about chunk_size bytes, so that it never has to be held in
+    memory as a whole. Other attachments are yielded in one piece.
+    """
+    encoding = _transfer_encoding(att)
+    if att.part.is_multipart() or encoding not in ("base64", "quoted-printable"):
+        yield read_payload(att)
+        return
+    encoded = _encoded_payload(att)
+    if encoding == "base64":
+        # every 4 base64 characters, not counting line breaks, are 3 bytes
+        step = chunk_size // 3 * 4
+        leftover = ""
+        for start in range(0, len(encoded), step):
+            data = leftover + "".join(encoded[start : start + step].split())
+            usable = len(data) - len(data) % 4
+            leftover = data[usable:]
+            if usable:
+                yield binascii.a2b_base64(_ascii(data[:usable]))
+        if leftover:
+            yield binascii.a2b_base64(_ascii(leftover + "=" * (-len(leftover) % 4)))
+    else:
+        # decode whole lines, so that no escape sequence is split
+        start = 0
+        while start < len(encoded):
+            end = encoded.find("\n", start + chunk_size)
+            end = len(encoded) if end == -1 else end + 1
+            yield binascii.a2b_qp(_ascii(encoded[start:end]))
+            start = end
+
+
+def _open_image(data: bytes) -> tuple[str, int, int]:
+    with warnings.catch_warnings():
+        # images over MAX_IMAGE_PIXELS are judged by the policy's own limit
+        warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+        with Image.open(io.BytesIO(data)) as img:
+            return img.format, img.width, img.height
+
+
+def _image_header(att: MailAttachment) -> Optional[tuple[str, int, int]]:
+    """
+    Read the format, width and height of an image from its header with
+    Pillow's lazy Image.open, decoding only the start of the attachment, or
+    None if it is no image Pillow can read. Raises
+    Image.DecompressionBombError for images over twice Pillow's
+    MAX_IMAGE_PIXELS.
+    """
+    head = next(iter_payload(att, HEADER_BYTES), b"")
+    try:
+        return _open_image(head)
+    except (OSError, SyntaxError, ValueError):
+        if len(head) >= payload_size(att):
+            return None
+    # the header did not fit in the start of the attachment
+    try:
+        return _open_image(read_payload(att))
+    except (OSError, SyntaxError, ValueError):
+        return None
+
+
+def draft_scale(width: int, height: int, max_pixels: int) -> Optional[int]:
+    """
+    The smallest DCT scale at which a JPEG of width x height decodes to at
+    most max_pixels, or None if even 1/8 is too large.
+    """
+    for scale in DRAFT_SCALES:
+        if (width // scale) * (height // scale) <= max_pixels:
+            return scale
+    return None
+
+
+class Decision:
+    """
+    How an attachment is saved: converted, converted from a JPEG decoded at
+    no more than 1/min_scale of its size ("cap"), streamed to disk as it is,
+    or skipped, and why.
+    """
+
+    def __init__(self, action: str, reason: str, min_scale: int = 1):
+        self.action = action
+        self.reason = reason
+        self.min_scale = min_scale
+
+    def __str__(self):
+        return f"{self.action} ({self.reason})"
+
+
+class AttachmentPolicy:
+    """
+    Decides how each attachment is saved from its content type, its size and,
+    for images, the dimensions in its header, before anything is decoded in
+    full, so the memory used per attachment is bounded:
+
+    - attachments whose content type matches none of `content_types`
+      (fnmatch patterns such as "image/*"), or larger than `max_bytes`, are
+      skipped;
+    - images of more than `max_image_pixels` are skipped, unless they are
+      JPEGs that can be decoded at a reduced DCT scale within that, which
+      are capped to it;
+    - other images are converted, and the remaining attachments, including
+      GIFs, are streamed to disk as they are.
+    """
+
+    def __init__(
+        self,
+        content_types=("*",),
+        max_bytes: Optional[int] = None,
+        max_image_pixels: int = Image.MAX_IMAGE_PIXELS,
+    ):
+        self.content_types = content_types
+        self.max_bytes = max_bytes
+        self.max_image_pixels = max_image_pixels
+
+    @classmethod
+    def from_env(cls) -> "AttachmentPolicy":
+        """
+        Build the policy set by M2B_ATTACHMENT_TYPES, comma-separated,
+        M2B_MAX_ATTACHMENT_BYTES and M2B_MAX_IMAGE_PIXELS.
+        """
+        policy = cls()
+        content_types = os.environ.get("M2B_ATTACHMENT_TYPES", "")
+        if content_types.strip():
+            policy.content_types = tuple(
+                pattern.strip().lower()
+                for pattern in content_types.split(",")
+                if pattern.strip()
+            )
+        max_bytes = os.environ.get("M2B_MAX_ATTACHMENT_BYTES")
+        if max_bytes:
+            policy.max_bytes = int(max_bytes)
+        max_image_pixels = os.environ.get("M2B_MAX_IMAGE_PIXELS")
+        if max_image_pixels:
+            policy.max_image_pixels = int(max_image_pixels)
+        return policy
+
+    def decide(self, att: MailAttachment) -> Decision:
+        """Decide how to save an attachment, logging the decision."""
+        with metrics.stage("policy"):
+            decision = self._decide(att)
+        logger.info(
+            f"Attachment {att.filename or att.content_id} ({att.content_type}): "
+            f"{decision}"
+        )
+        return decision
+
+    def _decide(self, att: MailAttachment) -> Decision:
+        content_type = att.content_type.lower()
+        if not any(
+            fnmatch.fnmatchcase(content_type, pattern) for pattern in self.content_types
+        ):
+            return Decision("skip", "content type not allowed")
+        size = payload_size(att)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return Decision("skip", f"about {size} bytes, over {self.max_bytes}")
+
+        if content_type.startswith("image/"):
+            try:
+                header = _image_header(att)
+            except Image.DecompressionBombError:
+                return Decision("skip", "decompression bomb")
+            if header is None:
+                return Decision("skip", "unreadable image")
+            image_format, width, height = header
+            if width * height > self.max_image_pixels:
+                scale = None
+                if image_format == "JPEG" and content_type != "image/gif":
+                    scale = draft_scale(width, height, self.max_image_pixels)
+                if scale is None:
+                    return Decision(
+                        "skip",
+                        f"{width}x{height} image over {self.max_image_pixels} pixels",
+                    )
+                return Decision(
+                    "cap", f"{width}x{height} image decoded at 1/{scale}", scale
+                )
+            # GIFs are saved as they are
+            if content_type != "image/gif":
+                return Decision("convert", f"{width}x{height} image")
+
+        return Decision("stream", f"about {size} bytes")
@@ -0,0 +1,273 @@
+"""Module to strip email cruft from HTML before it is converted to Markdown."""
+
+import re
+from collections import Counter
+from html.parser import HTMLParser
+from typing import Optional
+
+# elements dropped together with everything inside them
+DROPPED_ELEMENTS = {"head", "script", "style"}
+
+# elements without an end tag
+VOID_ELEMENTS = {
+    "area",
+    "base",
+    "br",
+    "col",
+    "embed",
+    "hr",
+    "img",
+    "input",
+    "link",
+    "meta",
+    "source",
+    "track",
+    "wbr",
+}
+
+# elements whose end tag may be left out, to the start tags of the elements
+# that end them when they follow; the end tag of their parent ends them too
+OPTIONAL_END_TAGS = {
+    "p": {
+        "address",
+        "article",
+        "aside",
+        "blockquote",
+        "details",
+        "div",
+        "dl",
+        "fieldset",
+        "figure",
+        "footer",
+        "form",
+        "h1",
+        "h2",
+        "h3",
+        "h4",
+        "h5",
+        "h6",
+        "header",
+        "hr",
+        "main",
+        "menu",
+        "nav",
+        "ol",
+        "p",
+        "pre",
+        "section",
+        "table",
+        "ul",
+    },
+    "li": {"li"},
+    "dt": {"dt", "dd"},
+    "dd": {"dt", "dd"},
+    "td": {"td", "th", "tr", "tbody", "tfoot", "thead"},
+    "th": {"td", "th", "tr", "tbody", "tfoot", "thead"},
+    "tr": {"tr", "tbody", "tfoot", "thead"},
+    "option": {"option", "optgroup"},
+}
+
+# table structure, to the markup it is replaced by when flattening layout tables
+TABLE_TAGS = {
+    "table": ("", ""),
+    "caption": ("", ""),
+    "colgroup": ("", ""),
+    "col": ("", ""),
+    "thead": ("", ""),
+    "tbody": ("", ""),
+    "tfoot": ("", ""),
+    "tr": ("", ""),
+    "td": ("<div>", "</div>"),
+    "th": ("<div>", "</div>"),
+}
+
+
+def _dimension(value) -> Optional[int]:
+    """Read a width or height attribute such as "1" or "1px"."""
+    match = re.match(r"\s*(\d+)", value or "")
+    return int(match.group(1)) if match else None
+
+
+class HtmlSanitizer(HTMLParser):
+    """
+    Streaming filter that rebuilds HTML without the parts of an email that
+    carry no content: the head, style sheets, scripts, comments including
+    Outlook conditional comments, hidden elements and tracking pixels.
+
+    Tables used for layout are flattened, their cells becoming <div>s. A
+    table is taken for layout when it has a presentation role, or when it
+    contains or is contained in another table. What is removed is counted
+    per rule in `removed`. Everything else is passed through as written.
+    """
+
+    def __init__(self):
+        # keep entities as written, rather than decoding them
+        super().__init__(convert_charrefs=False)
+        self.removed = Counter()
+        self._output = []
+        # the open tables, innermost last, as [is_layout, [(markup, flattened)]]
+        self._tables = []
+        # the tag of the element being dropped, and the tags open inside it
+        self._dropping = None
+
+    @property
+    def html(self) -> str:
+        """The sanitised HTML fed so far."""
+        return "".join(self._output)
+
+    def close(self):
+        super().close()
+        # tables left open by malformed HTML
+        while self._tables:
+            self._close_table("")
+
+    def _emit(self, markup: str, flattened=None):
+        if self._tables:
+            self._tables[-1][1].append(
+                (markup, markup if flattened is None else flattened)
+            )
+        else:
+            self._output.append(markup)
+
+    def _drop_rule(self, tag: str, attrs) -> Optional[str]:
+        """Name the rule removing an element, or None to keep it."""
+        if tag in DROPPED_ELEMENTS:
+            return tag
+        attrs = dict(attrs)
+        style = (attrs.get("style") or "").replace(" ", "").lower()
+        if "display:none" in style:
+            return "hidden"
+        if tag == "img":
+            width = _dimension(attrs.get("width"))
+            height = _dimension(attrs.get("height"))
+            if width is not None and height is not None and width <= 1 and height <= 1:
+                return "tracking_pixel"
+        return None
+
+    def _close_table(self, end_tag: str):
+        is_layout, tokens = self._tables.pop()
+        tokens.append((end_tag, ""))
+        if is_layout:
+            self.removed["layout_table"] += 1
+            self._emit("".join(flattened for _, flattened in tokens))
+        else:
+            self._emit("".join(markup for markup, _ in tokens))
+
+    def _ends_dropping(self, tag: str) -> bool:
+        """Whether the start of tag implicitly ends the element being dropped."""
+        dropped_tag, open_tags = self._dropping
+        # browsers end an unclosed head where the body starts
+        if dropped_tag == "head":
+            return tag == "body"
+        if tag not in OPTIONAL_END_TAGS.get(dropped_tag, ()):
+            return False
+        # a paragraph holds no blocks, while a list item or cell may hold a
+        # nested list or table of its own
+        return dropped_tag == "p" or not open_tags
+
+    def handle_starttag(self, tag, attrs):
+        if self._dropping:
+            if not self._ends_dropping(tag):
+                if tag not in VOID_ELEMENTS:
+                    self._dropping[1].append(tag)
+                return
+            self._dropping = None
+
+        rule = self._drop_rule(tag, attrs)
+        if rule:
+            self.removed[rule] += 1
+            if tag not in VOID_ELEMENTS:
+                self._dropping = (tag, [])
+            return
+
+        markup = self.get_starttag_text()
+        if tag == "table":
+            is_layout = dict(attrs).get("role") in ("presentation", "none")
+            if self._tables:
+                is_layout = True
+                for table in self._tables:
+                    table[0] = True
+            self._tables.append([is_layout, [(markup, "")]])
+        elif self._tables and tag in TABLE_TAGS:
+            self._emit(markup, TABLE_TAGS[tag][0])
+        else:
+            self._emit(markup)
+
+    def handle_startendtag(self, tag, attrs):
+        if self._dropping:
+            return
+        rule = self._drop_rule(tag, attrs)
+        if rule:
+            self.removed[rule] += 1
+            return
+        markup = self.get_starttag_text()
+        self._emit(markup, "" if self._tables and tag in TABLE_TAGS else None)
+
+    def handle_endtag(self, tag):
+        if self._dropping:
+            dropped_tag, open_tags = self._dropping
+            if tag in open_tags:
+                # along with the elements left open inside it
+                del open_tags[len(open_tags) - 1 - open_tags[::-1].index(tag) :]
+                return
+            if tag == dropped_tag:
+                self._dropping = None
+                return
+            if dropped_tag not in OPTIONAL_END_TAGS:
+                return
+            # the end tag of the parent of an implicitly ended element
+            self._dropping = None
+        markup = f"</{tag}>"
+        if tag == "table" and self._tables:
+            self._close_table(markup)
+        elif self._tables and tag in TABLE_TAGS:
+            self._emit(markup, TABLE_TAGS[tag][1])
+        else:
+            self._emit(markup)
+
+    def handle_data(self, data):
+        if not self._dropping:
+            self._emit(data)
+
+    def handle_entityref(self, name):
+        if not self._dropping:
+            self._emit(f"&{name};")
+
+    def handle_charref(self, name):
+        if not self._dropping:
+            self._emit(f"&#{name};")
+
+    def handle_comment(self, data):
+        if not self._dropping:
+            # Outlook conditional comments look like <!--[if mso]>...<![endif]-->
+            is_conditional = data.startswith("[if") or data.endswith("[endif]")
+            self.removed["conditional_comment" if is_conditional else "comment"] += 1
+
+    def handle_decl(self, decl):
+        if not self._dropping:
+            self._emit(f"<!{decl}>")
+
+    def unknown_decl(self, data):
+        if self._dropping:
+            return
+        if data.startswith("CDATA["):
+            self._emit(f"<![{data}]>")
+        else:
+            # the <![if !mso]> and <![endif]> markers around content for
+            # other clients than Outlook, which is kept
+            self.removed["conditional_comment"] += 1
+
+    def handle_pi(self, data):
+        if not self._dropping:
+            self._emit(f"<?{data}>")
+
+
+def sanitize_html(html: str) -> tuple[str, Counter]:
+    """
+    Strip the parts of an email's HTML that carry no content, returning the
+    sanitised HTML and the number of removals per rule.
+    """
+    sanitizer = HtmlSanitizer()
+    sanitizer.feed(html)
+    sanitizer.close()
+    return sanitizer.html, sanitizer.removed
@@ -0,0 +1,72 @@
+import unittest
+import os
+import mailbox
+import tempfile
+import email.policy
+from email.message import EmailMessage
+from archive import ImportProgress, read_archive
+
+
+def _raw_message(number, image=None):
+    message = EmailMessage(policy=email.policy.SMTP)
+    message["Subject"] = f"Post {number}"
+    message["Message-ID"] = f"<{number}@example.com>"
+    message.set_content(f'<p>Content {number}</p><img src="cid:img">', subtype="html")
+    if image:
+        message.add_related(image, "image", "png", cid="<img>", filename="a.png")
+    return message.as_bytes()
+
+
+class TestReadArchive(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def test_reads_mbox_in_order(self):
+        path = os.path.join(self.temp_dir.name, "archive.mbox")
+        archive = mailbox.mbox(path)
+        for number in (1, 2):
+            archive.add(_raw_message(number, image=b"png" if number == 2 else None))
+        archive.close()
+        progress = ImportProgress()
+
+        messages = list(read_archive(path, progress))
+
+        self.assertEqual([mail.subject for mail, _ in messages], ["Post 1", "Post 2"])
+        self.assertEqual(messages[0][1], {})
+        self.assertEqual(list(messages[1][1]), ["img"])
+        self.assertEqual(messages[1][1]["img"].payload, b"png")
+        self.assertEqual(progress.messages, 2)
+        self.assertGreater(progress.bytes, 0)
+
+    def test_reads_maildir(self):
+        path = os.path.join(self.temp_dir.name, "Maildir")
+        archive = mailbox.Maildir(path)
+        for number in (1, 2, 3):
+            archive.add(_raw_message(number))
+        archive.close()
+
+        subjects = [mail.subject for mail, _ in read_archive(path)]
+
+        self.assertEqual(sorted(subjects), ["Post 1", "Post 2", "Post 3"])
+
+    def test_missing_archive(self):
+        with self.assertRaises(FileNotFoundError):
+            list(read_archive(os.path.join(self.temp_dir.name, "missing")))
+
+
+class TestImportProgress(unittest.TestCase):
+    def test_logs_throughput_every_interval(self):
+        progress = ImportProgress(interval=0)
+
+        with self.assertLogs("mail2blog", level="INFO") as logs:
+            progress.add(2_000_000)
+
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("Read 1 emails (2.0 MB)", logs.output[0])
+        self.assertIn("emails/s", logs.output[0])
+        self.assertIn("MB/s", logs.output[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+import unittest
+import os
+import json
+import tempfile
+import threading
+from unittest.mock import patch
+from assets import AssetStore
+
+
+class TestAssetStore(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.assets_dir = self.temp_dir.name
+        self.index_path = os.path.join(self.temp_dir.name, "asset_index.jsonl")
+        self.legacy_path = os.path.join(self.temp_dir.name, "asset_index.json")
+        for attribute, path in (
+            ("M2B_ASSET_INDEX_FILEPATH", self.index_path),
+            ("M2B_LEGACY_ASSET_INDEX_FILEPATH", self.legacy_path),
+        ):
+            patcher = patch.object(AssetStore, attribute, path)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_key_depends_on_payload_and_params(self):
+        key = AssetStore.key(b"data", "jpeg", 600)
+        self.assertEqual(key, AssetStore.key(b"data", "jpeg", 600))
+        self.assertNotEqual(key, AssetStore.key(b"other", "jpeg", 600))
+        self.assertNotEqual(key, AssetStore.key(b"data", "jpeg", 1200))
+        self.assertNotEqual(key, AssetStore.key(b"data"))
+
+    def test_lookup_unknown_key(self):
+        self.assertIsNone(AssetStore().lookup("missing", self.assets_dir))
+
+    def test_record_persists(self):
+        open(os.path.join(self.assets_dir, "1.logo.png.jpeg"), "wb").close()
+        AssetStore().record("key", "1.logo.png.jpeg")
+
+        self.assertEqual(
+            AssetStore().lookup("key", self.assets_dir), ("1.logo.png.jpeg", [])
+        )
+
+    def test_record_with_variants(self):
+        for filename in ("1.logo.png.jpeg", "1.logo.png.320w.jpeg"):
+            open(os.path.join(self.assets_dir, filename), "wb").close()
+        variants = [["1.logo.png.320w.jpeg", 320, "image/jpeg"]]
+        AssetStore().record("key", "1.logo.png.jpeg", variants)
+
+        self.assertEqual(
+            AssetStore().lookup("key", self.assets_dir), ("1.logo.png.jpeg", variants)
+        )
+
+    def test_lookup_with_deleted_variant(self):
+        open(os.path.join(self.assets_dir, "1.logo.png.jpeg"), "wb").close()
+        asset_store = AssetStore()
+        variants = [["1.logo.png.320w.jpeg", 320, "image/jpeg"]]
+        asset_store.record("key", "1.logo.png.jpeg", variants)
+
+        self.assertIsNone(asset_store.lookup("key", self.assets_dir))
+
+    def test_lookup_with_deleted_file(self):
+        asset_store = AssetStore()
+        asset_store.record("key", "1.logo.png.jpeg")
+
+        self.assertIsNone(asset_store.lookup("key", self.assets_dir))
+
+    def test_record_appends_to_journal(self):
+        asset_store = AssetStore()
+        asset_store.record("key", "1.logo.png.jpeg")
+        asset_store.record("other", "2.doc.pdf")
+
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(
+            records,
+            [
+                {"key": "key", "filename": "1.logo.png.jpeg", "variants": []},
+                {"key": "other", "filename": "2.doc.pdf", "variants": []},
+            ],
+        )
+
+    def test_legacy_index_is_migrated(self):
+        open(os.path.join(self.assets_dir, "1.logo.png.jpeg"), "wb").close()
+        with open(self.legacy_path, "w", encoding="utf-8") as f:
+            json.dump({"key": {"filename": "1.logo.png.jpeg", "variants": []}}, f)
+
+        self.assertEqual(
+            AssetStore().lookup("key", self.assets_dir), ("1.logo.png.jpeg", [])
+        )
+        self.assertTrue(os.path.exists(self.index_path))
+
+    def test_incomplete_record_is_dropped(self):
+        open(os.path.join(self.assets_dir, "1.logo.png.jpeg"), "wb").close()
+        AssetStore().record("key", "1.logo.png.jpeg")
+        with open(self.index_path, "a", encoding="utf-8") as f:
+            f.write('{"key": "other", "filen')
+
+        asset_store = AssetStore()
+        self.assertEqual(list(asset_store.index), ["key"])
+        asset_store.record("other", "2.doc.pdf")
+        self.assertEqual(list(AssetStore().index), ["key", "other"])
+
+    def test_journal_is_compacted(self):
+        asset_store = AssetStore()
+        for _ in range(3):
+            asset_store.record("key", "1.logo.png.jpeg")
+
+        AssetStore()
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+    def test_claim_waits_for_claimed_key(self):
+        asset_store = AssetStore()
+        self.assertIsNone(asset_store.claim("key", self.assets_dir))
+
+        claimed = []
+        waiter = threading.Thread(
+            target=lambda: claimed.append(asset_store.claim("key", self.assets_dir))
+        )
+        waiter.start()
+        waiter.join(0.1)
+        self.assertTrue(waiter.is_alive())
+
+        open(os.path.join(self.assets_dir, "1.logo.png.jpeg"), "wb").close()
+        asset_store.record("key", "1.logo.png.jpeg")
+        waiter.join()
+        self.assertEqual(claimed, [("1.logo.png.jpeg", [])])
+
+    def test_released_key_is_claimed_again(self):
+        asset_store = AssetStore()
+        self.assertIsNone(asset_store.claim("key", self.assets_dir))
+
+        claimed = []
+        waiter = threading.Thread(
+            target=lambda: claimed.append(asset_store.claim("key", self.assets_dir))
+        )
+        waiter.start()
+        asset_store.release("key")
+        waiter.join()
+        self.assertEqual(claimed, [None])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,166 @@
+import unittest
+import os
+import datetime
+import tempfile
+from backends import (
+    asset_placeholder,
+    referenced_assets,
+    make_backend,
+    backends_for,
+    JekyllBackend,
+    PelicanBackend,
+)
+from jekyll import read_message_id
+from mail import MailboxConfig
+
+
+class TestBackends(unittest.TestCase):
+    def setUp(self):
+        self.content = (
+            f"![cat]({asset_placeholder('1.cat.png.jpeg')}) "
+            f"[pdf]({asset_placeholder('2.doc.pdf')})"
+        )
+        self.date = datetime.datetime(2023, 1, 1, 12, 0, 0)
+
+    def _post(self, generator):
+        site = make_backend(generator, assets_dir="/site/images")
+        return site.post(
+            title="A Cat: Photo",
+            author="Test Author",
+            date=self.date,
+            content=self.content,
+            message_id="<1@example.com>",
+        )
+
+    def test_referenced_assets(self):
+        self.assertEqual(
+            referenced_assets(self.content), {"1.cat.png.jpeg", "2.doc.pdf"}
+        )
+
+    def test_asset_urls_of_each_generator(self):
+        urls = {
+            generator: self._post(generator).content
+            for generator in ("jekyll", "hugo", "eleventy", "pelican")
+        }
+
+        self.assertEqual(
+            urls["jekyll"],
+            "![cat]({{ site.baseurl }}/images/1.cat.png.jpeg) "
+            "[pdf]({{ site.baseurl }}/images/2.doc.pdf)",
+        )
+        self.assertEqual(
+            urls["hugo"], "![cat](/images/1.cat.png.jpeg) [pdf](/images/2.doc.pdf)"
+        )
+        self.assertEqual(urls["eleventy"], urls["hugo"])
+        self.assertEqual(
+            urls["pelican"],
+            "![cat]({static}/images/1.cat.png.jpeg) [pdf]({static}/images/2.doc.pdf)",
+        )
+
+    def test_front_matter_of_each_generator(self):
+        hugo = self._post("hugo").generate_post()
+        eleventy = self._post("eleventy").generate_post()
+        pelican = self._post("pelican").generate_post()
+
+        self.assertTrue(
+            hugo.startswith(
+                '---\ntitle: "A Cat: Photo"\nauthor: "Test Author"\n'
+                'date: 2023-01-01T12:00:00\nslug: "a-cat-photo"\n'
+                'message_id: "<1@example.com>"\n---\n'
+            )
+        )
+        self.assertTrue(
+            eleventy.startswith(
+                '---\nlayout: post\ntitle: "A Cat: Photo"\nauthor: "Test Author"\n'
+                'date: 2023-01-01T12:00:00\nmessage_id: "<1@example.com>"\n---\n'
+            )
+        )
+        self.assertTrue(
+            pelican.startswith(
+                "Title: A Cat: Photo\nDate: 2023-01-01 12:00:00\n"
+                "Author: Test Author\nSlug: a-cat-photo\n"
+                "message_id: <1@example.com>\n\n!["
+            )
+        )
+
+    def test_message_id_of_saved_posts_is_read_back(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for generator in ("hugo", "eleventy", "pelican"):
+                post_dir = os.path.join(temp_dir, generator)
+                os.mkdir(post_dir)
+                site = make_backend(generator, post_dir=post_dir)
+                filepath = site.save(self._post(generator))
+
+                self.assertEqual(read_message_id(filepath), "<1@example.com>")
+
+    def test_same_titled_posts_get_their_own_slugs(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for generator, slug_key in (("hugo", "slug: "), ("pelican", "Slug: ")):
+                post_dir = os.path.join(temp_dir, generator)
+                os.mkdir(post_dir)
+                site = make_backend(generator, post_dir=post_dir)
+                slugs = []
+                for date in (self.date, self.date, self.date.replace(day=8)):
+                    post = self._post(generator)
+                    post.date = date
+                    with open(site.save(post), "r", encoding="utf-8") as f:
+                        slugs.extend(
+                            line[len(slug_key) :].strip('"')
+                            for line in f.read().splitlines()
+                            if line.startswith(slug_key)
+                        )
+
+                self.assertEqual(
+                    slugs,
+                    [
+                        "2023-01-01-a-cat-photo",
+                        "2023-01-01-a-cat-photo-2",
+                        "2023-01-08-a-cat-photo",
+                    ],
+                )
+
+    def test_unknown_generator(self):
+        with self.assertRaises(ValueError):
+            make_backend("gatsby")
+
+    def test_backends_for_config(self):
+        single = backends_for(
+            MailboxConfig(post_dir="/blog/_posts", assets_dir="/blog/assets")
+        )
+        many = backends_for(
+            MailboxConfig(
+                sites=[
+                    {"generator": "jekyll", "post_dir": "/a", "assets_dir": "/a/x"},
+                    {"generator": "pelican", "post_dir": "/b", "assets_dir": "/b/x"},
+                ]
+            )
+        )
+
+        self.assertEqual(len(single), 1)
+        self.assertIsInstance(single[0], JekyllBackend)
+        self.assertEqual(single[0].post_dir, "/blog/_posts")
+        self.assertEqual([type(site) for site in many], [JekyllBackend, PelicanBackend])
+
+    def test_import_assets_links_files(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source_dir = os.path.join(temp_dir, "source")
+            assets_dir = os.path.join(temp_dir, "assets")
+            os.mkdir(source_dir)
+            os.mkdir(assets_dir)
+            with open(os.path.join(source_dir, "1.cat.png.jpeg"), "wb") as f:
+                f.write(b"jpeg")
+            site = make_backend("hugo", assets_dir=assets_dir)
+
+            site.import_assets({"1.cat.png.jpeg"}, source_dir)
+            site.import_assets({"1.cat.png.jpeg"}, source_dir)
+
+            self.assertTrue(
+                os.path.samefile(
+                    os.path.join(source_dir, "1.cat.png.jpeg"),
+                    os.path.join(assets_dir, "1.cat.png.jpeg"),
+                )
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,255 @@
 import unittest
 from unittest.mock import patch, mock_open, MagicMock
+import io
 import os
+import sys
+import json
+import shutil
+import tempfile
+import time
+import threading
+from email.message import EmailMessage
 from imap_tools import MailAttachment
-from converter import html_to_blog_md
+from markdownify import markdownify
+from PIL import Image
+from assets import AssetStore
+from converter import (
+    html_to_blog_md,
+    md,
+    _convert_image_to_jpeg,
+    _convert_image_variants,
+    _convert_gif,
+    _ResizedFrames,
+    _rewrite_cids,
+)
+
+
+def _gif_payload(width=1200, height=600):
+    """
+    A looping GIF of a red frame, the same frame again once composited, then
+    a blue frame.
+    """
+    red = Image.new("RGBA", (width, height), (255, 0, 0, 255))
+    # a transparent pixel over the frame before, which is not disposed of
+    red_again = red.copy()
+    red_again.putpixel((5, 5), (0, 0, 0, 0))
+    blue = Image.new("RGBA", (width, height), (0, 0, 255, 255))
+    buf = io.BytesIO()
+    red.save(
+        buf,
+        "GIF",
+        save_all=True,
+        append_images=[red_again, blue],
+        duration=[100, 50, 70],
+        disposal=1,
+        loop=0,
+    )
+    return buf.getvalue()
+
+
+def _mime_part(payload):
+    """The base64-encoded MIME part of an attachment with payload."""
+    part = EmailMessage()
+    part.set_content(payload, "application", "octet-stream")
+    return part
+
+
+class TestConvertImageToJpeg(unittest.TestCase):
+    def _png_payload(self, width, height):
+        buf = io.BytesIO()
+        Image.new("RGBA", (width, height), (255, 0, 0, 128)).save(buf, "PNG")
+        return buf.getvalue()
+
+    def test_convert_resizes_wide_image(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_path = os.path.join(temp_dir, "out.jpeg")
+
+            _convert_image_to_jpeg(self._png_payload(1200, 800), output_path)
+
+            with Image.open(output_path) as img:
+                self.assertEqual(img.format, "JPEG")
+                self.assertEqual(img.size, (600, 400))
+            self.assertEqual(os.listdir(temp_dir), ["out.jpeg"])
+
+    def test_convert_large_jpeg_with_draft(self):
+        buf = io.BytesIO()
+        Image.new("RGB", (4800, 3200), (0, 128, 255)).save(buf, "JPEG")
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_path = os.path.join(temp_dir, "out.jpeg")
+
+            with patch(
+                "PIL.JpegImagePlugin.JpegImageFile.draft", autospec=True
+            ) as mock_draft:
+                _convert_image_to_jpeg(buf.getvalue(), output_path)
+            mock_draft.assert_called_once_with(unittest.mock.ANY, None, (600, 400))
+
+            _convert_image_to_jpeg(buf.getvalue(), output_path)
+            with Image.open(output_path) as img:
+                self.assertEqual(img.size, (600, 400))
+
+    def test_convert_keeps_narrow_image_size(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_path = os.path.join(temp_dir, "out.jpeg")
+
+            _convert_image_to_jpeg(self._png_payload(300, 200), output_path)
+
+            with Image.open(output_path) as img:
+                self.assertEqual(img.size, (300, 200))
+
+    def test_convert_failure_leaves_no_file(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_path = os.path.join(temp_dir, "out.jpeg")
+
+            with self.assertRaises(Exception):
+                _convert_image_to_jpeg(b"not an image", output_path)
+
+            self.assertEqual(os.listdir(temp_dir), [])
+
+    def test_convert_writes_hidden_temporary_file(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_path = os.path.join(temp_dir, "out.jpeg")
+
+            with patch("converter.os.replace", wraps=os.replace) as mock_replace:
+                _convert_image_to_jpeg(self._png_payload(20, 10), output_path)
+
+            tmp_path, path = mock_replace.call_args.args
+            self.assertEqual(os.path.dirname(tmp_path), temp_dir)
+            self.assertTrue(os.path.basename(tmp_path).startswith(".out.jpeg."))
+            self.assertEqual(path, output_path)
+            self.assertEqual(os.listdir(temp_dir), ["out.jpeg"])
+
+    def test_convert_variants_from_one_decode(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_path = os.path.join(temp_dir, "1.photo.png.jpeg")
+
+            with patch("converter.Image.open", wraps=Image.open) as mock_open_image:
+                variants = _convert_image_variants(
+                    self._png_payload(1000, 500), output_path, (320, 1200), ("webp",)
+                )
+
+            mock_open_image.assert_called_once()
+            self.assertEqual(
+                variants,
+                [
+                    ("1.photo.png.1000w.jpeg", 1000, "image/jpeg"),
+                    ("1.photo.png.1000w.webp", 1000, "image/webp"),
+                    ("1.photo.png.320w.jpeg", 320, "image/jpeg"),
+                    ("1.photo.png.320w.webp", 320, "image/webp"),
+                ],
+            )
+            with Image.open(output_path) as img:
+                self.assertEqual(img.size, (600, 300))
+            with Image.open(os.path.join(temp_dir, "1.photo.png.320w.webp")) as img:
+                self.assertEqual((img.format, img.size), ("WEBP", (320, 160)))
+                self.assertEqual(img.mode, "RGBA")
+            self.assertEqual(len(os.listdir(temp_dir)), 5)
+
+
+class TestConvertGif(unittest.TestCase):
+    def _frames(self, path):
+        with Image.open(path) as img:
+            frames = []
+            for index in range(img.n_frames):
+                img.seek(index)
+                img.load()
+                frames.append(
+                    (img.convert("RGB").getpixel((0, 0)), img.info["duration"])
+                )
+            return img.format, img.size, frames
+
+    def test_convert_gif_resizes_and_drops_duplicate_frames(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for gif_format in ("gif", "webp"):
+                output_path = os.path.join(temp_dir, f"out.{gif_format}")
+
+                _convert_gif(_gif_payload(), output_path, gif_format)
+
+                image_format, size, frames = self._frames(output_path)
+                self.assertEqual(image_format, gif_format.upper())
+                self.assertEqual(size, (600, 300))
+                self.assertEqual(
+                    [(duration, color[0] > 200) for color, duration in frames],
+                    [(150, True), (70, False)],
+                )
+            self.assertEqual(sorted(os.listdir(temp_dir)), ["out.gif", "out.webp"])
+
+    def test_resized_frames_are_encoded_lazily_by_webp_writer(self):
+        with Image.open(io.BytesIO(_gif_payload())) as img:
+            frames = _ResizedFrames(img, [0, 2], (600, 300), "RGBA")
+            buf = io.BytesIO()
+
+            with patch.object(
+                _ResizedFrames, "seek", autospec=True, side_effect=_ResizedFrames.seek
+            ) as mock_seek:
+                frames.save(buf, "WEBP", save_all=True, duration=[150, 70], loop=0)
+
+        # frames are decoded one at a time, as the writer reaches them
+        self.assertEqual([call.args[1] for call in mock_seek.call_args_list], [0, 1, 0])
+        with Image.open(buf) as webp:
+            self.assertEqual((webp.size, webp.n_frames), ((600, 300), 2))
+
+    def _fake_ffmpeg(self, temp_dir, exit_status=0):
+        """
+        Put an ffmpeg on the PATH that records its arguments and the number of
+        bytes piped to it in its output file.
+        """
+        path = os.path.join(temp_dir, "ffmpeg")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(
+                f"#!{sys.executable}\n"
+                "import sys, json\n"
+                f"if {exit_status}:\n"
+                f"    sys.exit({exit_status})\n"
+                "data = sys.stdin.buffer.read()\n"
+                "with open(sys.argv[-1], 'x') as f:\n"
+                "    json.dump({'args': sys.argv[1:], 'bytes': len(data)}, f)\n"
+            )
+        os.chmod(path, 0o755)
+        patcher = patch.dict(
+            "os.environ", {"PATH": temp_dir + os.pathsep + os.environ["PATH"]}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_convert_gif_to_video_pipes_frames_to_ffmpeg(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self._fake_ffmpeg(temp_dir)
+            output_path = os.path.join(temp_dir, "out.mp4")
+
+            _convert_gif(_gif_payload(), output_path, "mp4")
+
+            with open(output_path, "r", encoding="utf-8") as f:
+                ffmpeg_run = json.load(f)
+        args = ffmpeg_run["args"]
+        self.assertIn("libx264", args)
+        self.assertEqual(args[args.index("-framerate") + 1], "1000/10")
+        # each frame is repeated to last its duration at 100 frames a second
+        self.assertEqual(ffmpeg_run["bytes"], (15 + 7) * 600 * 300 * 3)
+
+    def test_convert_gif_video_failure_leaves_no_file(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self._fake_ffmpeg(temp_dir, exit_status=1)
+            assets_dir = os.path.join(temp_dir, "assets")
+            os.mkdir(assets_dir)
+
+            with self.assertRaises(OSError):
+                _convert_gif(
+                    _gif_payload(), os.path.join(assets_dir, "out.webm"), "webm"
+                )
+
+            self.assertEqual(os.listdir(assets_dir), [])
+
+    @unittest.skipUnless(shutil.which("ffmpeg"), "ffmpeg is not installed")
+    def test_convert_gif_to_video_with_ffmpeg(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for gif_format, magic in (("mp4", b"ftyp"), ("webm", b"\x1a\x45\xdf\xa3")):
+                output_path = os.path.join(temp_dir, f"out.{gif_format}")
+
+                _convert_gif(_gif_payload(), output_path, gif_format)
+
+                with open(output_path, "rb") as f:
+                    self.assertIn(magic, f.read(16))
 
 
 class TestHtmlToBlogMd(unittest.TestCase):
@@ -21,7 +268,7 @@ class TestHtmlToBlogMd(unittest.TestCase):
         attachment = MagicMock(spec=MailAttachment)
         attachment.content_type = "image/jpeg"
         attachment.filename = "test.jpg"
-        attachment.payload = b"image_data"
+        attachment.part = _mime_part(b"image_data")
 
         attachments_dict = {"123": attachment}
 
@@ -31,13 +278,10 @@ class TestHtmlToBlogMd(unittest.TestCase):
         # Assertions
         mock_md.assert_called_once_with(html)
         mock_env_get.assert_called_once_with("M2B_BLOG_ASSETS_DIR")
-        mock_file.assert_called_once_with(
-            os.path.join("assets", "123.test.jpg.jpeg"), "wb"
-        )
-        mock_file().write.assert_called_once_with(b"image_data")
+        # the image is converted straight from its payload, without writing it first
+        mock_file.assert_not_called()
         mock_convert.assert_called_once_with(
-            os.path.join("assets", "123.test.jpg.jpeg"),
-            os.path.join("assets", "123.test.jpg.jpeg"),
+            b"image_data", os.path.join("assets", "123.test.jpg.jpeg")
         )
         self.assertEqual(
             result,
@@ -60,12 +304,12 @@ class TestHtmlToBlogMd(unittest.TestCase):
         attachment1 = MagicMock(spec=MailAttachment)
         attachment1.content_type = "image/png"
         attachment1.filename = "image1.png"
-        attachment1.payload = b"image1_data"
+        attachment1.part = _mime_part(b"image1_data")
 
         attachment2 = MagicMock(spec=MailAttachment)
         attachment2.content_type = "image/jpeg"
         attachment2.filename = "image2.jpg"
-        attachment2.payload = b"image2_data"
+        attachment2.part = _mime_part(b"image2_data")
 
         attachments_dict = {"123": attachment1, "456": attachment2}
 
@@ -73,7 +317,7 @@ class TestHtmlToBlogMd(unittest.TestCase):
         result = html_to_blog_md(html, attachments_dict)
 
         # Assertions
-        self.assertEqual(mock_file.call_count, 2)
+        mock_file.assert_not_called()
         self.assertEqual(mock_convert.call_count, 2)
         self.assertEqual(
             result,
@@ -96,7 +340,7 @@ class TestHtmlToBlogMd(unittest.TestCase):
         attachment = MagicMock(spec=MailAttachment)
         attachment.content_type = "application/pdf"
         attachment.filename = "document.pdf"
-        attachment.payload = b"pdf_data"
+        attachment.part = _mime_part(b"pdf_data")
 
         attachments_dict = {"123": attachment}
 
@@ -130,7 +374,7 @@ class TestHtmlToBlogMd(unittest.TestCase):
         attachment = MagicMock(spec=MailAttachment)
         attachment.content_type = "image/gif"
         attachment.filename = "animation.gif"
-        attachment.payload = b"gif_data"
+        attachment.part = _mime_part(b"gif_data")
 
         attachments_dict = {"123": attachment}
 
@@ -148,6 +392,29 @@ class TestHtmlToBlogMd(unittest.TestCase):
             "# Content\n\nWith GIF: ![animation]({{ site.baseurl }}/assets/123.animation.gif)",
         )
 
+    @patch("converter.md")
+    @patch("converter._convert_gif")
+    def test_html_to_blog_md_converts_gif_to_video(self, mock_convert_gif, mock_md):
+        mock_md.return_value = '![cat](cid:1 "Cat") [gif](cid:1)'
+        attachment = MagicMock(spec=MailAttachment)
+        attachment.content_type = "image/gif"
+        attachment.filename = "cat.gif"
+        attachment.part = _mime_part(b"gif_data")
+
+        result = html_to_blog_md(
+            "<p>Test</p>", {"1": attachment}, assets_dir="assets", gif_format="mp4"
+        )
+
+        mock_convert_gif.assert_called_once_with(
+            b"gif_data", os.path.join("assets", "1.cat.gif.mp4"), "mp4"
+        )
+        url = "{{ site.baseurl }}/assets/1.cat.gif.mp4"
+        self.assertEqual(
+            result,
+            f'<video src="{url}" autoplay loop muted playsinline aria-label="cat" '
+            f'title="Cat"></video> [gif]({url})',
+        )
+
     @patch("converter.md")
     @patch("converter.os.environ.get")
     @patch("converter.open", new_callable=mock_open)
@@ -188,3 +455,227 @@ class TestHtmlToBlogMd(unittest.TestCase):
 
         # Assertions
         mock_env_get.assert_called_once_with("M2B_BLOG_ASSETS_DIR")
+
+    @patch("converter.md")
+    @patch("converter.os.environ.get")
+    @patch("converter.open", new_callable=mock_open)
+    @patch("converter._convert_image_to_jpeg")
+    def test_html_to_blog_md_with_executor(
+        self, mock_convert, mock_file, mock_env_get, mock_md
+    ):
+        # Setup
+        mock_env_get.return_value = "assets"
+        mock_md.return_value = "Image1: ![](cid:123)\nImage2: ![](cid:456)"
+        executor = MagicMock()
+        executor.submit.return_value.result.return_value = None
+
+        attachment1 = MagicMock(spec=MailAttachment)
+        attachment1.content_type = "image/png"
+        attachment1.filename = "image1.png"
+        attachment1.part = _mime_part(b"image1_data")
+
+        attachment2 = MagicMock(spec=MailAttachment)
+        attachment2.content_type = "image/gif"
+        attachment2.filename = "image2.gif"
+        attachment2.part = _mime_part(b"image2_data")
+
+        attachments_dict = {"123": attachment1, "456": attachment2}
+
+        # Call the function
+        result = html_to_blog_md("<p>Test</p>", attachments_dict, executor=executor)
+
+        # Assertions
+        dest_path = os.path.join("assets", "123.image1.png.jpeg")
+        executor.submit.assert_called_once_with(mock_convert, b"image1_data", dest_path)
+        executor.submit.return_value.result.assert_called_once()
+        mock_convert.assert_not_called()
+        self.assertEqual(
+            result,
+            "Image1: ![]({{ site.baseurl }}/assets/123.image1.png.jpeg)\nImage2: ![]({{ site.baseurl }}/assets/456.image2.gif)",
+        )
+
+
+class TestMarkdownConversion(unittest.TestCase):
+    def test_shared_converter_matches_markdownify(self):
+        html = "<h1>Title</h1><p>Some <b>bold</b> text_with *stars*</p><ul><li>one</li></ul>"
+
+        self.assertEqual(md(html), markdownify(html))
+
+    @patch("converter.md")
+    def test_plain_text_email_is_not_parsed_as_html(self, mock_md):
+        result = html_to_blog_md(
+            "", {}, text="Hello *world*\r\n\r\nsnake_case <b>\r\n", assets_dir="assets"
+        )
+
+        mock_md.assert_not_called()
+        self.assertEqual(result, "Hello \\*world\\*\n\nsnake\\_case <b>")
+
+    @patch("converter.md")
+    def test_html_is_preferred_over_text(self, mock_md):
+        mock_md.return_value = "From HTML"
+
+        result = html_to_blog_md(
+            "<p>From HTML</p>", {}, text="From text", assets_dir="assets"
+        )
+
+        mock_md.assert_called_once_with("<p>From HTML</p>")
+        self.assertEqual(result, "From HTML")
+
+
+class TestRewriteCids(unittest.TestCase):
+    def test_cid_that_prefixes_another_is_not_confused_with_it(self):
+        result = _rewrite_cids(
+            "![](cid:img1) ![](cid:img10) [x](cid:img1)",
+            {"img1": "one.jpeg", "img10": "ten.jpeg"},
+            {},
+        )
+
+        self.assertEqual(result, "![](one.jpeg) ![](ten.jpeg) [x](one.jpeg)")
+
+    def test_cids_are_matched_literally(self):
+        result = _rewrite_cids(
+            "![](cid:a.b+c@host) ![](cid:aXb+c@host)", {"a.b+c@host": "url"}, {}
+        )
+
+        self.assertEqual(result, "![](url) ![](cid:aXb+c@host)")
+
+    def test_replacements_are_not_rewritten_again(self):
+        result = _rewrite_cids(
+            "![](cid:1) ![](cid:2)", {"1": "cid:2", "2": "two.jpeg"}, {}
+        )
+
+        self.assertEqual(result, "![](cid:2) ![](two.jpeg)")
+
+
+class TestHtmlToBlogMdWithVariants(unittest.TestCase):
+    @patch("converter.md")
+    @patch("converter.os.environ.get")
+    @patch("converter._convert_image_variants")
+    def test_images_become_picture_elements(self, mock_variants, mock_env_get, mock_md):
+        # Setup
+        mock_env_get.return_value = "assets"
+        mock_md.return_value = (
+            '![A "cat"](cid:123 "Title") and [link](cid:123)\n![](cid:456)'
+        )
+        mock_variants.return_value = [
+            ("123.cat.png.320w.jpeg", 320, "image/jpeg"),
+            ("123.cat.png.320w.webp", 320, "image/webp"),
+            ("123.cat.png.600w.jpeg", 600, "image/jpeg"),
+            ("123.cat.png.600w.webp", 600, "image/webp"),
+        ]
+        attachment = MagicMock(spec=MailAttachment)
+        attachment.content_type = "image/png"
+        attachment.filename = "cat.png"
+        attachment.part = _mime_part(b"cat_data")
+
+        # Call the function
+        result = html_to_blog_md(
+            "<p>Test</p>",
+            {"123": attachment},
+            image_widths=(320, 600),
+            image_formats=("webp",),
+        )
+
+        # Assertions
+        mock_variants.assert_called_once_with(
+            b"cat_data",
+            os.path.join("assets", "123.cat.png.jpeg"),
+            (320, 600),
+            ("webp",),
+        )
+        base = "{{ site.baseurl }}/assets/123.cat.png"
+        self.assertEqual(
+            result,
+            "<picture>"
+            f'<source type="image/webp" srcset="{base}.320w.webp 320w, {base}.600w.webp 600w">'
+            f'<img src="{base}.jpeg" srcset="{base}.320w.jpeg 320w, {base}.600w.jpeg 600w" '
+            'alt="A &quot;cat&quot;" title="Title">'
+            "</picture>"
+            f" and [link]({base}.jpeg)\n![](cid:456)",
+        )
+
+
+class TestHtmlToBlogMdWithAssetStore(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.assets_dir = os.path.join(self.temp_dir.name, "assets")
+        os.mkdir(self.assets_dir)
+        index_path = os.path.join(self.temp_dir.name, "asset_index.jsonl")
+        patcher = patch.object(AssetStore, "M2B_ASSET_INDEX_FILEPATH", index_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _attachment(self, content_type, filename, payload):
+        attachment = MagicMock(spec=MailAttachment)
+        attachment.content_type = content_type
+        attachment.filename = filename
+        attachment.part = _mime_part(payload)
+        return attachment
+
+    @patch("converter.md")
+    @patch("converter._convert_image_to_jpeg")
+    def test_repeated_attachments_are_stored_once(self, mock_convert, mock_md):
+        mock_md.return_value = "![](cid:1) ![](cid:2) [pdf](cid:3)"
+        logo = self._attachment("image/png", "logo.png", b"logo_data")
+        same_logo = self._attachment("image/png", "logo2.png", b"logo_data")
+        pdf = self._attachment("application/pdf", "doc.pdf", b"pdf_data")
+        asset_store = AssetStore()
+
+        with patch.dict("os.environ", {"M2B_BLOG_ASSETS_DIR": self.assets_dir}):
+            result = html_to_blog_md(
+                "<p>Test</p>",
+                {"1": logo, "2": same_logo, "3": pdf},
+                asset_store=asset_store,
+            )
+            # the converted file must exist for it to be reused
+            open(os.path.join(self.assets_dir, "1.logo.png.jpeg"), "wb").close()
+            mock_md.return_value = "![](cid:4) [pdf](cid:5)"
+            second_result = html_to_blog_md(
+                "<p>Test</p>", {"4": logo, "5": pdf}, asset_store=AssetStore()
+            )
+
+        mock_convert.assert_called_once()
+        self.assertEqual(
+            result,
+            "![]({{ site.baseurl }}/assets/1.logo.png.jpeg) "
+            "![]({{ site.baseurl }}/assets/1.logo.png.jpeg) "
+            "[pdf]({{ site.baseurl }}/assets/3.doc.pdf)",
+        )
+        self.assertEqual(
+            second_result,
+            "![]({{ site.baseurl }}/assets/1.logo.png.jpeg) "
+            "[pdf]({{ site.baseurl }}/assets/3.doc.pdf)",
+        )
+
+    @patch("converter.md")
+    @patch("converter._convert_image_to_jpeg")
+    def test_concurrent_messages_convert_shared_attachment_once(
+        self, mock_convert, mock_md
+    ):
+        def convert(payload, dest_path):
+            time.sleep(0.1)
+            open(dest_path, "wb").close()
+
+        mock_convert.side_effect = convert
+        mock_md.return_value = "![](cid:1)"
+        logo = self._attachment("image/png", "logo.png", b"logo_data")
+        asset_store = AssetStore()
+        results = []
+
+        def convert_message():
+            results.append(
+                html_to_blog_md("<p>Test</p>", {"1": logo}, asset_store=asset_store)
+            )
+
+        with patch.dict("os.environ", {"M2B_BLOG_ASSETS_DIR": self.assets_dir}):
+            threads = [threading.Thread(target=convert_message) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        mock_convert.assert_called_once()
+        self.assertEqual(
+            results, ["![]({{ site.baseurl }}/assets/1.logo.png.jpeg)"] * 2
+        )
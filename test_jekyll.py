@@ -3,7 +3,7 @@ import os
 import datetime
 import tempfile
 from unittest.mock import patch
-from jekyll import JekyllPost
+from jekyll import JekyllPost, PostIndex, read_message_id
 
 
 class TestJekyllPost(unittest.TestCase):
@@ -78,6 +78,37 @@ class TestJekyllPost(unittest.TestCase):
         )
         self.assertEqual(post._generate_front_matter(), expected)
 
+    def test_generate_front_matter_with_message_id(self):
+        """Test front matter generation with the message_id of the email."""
+        post = JekyllPost(
+            title=self.title, author=self.author, date=self.date, message_id="<1@a.b>"
+        )
+        expected = (
+            "---\n"
+            "layout: post\n"
+            'title: "Test Post"\n'
+            'author: "Test Author"\n'
+            "date: 2023-01-01 12:00:00\n"
+            'message_id: "<1@a.b>"\n'
+            "---\n"
+        )
+        self.assertEqual(post._generate_front_matter(), expected)
+
+    def test_read_message_id(self):
+        """Test reading the message_id back from saved posts."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.post.message_id = '<"quoted"@example.com>'
+            with_id = self.post.save(temp_dir)
+            self.post.title, self.post.message_id = "Other Post", None
+            without_id = self.post.save(temp_dir)
+            other_file = os.path.join(temp_dir, "notes.md")
+            with open(other_file, "w", encoding="utf-8") as f:
+                f.write("message_id: not front matter\n")
+
+            self.assertEqual(read_message_id(with_id), '<"quoted"@example.com>')
+            self.assertIsNone(read_message_id(without_id))
+            self.assertIsNone(read_message_id(other_file))
+
     def test_generate_post(self):
         """Test complete post generation."""
         front_matter = self.post._generate_front_matter()
@@ -100,15 +131,72 @@ class TestJekyllPost(unittest.TestCase):
     @patch("os.path.expanduser")
     def test_save_with_user_path(self, mock_expanduser):
         """Test saving post with a path containing a user directory."""
-        mock_expanduser.return_value = "/home/user/blog"
+        with tempfile.TemporaryDirectory() as temp_dir:
+            mock_expanduser.return_value = temp_dir
 
-        with patch("builtins.open", unittest.mock.mock_open()) as mock_file:
             filepath = self.post.save("~/blog")
 
             mock_expanduser.assert_called_once_with("~/blog")
-            expected_path = os.path.join("/home/user/blog", "2023-01-01-test-post.md")
+            expected_path = os.path.join(temp_dir, "2023-01-01-test-post.md")
             self.assertEqual(filepath, expected_path)
-            mock_file.assert_called_once_with(expected_path, "w", encoding="utf-8")
+            self.assertTrue(os.path.exists(expected_path))
+
+    def test_save_same_title_on_same_day(self):
+        """Test that posts with the same title and day get numbered filenames."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with open(
+                os.path.join(temp_dir, "2023-01-01-test-post.md"), "w", encoding="utf-8"
+            ) as f:
+                f.write("existing post")
+
+            filepaths = [self.post.save(temp_dir) for _ in range(2)]
+
+            self.assertEqual(
+                [os.path.basename(filepath) for filepath in filepaths],
+                ["2023-01-01-test-post-2.md", "2023-01-01-test-post-3.md"],
+            )
+            with open(
+                os.path.join(temp_dir, "2023-01-01-test-post.md"), "r", encoding="utf-8"
+            ) as f:
+                self.assertEqual(f.read(), "existing post")
+            # only the posts, without temporary files
+            self.assertEqual(len(os.listdir(temp_dir)), 3)
+
+    def test_save_lists_directory_once(self):
+        """Test that the posts directory is only listed on the first save."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with patch("jekyll.os.scandir", wraps=os.scandir) as mock_scandir:
+                self.post.save(temp_dir)
+                JekyllPost(title="Other", date=self.date).save(temp_dir)
+
+            mock_scandir.assert_called_once_with(os.path.abspath(temp_dir))
+
+    def test_save_failure_leaves_no_file(self):
+        """Test that a failed write leaves neither a partial post nor a temporary file."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with patch("jekyll.os.replace", side_effect=OSError("disk full")):
+                with self.assertRaises(OSError):
+                    self.post.save(temp_dir)
+
+            self.assertEqual(os.listdir(temp_dir), [])
+
+    def test_post_index_claims_are_deterministic(self):
+        """Test that colliding filenames get suffixes in order."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index = PostIndex(temp_dir)
+
+            claimed = [index.claim("2023-01-01-a.md") for _ in range(3)]
+            claimed.append(index.claim("2023-01-01-a-2.md"))
+
+            self.assertEqual(
+                claimed,
+                [
+                    "2023-01-01-a.md",
+                    "2023-01-01-a-2.md",
+                    "2023-01-01-a-3.md",
+                    "2023-01-01-a-2-2.md",
+                ],
+            )
 
 
 if __name__ == "__main__":
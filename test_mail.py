@@ -1,20 +1,97 @@
 import unittest
+import os
+import json
+import time
+import asyncio
+import tempfile
+import threading
 from unittest.mock import patch, MagicMock
 from imap_tools.message import MailMessage
 from imap_tools import MailAttachment
-from mail import read_mail
+from mail import (
+    read_mail,
+    SyncState,
+    MailboxConfig,
+    load_mailbox_configs,
+    poll_mailboxes,
+)
+
+# sync state key of the mailbox configured in .env.test
+SYNC_KEY = "mail_user@localhost:993/Blog"
+
+
+def _mock_mailbox_instance(mock_mailbox, uids=(), uidvalidity=1):
+    mock_instance = MagicMock()
+    mock_mailbox.return_value.login.return_value = mock_instance
+    mock_instance.folder.status.return_value = {"UIDVALIDITY": uidvalidity}
+    mock_instance.uids.return_value = [str(uid) for uid in uids]
+    return mock_instance
+
+
+def _mock_header(uid, message_id):
+    header = MagicMock(spec=MailMessage)
+    header.uid = str(uid)
+    header.headers = {"message-id": (message_id,)}
+    return header
+
+
+def _mock_message(uid):
+    mail = MagicMock(spec=MailMessage)
+    mail.uid = str(uid)
+    mail.attachments = []
+    return mail
+
+
+class TestSyncState(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        state_path = os.path.join(self.temp_dir.name, "sync_state.json")
+        patcher = patch.object(SyncState, "M2B_SYNC_STATE_FILEPATH", state_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_last_uid_without_state(self):
+        self.assertEqual(SyncState().last_uid("Blog", 1), 0)
+
+    def test_record_uid_persists(self):
+        SyncState().record_uid("Blog", 1, 42)
+
+        sync_state = SyncState()
+        self.assertEqual(sync_state.last_uid("Blog", 1), 42)
+        self.assertEqual(sync_state.last_uid("Other", 1), 0)
+
+    def test_last_uid_with_changed_uidvalidity(self):
+        SyncState().record_uid("Blog", 1, 42)
+
+        self.assertEqual(SyncState().last_uid("Blog", 2), 0)
+
+    def test_failed_write_keeps_previous_state(self):
+        SyncState().record_uid("Blog", 1, 42)
+
+        with patch("mail.json.dump", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                SyncState().record_uid("Blog", 1, 43)
+
+        self.assertEqual(SyncState().last_uid("Blog", 1), 42)
 
 
 class TestReadMail(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.state_path = os.path.join(self.temp_dir.name, "sync_state.json")
+        patcher = patch.object(SyncState, "M2B_SYNC_STATE_FILEPATH", self.state_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     @patch("mail.MailBox")
     def test_read_mail_configuration(self, mock_mailbox):
         # Setup mock
-        mock_instance = MagicMock()
-        mock_mailbox.return_value.login.return_value = mock_instance
-        mock_instance.fetch.return_value = []
+        mock_instance = _mock_mailbox_instance(mock_mailbox)
 
         # Call function
-        result = read_mail()
+        result = list(read_mail())
 
         # Assert MailBox was called with correct default parameters
         mock_mailbox.assert_called_with("localhost", "993")
@@ -25,33 +102,44 @@ class TestReadMail(unittest.TestCase):
         # Assert folder was set correctly
         mock_instance.folder.set.assert_called_with("Blog")
 
-        # Assert fetch was called with correct parameters
-        mock_instance.fetch.assert_called_with(limit=10, reverse=True)
+        # Assert all UIDs were searched for, as nothing has been synced yet
+        self.assertEqual(str(mock_instance.uids.call_args.args[0]), "(UID 1:*)")
+
+        # Assert nothing was fetched, as there was nothing new
+        mock_instance.fetch.assert_not_called()
 
         # Assert empty result
         self.assertEqual(result, [])
 
+        # Assert the session was closed
+        mock_instance.logout.assert_called_once()
+
     @patch("mail.MailBox")
     def test_read_mail_with_messages(self, mock_mailbox):
         # Setup mock
-        mock_instance = MagicMock()
-        mock_mailbox.return_value.login.return_value = mock_instance
+        mock_instance = _mock_mailbox_instance(mock_mailbox, uids=[1, 2])
 
         # Create test mail messages with attachments
         mail1 = MagicMock(spec=MailMessage)
         attachment1 = MagicMock(spec=MailAttachment)
         attachment1.content_id = "cid1"
+        mail1.uid = "1"
         mail1.attachments = [attachment1]
 
         mail2 = MagicMock(spec=MailMessage)
         attachment2 = MagicMock(spec=MailAttachment)
         attachment2.content_id = "cid2"
+        mail2.uid = "2"
         mail2.attachments = [attachment2]
 
-        mock_instance.fetch.return_value = [mail1, mail2]
+        headers = [
+            _mock_header(1, "<1@example.com>"),
+            _mock_header(2, "<2@example.com>"),
+        ]
+        mock_instance.fetch.side_effect = [headers, [mail1, mail2]]
 
         # Call function
-        result = read_mail()
+        result = list(read_mail())
 
         # Assert result contains correct data
         self.assertEqual(len(result), 2)
@@ -66,6 +154,207 @@ class TestReadMail(unittest.TestCase):
         self.assertEqual(len(result[1][1]), 1)
         self.assertEqual(result[1][1]["cid2"], attachment2)
 
+    @patch("mail.MailBox")
+    def test_read_mail_yields_one_message_at_a_time(self, mock_mailbox):
+        # Setup mock
+        mock_instance = _mock_mailbox_instance(mock_mailbox, uids=[1, 2])
+
+        mail1 = MagicMock(spec=MailMessage)
+        mail1.uid = "1"
+        mail1.attachments = []
+        mail2 = MagicMock(spec=MailMessage)
+        mail2.uid = "2"
+        mail2.attachments = []
+
+        headers = [
+            _mock_header(1, "<1@example.com>"),
+            _mock_header(2, "<2@example.com>"),
+        ]
+        mock_instance.fetch.side_effect = [headers, iter([mail1, mail2])]
+
+        sync_state = SyncState()
+        mails = read_mail(sync_state=sync_state)
+
+        # Assert nothing is recorded until the first message has been processed
+        self.assertEqual(next(mails), (mail1, {}))
+        self.assertEqual(next(mails), (mail2, {}))
+        self.assertEqual(SyncState().last_uid(SYNC_KEY, 1), 0)
+        sync_state.processed(SYNC_KEY, "1")
+        self.assertEqual(SyncState().last_uid(SYNC_KEY, 1), 1)
+
+        # Assert closing the generator early logs out
+        mails.close()
+        mock_instance.logout.assert_called_once()
+
+    @patch("mail.MailBox")
+    def test_read_mail_does_not_pass_unprocessed_messages(self, mock_mailbox):
+        _mock_mailbox_instance(mock_mailbox, uids=[1, 2, 3]).fetch.side_effect = [
+            [_mock_header(uid, f"<{uid}@example.com>") for uid in (1, 2, 3)],
+            [_mock_message(uid) for uid in (1, 2, 3)],
+        ]
+        sync_state = SyncState()
+
+        for mail, _ in read_mail(sync_state=sync_state):
+            # the message with UID 2 failed
+            if mail.uid != "2":
+                sync_state.processed(SYNC_KEY, mail.uid)
+
+        self.assertEqual(SyncState().last_uid(SYNC_KEY, 1), 1)
+        sync_state.processed(SYNC_KEY, "2")
+        self.assertEqual(SyncState().last_uid(SYNC_KEY, 1), 3)
+
+    @patch.dict(os.environ, {"M2B_MAX_ATTEMPTS": "2"})
+    @patch("mail.MailBox")
+    def test_failing_message_is_retried_without_holding_back_new_mail(
+        self, mock_mailbox
+    ):
+        def run(new_uids, fetched_uids):
+            mock_instance = _mock_mailbox_instance(mock_mailbox, uids=new_uids)
+            mock_instance.fetch.side_effect = [
+                [_mock_header(uid, f"<{uid}@example.com>") for uid in fetched_uids],
+                [_mock_message(uid) for uid in fetched_uids],
+            ]
+            sync_state = SyncState()
+            read = []
+            for mail, _ in read_mail(sync_state=sync_state):
+                read.append(int(mail.uid))
+                # the message with UID 2 always fails
+                if mail.uid != "2":
+                    sync_state.processed(SYNC_KEY, mail.uid)
+            sync_state.finish(SYNC_KEY)
+            return read
+
+        self.assertEqual(run([1, 2, 3], [1, 2, 3]), [1, 2, 3])
+        self.assertEqual(SyncState().last_uid(SYNC_KEY, 1), 3)
+        self.assertEqual(SyncState().failed_uids(SYNC_KEY, 1), [2])
+
+        # the failed message is read again along with the new one
+        self.assertEqual(run([4], [2, 4]), [2, 4])
+        self.assertEqual(SyncState().last_uid(SYNC_KEY, 1), 4)
+        self.assertEqual(SyncState().failed_uids(SYNC_KEY, 1), [])
+
+        self.assertEqual(run([], []), [])
+
+    @patch("mail.MailBox")
+    def test_failed_message_is_not_retried_once_processed(self, mock_mailbox):
+        mock_instance = _mock_mailbox_instance(mock_mailbox, uids=[1])
+        mock_instance.fetch.side_effect = [
+            [_mock_header(1, "<1@example.com>")],
+            [_mock_message(1)],
+        ]
+        sync_state = SyncState()
+        list(read_mail(sync_state=sync_state))
+        sync_state.finish(SYNC_KEY)
+
+        mock_instance = _mock_mailbox_instance(mock_mailbox, uids=[])
+        mock_instance.fetch.side_effect = [[_mock_header(1, "<1@example.com>")]]
+        sync_state = SyncState()
+        self.assertEqual(
+            list(read_mail(sync_state=sync_state, previously_posted=lambda _: True)),
+            [],
+        )
+        sync_state.finish(SYNC_KEY)
+
+        self.assertEqual(SyncState().failed_uids(SYNC_KEY, 1), [])
+        self.assertEqual(SyncState().last_uid(SYNC_KEY, 1), 1)
+
+    @patch("mail.MailBox")
+    def test_read_mail_skips_previously_posted(self, mock_mailbox):
+        # Setup mock
+        mock_instance = _mock_mailbox_instance(mock_mailbox, uids=[1, 2])
+
+        mail2 = MagicMock(spec=MailMessage)
+        mail2.uid = "2"
+        mail2.attachments = []
+
+        headers = [
+            _mock_header(1, "<old@example.com>"),
+            _mock_header(2, "<new@example.com>"),
+        ]
+        mock_instance.fetch.side_effect = [headers, [mail2]]
+
+        # Call function
+        result = list(
+            read_mail(
+                previously_posted=lambda message_id: message_id == "<old@example.com>"
+            )
+        )
+
+        # Assert headers were fetched first, then full bodies for the new message only
+        mock_instance.fetch.assert_any_call(
+            uid_list=["1", "2"], headers_only=True, mark_seen=False, bulk=True
+        )
+        mock_instance.fetch.assert_called_with(uid_list=["2"])
+        self.assertEqual(result, [(mail2, {})])
+
+    @patch("mail.MailBox")
+    def test_read_mail_all_previously_posted(self, mock_mailbox):
+        # Setup mock
+        mock_instance = _mock_mailbox_instance(mock_mailbox, uids=[1])
+        mock_instance.fetch.return_value = [_mock_header(1, "<old@example.com>")]
+
+        # Call function
+        result = list(read_mail(previously_posted=lambda message_id: True))
+
+        # Assert no full bodies were fetched
+        mock_instance.fetch.assert_called_once()
+        self.assertEqual(result, [])
+
+    @patch("mail.MailBox")
+    def test_read_mail_resumes_after_last_uid(self, mock_mailbox):
+        with open(self.state_path, "w", encoding="utf-8") as f:
+            json.dump({SYNC_KEY: {"uidvalidity": 7, "last_uid": 5}}, f)
+
+        # "6:*" also returns the newest message when nothing newer exists
+        mock_instance = _mock_mailbox_instance(mock_mailbox, uids=[5], uidvalidity=7)
+
+        # Call function
+        result = list(read_mail())
+
+        # Assert only UIDs above the last processed one were searched and fetched
+        self.assertEqual(str(mock_instance.uids.call_args.args[0]), "(UID 6:*)")
+        mock_instance.fetch.assert_not_called()
+        self.assertEqual(result, [])
+
+    @patch("mail.MailBox")
+    def test_read_mail_rescans_on_uidvalidity_change(self, mock_mailbox):
+        with open(self.state_path, "w", encoding="utf-8") as f:
+            json.dump({SYNC_KEY: {"uidvalidity": 7, "last_uid": 5}}, f)
+
+        mock_instance = _mock_mailbox_instance(mock_mailbox, uidvalidity=8)
+
+        # Call function
+        list(read_mail())
+
+        # Assert the whole folder was searched again
+        self.assertEqual(str(mock_instance.uids.call_args.args[0]), "(UID 1:*)")
+
+    @patch("mail.MailBox")
+    @patch.dict("os.environ", {"M2B_FETCH_BATCH_SIZE": "2"})
+    def test_read_mail_in_batches(self, mock_mailbox):
+        # Setup mock
+        mock_instance = _mock_mailbox_instance(mock_mailbox, uids=[3, 1, 2])
+        mock_instance.fetch.side_effect = [
+            [_mock_header(1, "<1@example.com>"), _mock_header(2, "<2@example.com>")],
+            [],
+            [_mock_header(3, "<3@example.com>")],
+            [],
+        ]
+
+        # Call function
+        list(read_mail())
+
+        # Assert headers were fetched oldest first, in batches
+        mock_instance.fetch.assert_any_call(
+            uid_list=["1", "2"], headers_only=True, mark_seen=False, bulk=True
+        )
+        mock_instance.fetch.assert_any_call(
+            uid_list=["3"], headers_only=True, mark_seen=False, bulk=True
+        )
+
+        # Assert the highest UID was recorded
+        self.assertEqual(SyncState().last_uid(SYNC_KEY, 1), 3)
+
     @patch("mail.MailBox")
     @patch("mail.os.environ.get")
     def test_read_mail_with_custom_env_vars(self, mock_env_get, mock_mailbox):
@@ -83,12 +372,10 @@ class TestReadMail(unittest.TestCase):
         mock_env_get.side_effect = env_side_effect
 
         # Setup mailbox mock
-        mock_instance = MagicMock()
-        mock_mailbox.return_value.login.return_value = mock_instance
-        mock_instance.fetch.return_value = []
+        mock_instance = _mock_mailbox_instance(mock_mailbox)
 
         # Call function
-        read_mail()
+        list(read_mail())
 
         # Assert MailBox was called with custom parameters
         mock_mailbox.assert_called_with("custom-host.com", "1234")
@@ -99,6 +386,105 @@ class TestReadMail(unittest.TestCase):
         # Assert folder was set correctly
         mock_instance.folder.set.assert_called_with("CustomFolder")
 
+    @patch("mail.MailBox")
+    def test_read_mail_with_config(self, mock_mailbox):
+        # Setup mock
+        mock_instance = _mock_mailbox_instance(mock_mailbox)
+        config = MailboxConfig(
+            host="other-host.com",
+            port="143",
+            user="other",
+            password="secret",
+            folder="Posts",
+        )
+        sync_state = SyncState()
+        sync_state.record_uid(config.sync_key, 1, 9)
+
+        # Call function
+        list(read_mail(config=config, sync_state=sync_state))
+
+        # Assert the config and the shared sync state were used
+        mock_mailbox.assert_called_with("other-host.com", "143")
+        mock_mailbox.return_value.login.assert_called_with("other", "secret")
+        mock_instance.folder.set.assert_called_with("Posts")
+        self.assertEqual(str(mock_instance.uids.call_args.args[0]), "(UID 10:*)")
+
+
+class TestMailboxConfig(unittest.TestCase):
+    def test_from_env(self):
+        config = MailboxConfig.from_env()
+
+        self.assertEqual(config.host, "localhost")
+        self.assertEqual(config.user, "mail_user")
+        self.assertEqual(config.folder, "Blog")
+        self.assertEqual(config.assets_dir, "/path/to/your/blog/assets")
+        self.assertEqual(config.sync_key, SYNC_KEY)
+
+    def test_load_mailbox_configs(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "mailboxes.json")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(
+                    [
+                        {"host": "a.example.com", "user": "a", "post_dir": "/a"},
+                        {"host": "b.example.com", "folder": "Posts"},
+                    ],
+                    f,
+                )
+
+            configs = load_mailbox_configs(path)
+
+        self.assertEqual(
+            [config.sync_key for config in configs],
+            ["a@a.example.com:993/Blog", "@b.example.com:993/Posts"],
+        )
+        self.assertEqual(configs[0].post_dir, "/a")
+
+
+class TestPollMailboxes(unittest.TestCase):
+    def test_polls_concurrently_with_host_limit(self):
+        configs = [
+            MailboxConfig(host=host, user=str(i))
+            for i, host in enumerate(["a", "a", "a", "b"])
+        ]
+        lock = threading.Lock()
+        open_connections = {"a": 0, "b": 0}
+        max_connections = {"a": 0, "b": 0}
+        processed = []
+
+        def process_mailbox(config):
+            with lock:
+                open_connections[config.host] += 1
+                max_connections[config.host] = max(
+                    max_connections[config.host], open_connections[config.host]
+                )
+            time.sleep(0.05)
+            with lock:
+                open_connections[config.host] -= 1
+                processed.append(config.sync_key)
+
+        asyncio.run(
+            poll_mailboxes(configs, process_mailbox, max_connections_per_host=2)
+        )
+
+        self.assertEqual(len(processed), 4)
+        self.assertEqual(max_connections, {"a": 2, "b": 1})
+
+    def test_error_in_one_mailbox_is_logged(self):
+        configs = [MailboxConfig(host="a"), MailboxConfig(host="b")]
+        processed = []
+
+        def process_mailbox(config):
+            if config.host == "a":
+                raise ConnectionError("login failed")
+            processed.append(config.host)
+
+        with self.assertLogs("mail2blog", level="ERROR") as logs:
+            asyncio.run(poll_mailboxes(configs, process_mailbox))
+
+        self.assertEqual(processed, ["b"])
+        self.assertIn("@a:993/Blog", logs.output[0])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,58 +1,219 @@
 import unittest
-from unittest.mock import patch, MagicMock, mock_open
+import io
+from unittest.mock import patch, MagicMock, mock_open, ANY, call
 import json
 import os
-from main import PostManager, main
+import time
+import mailbox
+import email.policy
+import tempfile
+import datetime
+import threading
+from email.message import EmailMessage
+from imap_tools import MailMessage
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+import backends
+import converter
+from assets import AssetStore
+from fake_imap import FakeImapServer
+from jekyll import JekyllPost
+from mail import MailboxConfig, SyncState
+from main import (
+    PostManager,
+    main,
+    daemon,
+    import_archive,
+    _image_executor,
+    _image_options,
+)
 
 
 class TestPostManager(unittest.TestCase):
-    @patch(
-        "builtins.open", new_callable=mock_open, read_data='{"test_id": "test_path.md"}'
-    )
-    @patch("os.path.exists", return_value=True)
-    def test_init_with_existing_history(self, mock_exists, mock_file):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.journal_path = os.path.join(self.temp_dir.name, "post_history.jsonl")
+        self.legacy_path = os.path.join(self.temp_dir.name, "post_history.json")
+        for attribute, path in (
+            ("M2B_POST_HISTORY_FILEPATH", self.journal_path),
+            ("M2B_LEGACY_POST_HISTORY_FILEPATH", self.legacy_path),
+        ):
+            patcher = patch.object(PostManager, attribute, path)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _write_journal(self, content):
+        with open(self.journal_path, "w", encoding="utf-8") as f:
+            f.write(content)
+
+    def _read_journal(self):
+        with open(self.journal_path, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def test_init_with_existing_history(self):
+        self._write_journal('{"message_id": "test_id", "filepath": "test_path.md"}\n')
         post_manager = PostManager()
         self.assertEqual(post_manager.post_history, {"test_id": "test_path.md"})
-        mock_exists.assert_called_once_with(post_manager.M2B_POST_HISTORY_FILEPATH)
 
-    @patch("builtins.open", new_callable=mock_open)
-    @patch("os.path.exists", return_value=False)
-    def test_init_without_history(self, mock_exists, mock_file):
+    def test_init_without_history(self):
         post_manager = PostManager()
         self.assertEqual(post_manager.post_history, {})
-        mock_exists.assert_called_once_with(post_manager.M2B_POST_HISTORY_FILEPATH)
+        self.assertFalse(os.path.exists(self.journal_path))
+
+    @patch("builtins.open", new_callable=mock_open)
+    def test_init_is_lazy(self, mock_file):
+        PostManager()
+        mock_file.assert_not_called()
 
     def test_previously_posted(self):
+        self._write_journal('{"message_id": "existing_id", "filepath": "path.md"}\n')
         post_manager = PostManager()
-        post_manager.post_history = {"existing_id": "path.md"}
 
         self.assertTrue(post_manager.previously_posted("existing_id"))
         self.assertFalse(post_manager.previously_posted("new_id"))
 
-    @patch("builtins.open", new_callable=mock_open, read_data="{}")
-    @patch("json.dump")
-    def test_record_posting(self, mock_json_dump, mock_file):
-        """Test that record_posting correctly updates post_history and saves it to file."""
+    def test_record_posting(self):
+        """Test that record_posting updates post_history and appends to the journal."""
+        self._write_journal('{"message_id": "old_id", "filepath": "old_path.md"}\n')
+        post_manager = PostManager()
+
+        with patch("main.os.fsync") as mock_fsync:
+            post_manager.record_posting("new_id", "new_path.md")
+
+        self.assertEqual(
+            post_manager.post_history,
+            {"old_id": "old_path.md", "new_id": "new_path.md"},
+        )
+        self.assertEqual(
+            self._read_journal(),
+            [
+                {"message_id": "old_id", "filepath": "old_path.md"},
+                {"message_id": "new_id", "filepath": "new_path.md"},
+            ],
+        )
+        mock_fsync.assert_called_once()
+        self.assertEqual(
+            PostManager().post_history,
+            {"old_id": "old_path.md", "new_id": "new_path.md"},
+        )
+
+    def test_migrates_legacy_history(self):
+        with open(self.legacy_path, "w", encoding="utf-8") as f:
+            json.dump({"test_id": "test_path.md"}, f)
+
         post_manager = PostManager()
-        post_manager.post_history = {}
 
+        self.assertEqual(post_manager.post_history, {"test_id": "test_path.md"})
+        self.assertEqual(
+            self._read_journal(),
+            [{"message_id": "test_id", "filepath": "test_path.md"}],
+        )
+
+    def test_drops_incomplete_last_record(self):
+        self._write_journal(
+            '{"message_id": "test_id", "filepath": "test_path.md"}\n{"message_id": "cut'
+        )
+
+        post_manager = PostManager()
         post_manager.record_posting("new_id", "new_path.md")
 
-        self.assertEqual(post_manager.post_history, {"new_id": "new_path.md"})
-        # Check that one of the calls to open was with the correct write parameters
-        mock_file.assert_any_call(
-            post_manager.M2B_POST_HISTORY_FILEPATH, "w", encoding="utf-8"
+        self.assertEqual(
+            self._read_journal(),
+            [
+                {"message_id": "test_id", "filepath": "test_path.md"},
+                {"message_id": "new_id", "filepath": "new_path.md"},
+            ],
+        )
+
+    def test_compacts_journal(self):
+        self._write_journal(
+            '{"message_id": "test_id", "filepath": "first.md"}\n'
+            '{"message_id": "test_id", "filepath": "second.md"}\n'
+            '{"message_id": "test_id", "filepath": "third.md"}\n'
+        )
+
+        post_manager = PostManager()
+
+        self.assertEqual(post_manager.post_history, {"test_id": "third.md"})
+        self.assertEqual(
+            self._read_journal(), [{"message_id": "test_id", "filepath": "third.md"}]
+        )
+
+    def test_batch_mode_commits_every_batch_size_records(self):
+        post_manager = PostManager(batch_size=2)
+
+        post_manager.record_posting("id1", "1.md")
+        self.assertFalse(os.path.exists(self.journal_path))
+        self.assertTrue(post_manager.previously_posted("id1"))
+        post_manager.record_posting("id2", "2.md")
+        self.assertEqual(len(self._read_journal()), 2)
+        post_manager.record_posting("id3", "3.md")
+        self.assertEqual(len(self._read_journal()), 2)
+        post_manager.close()
+
+        self.assertEqual(len(self._read_journal()), 3)
+        self.assertFalse(os.path.exists(self.journal_path + ".pending"))
+
+    def test_batch_mode_commits_after_batch_seconds(self):
+        post_manager = PostManager(batch_size=100, batch_seconds=0.05)
+
+        post_manager.record_posting("id1", "1.md")
+        time.sleep(0.1)
+        post_manager.record_posting("id2", "2.md")
+
+        self.assertEqual(len(self._read_journal()), 2)
+
+    def _save_post(self, post_dir, title, message_id):
+        return JekyllPost(
+            title=title, date=datetime.datetime(2023, 1, 1), message_id=message_id
+        ).save(post_dir)
+
+    def test_reconcile_records_posts_of_a_crashed_batch(self):
+        post_dir = os.path.join(self.temp_dir.name, "_posts")
+        os.mkdir(post_dir)
+        crashed = PostManager(batch_size=10)
+        crashed.record_posting("id1", self._save_post(post_dir, "One", "id1"))
+        crashed.commit()
+        # saved, but the run crashed before committing it
+        lost_path = self._save_post(post_dir, "Two", "id2")
+        crashed.record_posting("id2", lost_path)
+
+        post_manager = PostManager()
+        with self.assertLogs("mail2blog", level="WARNING"):
+            self.assertEqual(post_manager.reconcile(post_dir), 1)
+        self.assertEqual(post_manager.reconcile(post_dir), 0)
+        post_manager.close()
+
+        self.assertEqual(
+            self._read_journal()[-1], {"message_id": "id2", "filepath": lost_path}
         )
-        mock_json_dump.assert_called_once()
+        self.assertFalse(os.path.exists(self.journal_path + ".pending"))
+        self.assertEqual(PostManager().reconcile(post_dir), 0)
+
+    def test_reconcile_skips_scan_after_clean_run(self):
+        post_manager = PostManager(batch_size=10)
+        post_manager.record_posting("id1", "1.md")
+        post_manager.close()
+
+        with patch("main.os.scandir") as mock_scandir:
+            self.assertEqual(PostManager().reconcile("_posts"), 0)
+        mock_scandir.assert_not_called()
 
 
 class TestMain(unittest.TestCase):
     @patch("main.mail.read_mail")
     @patch("main.PostManager")
+    @patch("main.AssetStore")
     @patch("main.converter.html_to_blog_md")
-    @patch("main.JekyllPost")
+    @patch("backends.JekyllBackend.post_class")
     def test_main_processes_new_emails(
-        self, mock_jekyll_post, mock_converter, mock_post_manager, mock_read_mail
+        self,
+        mock_jekyll_post,
+        mock_converter,
+        mock_asset_store,
+        mock_post_manager,
+        mock_read_mail,
     ):
         # Setup mocks
         mock_post_manager_instance = MagicMock()
@@ -63,6 +224,7 @@ class TestMain(unittest.TestCase):
         mock_mail_message.subject = "Test Subject"
         mock_mail_message.headers = {"message-id": ["test_id"]}
         mock_mail_message.html = "<p>Test content</p>"
+        mock_mail_message.text = "Test content"
         mock_mail_message.from_values.name = "Test Author"
         mock_mail_message.date = "2023-01-01"
 
@@ -76,17 +238,44 @@ class TestMain(unittest.TestCase):
         mock_jekyll_post.return_value = mock_jekyll_post_instance
 
         # Call the main function
-        with patch.dict("os.environ", {"M2B_BLOG_POST_DIR": "/blog/posts"}):
+        env = {
+            "M2B_BLOG_POST_DIR": "/blog/posts",
+            "M2B_BLOG_ASSETS_DIR": "/path/to/your/blog/assets",
+        }
+        with patch.dict("os.environ", env):
             main()
 
         # Assertions
-        mock_post_manager_instance.previously_posted.assert_called_once_with("test_id")
-        mock_converter.assert_called_once_with("<p>Test content</p>", mock_attachments)
+        mock_read_mail.assert_called_once_with(
+            previously_posted=mock_post_manager_instance.previously_posted,
+            config=ANY,
+            sync_state=ANY,
+        )
+        self.assertEqual(mock_read_mail.call_args.kwargs["config"].folder, "Blog")
+        # checked before converting, and again before saving
+        self.assertEqual(
+            mock_post_manager_instance.previously_posted.call_args_list,
+            [call("test_id"), call("test_id")],
+        )
+        mock_converter.assert_called_once_with(
+            "<p>Test content</p>",
+            mock_attachments,
+            executor=None,
+            asset_store=mock_asset_store.return_value,
+            policy=ANY,
+            image_widths=(),
+            image_formats=(),
+            gif_format=None,
+            assets_dir="/path/to/your/blog/assets",
+            asset_url=backends.asset_placeholder,
+            text="Test content",
+        )
         mock_jekyll_post.assert_called_once_with(
             title="Test Subject",
             author="Test Author",
             date="2023-01-01",
             content="Converted markdown content",
+            message_id="test_id",
         )
         mock_jekyll_post_instance.save.assert_called_once_with(directory="/blog/posts")
         mock_post_manager_instance.record_posting.assert_called_once_with(
@@ -95,10 +284,16 @@ class TestMain(unittest.TestCase):
 
     @patch("main.mail.read_mail")
     @patch("main.PostManager")
+    @patch("main.AssetStore")
     @patch("main.converter.html_to_blog_md")
-    @patch("main.JekyllPost")
+    @patch("backends.JekyllBackend.post_class")
     def test_main_skips_previously_posted(
-        self, mock_jekyll_post, mock_converter, mock_post_manager, mock_read_mail
+        self,
+        mock_jekyll_post,
+        mock_converter,
+        mock_asset_store,
+        mock_post_manager,
+        mock_read_mail,
     ):
         # Setup mocks
         mock_post_manager_instance = MagicMock()
@@ -120,6 +315,466 @@ class TestMain(unittest.TestCase):
         mock_jekyll_post.assert_not_called()
         mock_post_manager_instance.record_posting.assert_not_called()
 
+    @patch("main.mail.read_mail")
+    @patch("main.PostManager")
+    @patch("main.AssetStore")
+    @patch("main.converter.html_to_blog_md")
+    @patch("backends.JekyllBackend.post_class")
+    @patch.dict("os.environ", {"M2B_PIPELINE_WORKERS": "2"})
+    def test_main_pipelined(
+        self,
+        mock_jekyll_post,
+        mock_converter,
+        mock_asset_store,
+        mock_post_manager,
+        mock_read_mail,
+    ):
+        # Setup mocks
+        mock_post_manager_instance = MagicMock()
+        mock_post_manager_instance.previously_posted.side_effect = (
+            lambda message_id: message_id == "old_id"
+        )
+        mock_post_manager.return_value = mock_post_manager_instance
+
+        messages = []
+        for message_id in ("id1", "old_id", "id2", "id3"):
+            mock_mail_message = MagicMock()
+            mock_mail_message.headers = {"message-id": [message_id]}
+            messages.append((mock_mail_message, {}))
+        mock_read_mail.return_value = iter(messages)
+        mock_converter.return_value = "Converted markdown content"
+
+        mock_jekyll_post.return_value.save.side_effect = [
+            "/path/to/post1.md",
+            OSError("disk full"),
+            "/path/to/post3.md",
+        ]
+
+        # Call the main function
+        with self.assertLogs("mail2blog") as logs:
+            main()
+
+        # Assertions
+        self.assertEqual(mock_converter.call_count, 3)
+        self.assertEqual(mock_jekyll_post.return_value.save.call_count, 3)
+        recorded = {
+            call.args
+            for call in mock_post_manager_instance.record_posting.call_args_list
+        }
+        self.assertEqual(len(recorded), 2)
+        self.assertTrue(
+            any("Pipeline stage convert: 4 items" in line for line in logs.output)
+        )
+
+    @patch("main.mail.read_mail")
+    @patch("main.mail.load_mailbox_configs")
+    @patch("main.PostManager")
+    @patch("main.AssetStore")
+    @patch("main.converter.html_to_blog_md")
+    @patch("backends.JekyllBackend.post_class")
+    @patch.dict("os.environ", {"M2B_MAILBOXES_CONFIG": "/path/to/mailboxes.json"})
+    def test_main_with_many_mailboxes(
+        self,
+        mock_jekyll_post,
+        mock_converter,
+        mock_asset_store,
+        mock_post_manager,
+        mock_load_configs,
+        mock_read_mail,
+    ):
+        # Setup mocks
+        mock_post_manager.return_value.previously_posted.return_value = False
+        mock_load_configs.return_value = [
+            MailboxConfig(host="a", post_dir="/a/_posts", assets_dir="/a/assets"),
+            MailboxConfig(host="b", post_dir="/b/_posts", assets_dir="/b/assets"),
+        ]
+
+        def read_mail(previously_posted, config, sync_state):
+            mock_mail_message = MagicMock()
+            mock_mail_message.headers = {"message-id": [config.host]}
+            return [(mock_mail_message, {})]
+
+        mock_read_mail.side_effect = read_mail
+        mock_converter.return_value = "Converted markdown content"
+
+        # Call the main function
+        main()
+
+        # Assertions
+        mock_load_configs.assert_called_once_with("/path/to/mailboxes.json")
+        self.assertEqual(
+            sorted(call.kwargs["assets_dir"] for call in mock_converter.call_args_list),
+            ["/a/assets", "/b/assets"],
+        )
+        self.assertEqual(
+            sorted(
+                call.kwargs["directory"]
+                for call in mock_jekyll_post.return_value.save.call_args_list
+            ),
+            ["/a/_posts", "/b/_posts"],
+        )
+        # all mailboxes share one sync state
+        sync_states = {
+            id(call.kwargs["sync_state"]) for call in mock_read_mail.call_args_list
+        }
+        self.assertEqual(len(sync_states), 1)
+
+    @patch.dict("os.environ", {"M2B_IMAGE_WORKERS": "2"})
+    def test_image_executor_with_workers(self):
+        with _image_executor() as executor:
+            self.assertIsInstance(executor, ProcessPoolExecutor)
+            # forked workers could inherit locks held by other threads
+            self.assertNotEqual(executor._mp_context.get_start_method(), "fork")
+            self.assertEqual(executor.submit(abs, -1).result(), 1)
+
+    @patch.dict("os.environ", {"M2B_IMAGE_WORKERS": "1"})
+    def test_image_executor_single_worker(self):
+        with _image_executor() as executor:
+            self.assertIsNone(executor)
+
+    @patch.dict(
+        "os.environ",
+        {"M2B_IMAGE_WIDTHS": "320, 600,1200", "M2B_IMAGE_FORMATS": "WebP,bmp,"},
+    )
+    def test_image_options(self):
+        self.assertEqual(
+            _image_options(),
+            {
+                "image_widths": (320, 600, 1200),
+                "image_formats": ("webp",),
+                "gif_format": None,
+            },
+        )
+
+    @patch.dict(
+        "os.environ",
+        {"M2B_IMAGE_WIDTHS": "", "M2B_IMAGE_FORMATS": "", "M2B_GIF_FORMAT": ""},
+    )
+    def test_image_options_unset(self):
+        self.assertEqual(
+            _image_options(),
+            {"image_widths": (), "image_formats": (), "gif_format": None},
+        )
+
+    @patch("main.shutil.which", return_value=None)
+    def test_gif_format_falls_back_without_ffmpeg(self, mock_which):
+        for name, expected in [("MP4", "webp"), ("bmp", None)]:
+            with patch.dict("os.environ", {"M2B_GIF_FORMAT": name}):
+                with self.assertLogs("mail2blog", level="WARNING"):
+                    self.assertEqual(_image_options()["gif_format"], expected)
+
+        mock_which.return_value = "/usr/bin/ffmpeg"
+        with patch.dict("os.environ", {"M2B_GIF_FORMAT": "webm"}):
+            self.assertEqual(_image_options()["gif_format"], "webm")
+
+
+def _raw_message(number):
+    message = EmailMessage(policy=email.policy.SMTP)
+    message["Subject"] = f"Post {number}"
+    message["From"] = "Test Author <author@example.com>"
+    message["Date"] = "Sun, 01 Jan 2023 12:00:00 +0000"
+    message["Message-ID"] = f"<{number}@example.com>"
+    message.set_content(f"<p>Content {number}</p>", subtype="html")
+    return message.as_bytes()
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.post_dir = os.path.join(self.temp_dir.name, "_posts")
+        os.mkdir(self.post_dir)
+        for target, attribute, filename in (
+            (PostManager, "M2B_POST_HISTORY_FILEPATH", "post_history.jsonl"),
+            (PostManager, "M2B_LEGACY_POST_HISTORY_FILEPATH", "post_history.json"),
+            (SyncState, "M2B_SYNC_STATE_FILEPATH", "sync_state.json"),
+            (AssetStore, "M2B_ASSET_INDEX_FILEPATH", "asset_index.jsonl"),
+            (AssetStore, "M2B_LEGACY_ASSET_INDEX_FILEPATH", "asset_index.json"),
+        ):
+            patcher = patch.object(
+                target, attribute, os.path.join(self.temp_dir.name, filename)
+            )
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch("main.RECONNECT_MIN_DELAY", 0.05)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _start_daemon(self, server, **env):
+        env = {
+            "M2B_IMAP_HOST": "127.0.0.1",
+            "M2B_IMAP_PORT": str(server.port),
+            "M2B_IMAP_SSL": "0",
+            "M2B_MAILBOX_USER": "user",
+            "M2B_MAILBOX_PASS": "pass",
+            "M2B_BLOG_POST_DIR": self.post_dir,
+            "M2B_IDLE_TIMEOUT": "5",
+            **env,
+        }
+        patcher = patch.dict("os.environ", env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        stop_event = threading.Event()
+        thread = threading.Thread(target=daemon, args=(stop_event,))
+        thread.start()
+
+        def stop():
+            stop_event.set()
+            # wake the daemon up from IDLE
+            server.add_message(_raw_message(0))
+            thread.join(timeout=10)
+
+        self.addCleanup(stop)
+
+    def _wait_for_posts(self, count, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            # posts being written are hidden temporary files
+            posts = sorted(
+                name for name in os.listdir(self.post_dir) if not name.startswith(".")
+            )
+            if len(posts) >= count:
+                return posts
+            time.sleep(0.02)
+        self.fail(f"expected {count} posts, found {os.listdir(self.post_dir)}")
+
+    def _assert_failed_conversion_is_retried(self, pipeline_workers):
+        html_to_blog_md = converter.html_to_blog_md
+        failed = []
+
+        def convert(html, *args, **kwargs):
+            # the first email fails the first time only
+            if "Content 1" in html and not failed:
+                failed.append(html)
+                raise OSError("disk full")
+            return html_to_blog_md(html, *args, **kwargs)
+
+        with FakeImapServer([_raw_message(1), _raw_message(2)]) as server:
+            env = {
+                "M2B_IMAP_HOST": "127.0.0.1",
+                "M2B_IMAP_PORT": str(server.port),
+                "M2B_IMAP_SSL": "0",
+                "M2B_MAILBOX_USER": "user",
+                "M2B_MAILBOX_PASS": "pass",
+                "M2B_BLOG_POST_DIR": self.post_dir,
+                "M2B_PIPELINE_WORKERS": pipeline_workers,
+            }
+            with patch.dict("os.environ", env):
+                with patch("converter.html_to_blog_md", side_effect=convert):
+                    with self.assertLogs("mail2blog", level="ERROR"):
+                        main()
+                self.assertEqual(os.listdir(self.post_dir), ["2023-01-01-post-2.md"])
+
+                main()
+
+        self.assertEqual(
+            sorted(os.listdir(self.post_dir)),
+            ["2023-01-01-post-1.md", "2023-01-01-post-2.md"],
+        )
+
+    def test_failed_conversion_is_retried_on_the_next_run(self):
+        self._assert_failed_conversion_is_retried(pipeline_workers="0")
+
+    def test_failed_conversion_is_retried_on_the_next_run_pipelined(self):
+        self._assert_failed_conversion_is_retried(pipeline_workers="2")
+
+    def test_daemon_picks_up_new_mail_with_idle(self):
+        with FakeImapServer([_raw_message(1)]) as server:
+            self._start_daemon(server)
+            self._wait_for_posts(1)
+
+            start = time.monotonic()
+            server.add_message(_raw_message(2))
+            posts = self._wait_for_posts(2)
+
+            # IDLE delivers the message well before the IDLE timeout
+            self.assertLess(time.monotonic() - start, 2)
+            self.assertEqual(posts, ["2023-01-01-post-1.md", "2023-01-01-post-2.md"])
+            self.assertEqual(server.logins, 1)
+
+    def test_daemon_reconnects_after_connection_drop(self):
+        with FakeImapServer([_raw_message(1)]) as server:
+            self._start_daemon(server)
+            self._wait_for_posts(1)
+
+            with self.assertLogs("mail2blog", level="ERROR"):
+                server.drop_connections()
+                server.add_message(_raw_message(2))
+                self._wait_for_posts(2)
+
+            self.assertEqual(server.logins, 2)
+
+    def test_daemon_polls_without_idle(self):
+        with FakeImapServer([_raw_message(1)], idle=False) as server:
+            self._start_daemon(server, M2B_POLL_INTERVAL="0.1")
+            self._wait_for_posts(1)
+
+            server.add_message(_raw_message(2))
+
+            self._wait_for_posts(2)
+            self.assertEqual(server.logins, 1)
+
+
+class TestImportArchive(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.post_dir = os.path.join(self.temp_dir.name, "_posts")
+        os.mkdir(self.post_dir)
+        for target, attribute, filename in (
+            (PostManager, "M2B_POST_HISTORY_FILEPATH", "post_history.jsonl"),
+            (PostManager, "M2B_LEGACY_POST_HISTORY_FILEPATH", "post_history.json"),
+            (AssetStore, "M2B_ASSET_INDEX_FILEPATH", "asset_index.jsonl"),
+            (AssetStore, "M2B_LEGACY_ASSET_INDEX_FILEPATH", "asset_index.json"),
+        ):
+            patcher = patch.object(
+                target, attribute, os.path.join(self.temp_dir.name, filename)
+            )
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.dict("os.environ", {"M2B_BLOG_POST_DIR": self.post_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_import_mbox_posts_each_email_once(self):
+        mbox_path = os.path.join(self.temp_dir.name, "archive.mbox")
+        archive_mbox = mailbox.mbox(mbox_path)
+        for number in (1, 2, 3):
+            archive_mbox.add(_raw_message(number))
+        archive_mbox.close()
+
+        with self.assertLogs("mail2blog", level="INFO") as logs:
+            import_archive(mbox_path)
+        import_archive(mbox_path)
+
+        self.assertEqual(
+            sorted(os.listdir(self.post_dir)),
+            [f"2023-01-01-post-{number}.md" for number in (1, 2, 3)],
+        )
+        self.assertTrue(
+            any("Read 3 emails" in message for message in logs.output), logs.output
+        )
+
+    def test_import_posts_duplicate_messages_once(self):
+        mbox_path = os.path.join(self.temp_dir.name, "archive.mbox")
+        archive_mbox = mailbox.mbox(mbox_path)
+        for _ in range(4):
+            archive_mbox.add(_raw_message(1))
+        archive_mbox.close()
+        html_to_blog_md = converter.html_to_blog_md
+
+        def slow_convert(*args, **kwargs):
+            # keep every copy in flight at once
+            time.sleep(0.1)
+            return html_to_blog_md(*args, **kwargs)
+
+        with patch.dict("os.environ", {"M2B_PIPELINE_WORKERS": "4"}), patch(
+            "converter.html_to_blog_md", side_effect=slow_convert
+        ):
+            import_archive(mbox_path)
+
+        self.assertEqual(os.listdir(self.post_dir), ["2023-01-01-post-1.md"])
+
+    def test_import_writes_manifest_of_new_posts(self):
+        mbox_path = os.path.join(self.temp_dir.name, "archive.mbox")
+        archive_mbox = mailbox.mbox(mbox_path)
+        archive_mbox.add(_raw_message(1))
+        archive_mbox.close()
+        manifest_path = os.path.join(self.temp_dir.name, "manifest.json")
+
+        with patch.dict("os.environ", {"M2B_MANIFEST_PATH": manifest_path}):
+            import_archive(mbox_path)
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                first_run = json.load(f)["files"]
+            import_archive(mbox_path)
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                second_run = json.load(f)["files"]
+
+        self.assertEqual(
+            [(entry["path"], entry["kind"]) for entry in first_run],
+            [(os.path.join(self.post_dir, "2023-01-01-post-1.md"), "post")],
+        )
+        self.assertEqual(second_run, [])
+
+    def test_failed_import_writes_manifest_of_saved_posts(self):
+        manifest_path = os.path.join(self.temp_dir.name, "manifest.json")
+
+        def read_archive(path, progress):
+            yield MailMessage.from_bytes(_raw_message(1)), {}
+            raise OSError("archive truncated")
+
+        with patch.dict(
+            "os.environ",
+            {"M2B_MANIFEST_PATH": manifest_path, "M2B_PIPELINE_WORKERS": "0"},
+        ), patch("main.archive.read_archive", side_effect=read_archive):
+            with self.assertRaises(OSError):
+                import_archive("archive.mbox")
+
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            files = json.load(f)["files"]
+        self.assertEqual(
+            [entry["path"] for entry in files],
+            [os.path.join(self.post_dir, "2023-01-01-post-1.md")],
+        )
+
+    def test_import_to_many_sites_converts_images_once(self):
+        message = EmailMessage(policy=email.policy.SMTP)
+        message["Subject"] = "Photo"
+        message["From"] = "Test Author <author@example.com>"
+        message["Date"] = "Sun, 01 Jan 2023 12:00:00 +0000"
+        message["Message-ID"] = "<photo@example.com>"
+        message.set_content('<p><img src="cid:photo1"></p>', subtype="html")
+        buf = io.BytesIO()
+        Image.new("RGB", (20, 10), "red").save(buf, "PNG")
+        message.add_related(
+            buf.getvalue(), "image", "png", cid="<photo1>", filename="photo.png"
+        )
+        mbox_path = os.path.join(self.temp_dir.name, "archive.mbox")
+        archive_mbox = mailbox.mbox(mbox_path)
+        archive_mbox.add(message.as_bytes())
+        archive_mbox.close()
+        sites = []
+        for generator in ("jekyll", "hugo"):
+            site_dir = os.path.join(self.temp_dir.name, generator)
+            sites.append(
+                {
+                    "generator": generator,
+                    "post_dir": os.path.join(site_dir, "posts"),
+                    "assets_dir": os.path.join(site_dir, "images"),
+                }
+            )
+            os.makedirs(sites[-1]["post_dir"])
+            os.makedirs(sites[-1]["assets_dir"])
+        sites_path = os.path.join(self.temp_dir.name, "sites.json")
+        with open(sites_path, "w", encoding="utf-8") as f:
+            json.dump(sites, f)
+
+        with patch.dict("os.environ", {"M2B_BLOG_SITES_CONFIG": sites_path}):
+            with patch("converter._convert_image_to_jpeg") as convert_image:
+                convert_image.side_effect = lambda payload, path: open(
+                    path, "wb"
+                ).close()
+                import_archive(mbox_path)
+
+        convert_image.assert_called_once()
+        jekyll_asset, hugo_asset = (
+            os.path.join(site["assets_dir"], "photo1.photo.png.jpeg") for site in sites
+        )
+        self.assertTrue(os.path.samefile(jekyll_asset, hugo_asset))
+        with open(os.path.join(sites[0]["post_dir"], "2023-01-01-photo.md")) as f:
+            self.assertIn(
+                "![]({{ site.baseurl }}/images/photo1.photo.png.jpeg)", f.read()
+            )
+        with open(os.path.join(sites[1]["post_dir"], "2023-01-01-photo.md")) as f:
+            post = f.read()
+        self.assertIn('slug: "2023-01-01-photo"', post)
+        self.assertIn("![](/images/photo1.photo.png.jpeg)", post)
+        with open(PostManager.M2B_POST_HISTORY_FILEPATH, "r") as f:
+            self.assertEqual(
+                json.loads(f.read())["filepath"],
+                os.path.join(sites[0]["post_dir"], "2023-01-01-photo.md"),
+            )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+import os
+import json
+import hashlib
+import tempfile
+from unittest.mock import patch
+from manifest import Manifest
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.manifest_path = os.path.join(self.temp_dir.name, "manifest.json")
+        env = {
+            "M2B_MANIFEST_PATH": self.manifest_path,
+            "M2B_REBUILD_COMMAND": "make rebuild",
+        }
+        patcher = patch.dict("os.environ", env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch("manifest.subprocess.run")
+        self.mock_run = patcher.start()
+        self.mock_run.return_value.returncode = 0
+        self.addCleanup(patcher.stop)
+
+    def _write(self, filename, data):
+        path = os.path.join(self.temp_dir.name, filename)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def _read_manifest(self):
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def test_finish_lists_files_and_rebuilds(self):
+        manifest = Manifest()
+        post_path = self._write("post.md", b"# Post")
+        asset_path = self._write("cat.jpeg", b"jpeg")
+        manifest.add(post_path, "post")
+        manifest.add(asset_path, "asset")
+        manifest.add(post_path, "post")
+
+        manifest.finish()
+
+        self.assertEqual(
+            self._read_manifest()["files"],
+            [
+                {
+                    "path": asset_path,
+                    "kind": "asset",
+                    "sha256": hashlib.sha256(b"jpeg").hexdigest(),
+                    "size": 4,
+                },
+                {
+                    "path": post_path,
+                    "kind": "post",
+                    "sha256": hashlib.sha256(b"# Post").hexdigest(),
+                    "size": 6,
+                },
+            ],
+        )
+        self.mock_run.assert_called_once_with("make rebuild", shell=True)
+
+    def test_run_without_changes_does_not_rebuild(self):
+        manifest = Manifest()
+        manifest.add(self._write("post.md", b"# Post"), "post")
+        manifest.finish()
+
+        manifest.finish()
+
+        self.assertEqual(self._read_manifest()["files"], [])
+        self.mock_run.assert_called_once()
+
+    def test_failed_rebuild_is_logged(self):
+        manifest = Manifest()
+        manifest.add(self._write("post.md", b"# Post"), "post")
+        self.mock_run.return_value.returncode = 2
+
+        with self.assertLogs("mail2blog", level="ERROR"):
+            manifest.finish()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,157 @@
+import unittest
+import io
+import os
+import json
+import pstats
+import tempfile
+from unittest.mock import patch
+from PIL import Image
+import metrics
+from metrics import Metrics
+from converter import _convert_image_to_jpeg
+
+
+class TestMetrics(unittest.TestCase):
+    def test_stage_totals_calls_time_and_bytes(self):
+        stages = Metrics()
+
+        with stages.stage("fetch", 100):
+            pass
+        with stages.stage("fetch") as measurement:
+            measurement.bytes += 50
+
+        totals = stages.snapshot()["fetch"]
+        self.assertEqual(totals["calls"], 2)
+        self.assertEqual(totals["bytes"], 150)
+        self.assertGreater(totals["seconds"], 0)
+        self.assertGreaterEqual(totals["peak_rss_growth_bytes"], 0)
+
+    def test_stage_is_recorded_when_block_fails(self):
+        stages = Metrics()
+
+        with self.assertRaises(ValueError):
+            with stages.stage("parse", 10):
+                raise ValueError("bad input")
+
+        self.assertEqual(stages.snapshot()["parse"]["calls"], 1)
+
+    def test_iterate_measures_each_item(self):
+        stages = Metrics()
+
+        items = list(stages.iterate("fetch", [b"ab", b"cde"], size=len))
+
+        self.assertEqual(items, [b"ab", b"cde"])
+        totals = stages.snapshot()["fetch"]
+        # the final call, finding no more items, is measured too
+        self.assertEqual((totals["calls"], totals["bytes"]), (3, 5))
+
+    def test_merge_adds_totals(self):
+        stages = Metrics()
+        stages.add("image_encode", calls=1, seconds=0.5, bytes=10)
+
+        stages.merge(
+            {"image_encode": {"calls": 2, "seconds": 1.0, "bytes": 20}, "other": {}}
+        )
+
+        totals = stages.snapshot()["image_encode"]
+        self.assertEqual((totals["calls"], totals["seconds"]), (3, 1.5))
+        self.assertEqual(totals["bytes"], 30)
+        self.assertIn("other", stages.snapshot())
+
+    def test_measured_returns_result_and_stages_of_the_call(self):
+        metrics.METRICS.add("earlier", calls=1)
+
+        def convert(value):
+            with metrics.stage("convert", value):
+                return value * 2
+
+        result, stages = metrics.measured(convert, 21)
+
+        self.assertEqual(result, 42)
+        self.assertEqual(list(stages), ["convert"])
+        self.assertEqual(stages["convert"]["bytes"], 21)
+
+    def test_image_conversion_stages(self):
+        buf = io.BytesIO()
+        Image.new("RGB", (1200, 800), "red").save(buf, "JPEG")
+        metrics.METRICS.reset()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            _convert_image_to_jpeg(buf.getvalue(), os.path.join(temp_dir, "out.jpeg"))
+            output_size = os.path.getsize(os.path.join(temp_dir, "out.jpeg"))
+
+        stages = metrics.METRICS.snapshot()
+        self.assertEqual(list(stages), ["image_decode", "image_resize", "image_encode"])
+        self.assertEqual(stages["image_decode"]["bytes"], len(buf.getvalue()))
+        self.assertEqual(stages["image_encode"]["bytes"], output_size)
+
+
+class TestMetricsOutput(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.jsonl_path = os.path.join(self.temp_dir.name, "metrics.jsonl")
+        self.prometheus_path = os.path.join(self.temp_dir.name, "mail2blog.prom")
+        env = {
+            "M2B_METRICS_JSONL": self.jsonl_path,
+            "M2B_METRICS_PROMETHEUS": self.prometheus_path,
+        }
+        patcher = patch.dict("os.environ", env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_write_outputs_totals(self):
+        stages = Metrics()
+        stages.add("fetch", calls=2, seconds=0.25, bytes=2048)
+
+        with self.assertLogs("mail2blog", level="INFO"):
+            stages.write()
+
+        with open(self.jsonl_path, "r", encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["stage"], "fetch")
+        self.assertEqual(records[0]["calls"], 2)
+        self.assertEqual(records[0]["bytes"], 2048)
+        with open(self.prometheus_path, "r", encoding="utf-8") as f:
+            prometheus = f.read()
+        self.assertIn("# TYPE mail2blog_stage_seconds_total counter\n", prometheus)
+        self.assertIn('mail2blog_stage_seconds_total{stage="fetch"} 0.25\n', prometheus)
+        self.assertIn('mail2blog_stage_bytes_total{stage="fetch"} 2048\n', prometheus)
+        self.assertIn("mail2blog_peak_rss_bytes ", prometheus)
+        self.assertEqual(os.listdir(self.temp_dir.name).count("mail2blog.prom"), 1)
+
+    def test_write_skips_unchanged_metrics(self):
+        stages = Metrics()
+        stages.add("fetch", calls=1)
+        stages.write()
+
+        stages.write()
+        stages.add("fetch", calls=1)
+        stages.write()
+
+        with open(self.jsonl_path, "r", encoding="utf-8") as f:
+            calls = [json.loads(line)["calls"] for line in f]
+        self.assertEqual(calls, [1, 2])
+
+
+class TestCapture(unittest.TestCase):
+    def test_capture_saves_profile_and_allocations(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            profile_path = os.path.join(temp_dir, "run.prof")
+            tracemalloc_path = os.path.join(temp_dir, "run.tracemalloc")
+
+            with metrics.capture(profile_path, tracemalloc_path):
+                data = [bytes(1000) for _ in range(100)]
+
+            stats = pstats.Stats(profile_path)
+            self.assertTrue(stats.stats)
+            with open(tracemalloc_path, "r", encoding="utf-8") as f:
+                self.assertTrue(f.readline().startswith("Peak traced memory: "))
+        self.assertEqual(len(data), 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
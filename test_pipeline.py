@@ -0,0 +1,92 @@
+import unittest
+import time
+import threading
+from pipeline import run_pipeline, StageStats
+
+
+class TestStageStats(unittest.TestCase):
+    def test_counts_items_and_throughput(self):
+        stats = StageStats("convert")
+        stats.add(0.5)
+        stats.add(1.5)
+
+        self.assertEqual(stats.items, 2)
+        self.assertEqual(stats.busy_seconds, 2.0)
+        self.assertEqual(stats.items_per_second, 1.0)
+        self.assertEqual(str(stats), "convert: 2 items in 2.00s (1.00 items/s)")
+
+    def test_throughput_without_items(self):
+        self.assertEqual(StageStats("save").items_per_second, 0.0)
+
+
+class TestRunPipeline(unittest.TestCase):
+    def test_processes_all_items(self):
+        saved = []
+        save_threads = set()
+
+        def save(result):
+            save_threads.add(threading.current_thread())
+            saved.append(result)
+
+        stats = run_pipeline(
+            range(20),
+            convert=lambda item: None if item % 5 == 0 else item * 2,
+            save=save,
+            workers=3,
+            queue_size=2,
+        )
+
+        self.assertEqual(
+            sorted(saved), [item * 2 for item in range(20) if item % 5 != 0]
+        )
+        # saves are serialised in the calling thread
+        self.assertEqual(save_threads, {threading.current_thread()})
+        self.assertEqual(stats["fetch"].items, 20)
+        self.assertEqual(stats["convert"].items, 20)
+        self.assertEqual(stats["save"].items, 16)
+
+    def test_saves_in_fetch_order(self):
+        saved = []
+
+        def convert(item):
+            # earlier items take longer to convert
+            time.sleep((10 - item) * 0.005)
+            return item
+
+        run_pipeline(range(10), convert, saved.append, workers=4, queue_size=2)
+
+        self.assertEqual(saved, list(range(10)))
+
+    def test_convert_and_save_errors_skip_item(self):
+        def convert(item):
+            if item == 1:
+                raise ValueError("bad message")
+            return item
+
+        def save(result):
+            if result == 2:
+                raise OSError("disk full")
+            saved.append(result)
+
+        saved = []
+        with self.assertLogs("mail2blog", level="ERROR") as logs:
+            run_pipeline(range(4), convert, save, workers=2, queue_size=1)
+
+        self.assertEqual(sorted(saved), [0, 3])
+        self.assertEqual(len(logs.records), 2)
+
+    def test_fetch_error_is_raised_after_processing(self):
+        def items():
+            yield 1
+            yield 2
+            raise ConnectionError("connection lost")
+
+        saved = []
+        with self.assertRaises(ConnectionError):
+            run_pipeline(items(), lambda item: item, saved.append, 2, 1)
+
+        self.assertEqual(sorted(saved), [1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+import unittest
+import io
+import os
+import zlib
+import struct
+import tempfile
+from email.message import EmailMessage
+from unittest.mock import patch, ANY
+from imap_tools.message import MailMessage
+from PIL import Image, JpegImagePlugin
+from converter import html_to_blog_md, _convert_image_to_jpeg
+from policy import AttachmentPolicy, iter_payload, payload_size
+
+
+def _attachment(payload, maintype, subtype, cte="base64", filename="file"):
+    message = EmailMessage()
+    message.set_content("<p>Hello</p>", subtype="html")
+    message.add_attachment(
+        payload, maintype, subtype, cte=cte, filename=filename, cid="<att1>"
+    )
+    return MailMessage.from_bytes(message.as_bytes()).attachments[0]
+
+
+def _image(image_format, size, mode="RGB"):
+    buf = io.BytesIO()
+    Image.new(mode, size).save(buf, image_format)
+    return buf.getvalue()
+
+
+def _png_header(width, height):
+    """The header of a PNG claiming to be width x height, without its pixels."""
+    ihdr = b"IHDR" + struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + struct.pack(">I", 13)
+        + ihdr
+        + struct.pack(">I", zlib.crc32(ihdr))
+        + struct.pack(">I", 0)
+        + b"IDAT"
+        + struct.pack(">I", zlib.crc32(b"IDAT"))
+    )
+
+
+class TestPayload(unittest.TestCase):
+    def test_iter_payload_decodes_in_chunks(self):
+        payload = os.urandom(10000) + b"=\n\r\x00" * 100
+        for cte in ("base64", "quoted-printable"):
+            att = _attachment(payload, "application", "octet-stream", cte=cte)
+
+            chunks = list(iter_payload(att, chunk_size=1000))
+
+            self.assertGreater(len(chunks), 5)
+            self.assertEqual(b"".join(chunks), payload)
+            self.assertGreaterEqual(payload_size(att), len(payload))
+            # the whole decoded payload was never cached
+            self.assertNotIn("payload", att.__dict__)
+
+
+class TestAttachmentPolicy(unittest.TestCase):
+    def test_decisions(self):
+        policy = AttachmentPolicy(
+            content_types=("image/*", "application/pdf"),
+            max_bytes=1_000_000,
+            max_image_pixels=1_000_000,
+        )
+        cases = [
+            (_attachment(b"PK", "application", "zip"), "skip"),
+            (_attachment(bytes(2_000_000), "application", "pdf"), "skip"),
+            (_attachment(bytes(10), "application", "pdf"), "stream"),
+            (_attachment(bytes(5000), "application", "pdf"), "stream"),
+            (_attachment(_image("PNG", (100, 50)), "image", "png"), "convert"),
+            (_attachment(_image("GIF", (100, 50), "P"), "image", "gif"), "stream"),
+            (_attachment(_png_header(2000, 2000), "image", "png"), "skip"),
+            (_attachment(_png_header(100_000, 100_000), "image", "png"), "skip"),
+            (_attachment(_image("JPEG", (3000, 3000)), "image", "jpeg"), "cap"),
+            (_attachment(b"not an image", "image", "png"), "skip"),
+        ]
+
+        with self.assertLogs("mail2blog", level="INFO") as logs:
+            decisions = [policy.decide(att) for att, _ in cases]
+
+        self.assertEqual(
+            [decision.action for decision in decisions],
+            [action for _, action in cases],
+        )
+        self.assertEqual(decisions[8].min_scale, 4)
+        self.assertEqual(decisions[7].reason, "decompression bomb")
+        self.assertEqual(len(logs.output), len(cases))
+
+    def test_from_env(self):
+        env = {
+            "M2B_ATTACHMENT_TYPES": "image/*, Application/PDF",
+            "M2B_MAX_ATTACHMENT_BYTES": "1000",
+            "M2B_MAX_IMAGE_PIXELS": "2000",
+        }
+        with patch.dict("os.environ", env):
+            policy = AttachmentPolicy.from_env()
+
+        self.assertEqual(policy.content_types, ("image/*", "application/pdf"))
+        self.assertEqual((policy.max_bytes, policy.max_image_pixels), (1000, 2000))
+
+    def test_capped_jpeg_is_decoded_at_reduced_scale(self):
+        payload = _image("JPEG", (3000, 2000))
+        draft = JpegImagePlugin.JpegImageFile.draft
+
+        with tempfile.TemporaryDirectory() as temp_dir, patch.object(
+            JpegImagePlugin.JpegImageFile, "draft", autospec=True, side_effect=draft
+        ) as mock_draft:
+            _convert_image_to_jpeg(
+                payload, os.path.join(temp_dir, "out.jpeg"), draft=False, min_scale=4
+            )
+
+        mock_draft.assert_called_once_with(ANY, None, (750, 500))
+
+    def test_html_to_blog_md_applies_policy(self):
+        pdf = _attachment(os.urandom(5000), "application", "pdf", filename="doc.pdf")
+        zip_file = _attachment(b"PK", "application", "zip", filename="a.zip")
+        policy = AttachmentPolicy(content_types=("application/pdf",))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with self.assertLogs("mail2blog", level="INFO"):
+                html_to_blog_md(
+                    '<a href="cid:1">doc</a><a href="cid:2">zip</a>',
+                    {"1": pdf, "2": zip_file},
+                    assets_dir=temp_dir,
+                    policy=policy,
+                )
+
+            self.assertEqual(os.listdir(temp_dir), ["1.doc.pdf"])
+            with open(os.path.join(temp_dir, "1.doc.pdf"), "rb") as f:
+                self.assertEqual(f.read(), pdf.part.get_payload(decode=True))
+        self.assertNotIn("payload", pdf.__dict__)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import unittest
+from sanitize import sanitize_html
+
+
+class TestSanitizeHtml(unittest.TestCase):
+    def test_content_is_passed_through_as_written(self):
+        html = (
+            "<!DOCTYPE html><html><body><h1 class=title>Title</h1>"
+            "<p>A &amp; B &#169; &nbsp;<br/><img src='cid:123' alt=\"photo\"></p>"
+            "<table><tr><th>Name</th></tr><tr><td>Value</td></tr></table>"
+            "</body></html>"
+        )
+
+        result, removed = sanitize_html(html)
+
+        self.assertEqual(result, html)
+        self.assertEqual(removed, {})
+
+    def test_non_content_elements_are_dropped(self):
+        result, removed = sanitize_html(
+            "<html><head><title>Newsletter</title><style>p { color: red; }</style>"
+            "</head><body><script>if (a < b) {}</script>"
+            '<div style="display: none;">Preview <b>text</b></div>'
+            "<p>Hello</p></body></html>"
+        )
+
+        self.assertEqual(result, "<html><body><p>Hello</p></body></html>")
+        self.assertEqual(removed, {"head": 1, "script": 1, "hidden": 1})
+
+    def test_unclosed_head_ends_at_body(self):
+        result, removed = sanitize_html(
+            "<html><head><style>p {}</style><body><p>Hello</p></body></html>"
+        )
+
+        self.assertEqual(result, "<html><body><p>Hello</p></body></html>")
+        self.assertEqual(removed, {"head": 1})
+
+    def test_hidden_elements_with_implicit_end_tags_end_where_browsers_end_them(self):
+        cases = [
+            (
+                '<p style="display:none">pre<p>Real content</p><p>more</p>',
+                "<p>Real content</p><p>more</p>",
+            ),
+            (
+                '<li style="display:none">a<li>b</ul><p>after</p>',
+                "<li>b</ul><p>after</p>",
+            ),
+            (
+                '<table><tr><td style="display:none">x</tr><tr><td>y</td></tr>'
+                "</table><p>after</p>",
+                "<table><tr></tr><tr><td>y</td></tr></table><p>after</p>",
+            ),
+            (
+                '<ul><li style="display:none">a<ul><li>b<li>c</ul><li>d</ul>',
+                "<ul><li>d</ul>",
+            ),
+        ]
+        for html, expected in cases:
+            result, removed = sanitize_html(html)
+
+            self.assertEqual(result, expected)
+            self.assertEqual(removed, {"hidden": 1})
+
+    def test_comments_are_dropped(self):
+        result, removed = sanitize_html(
+            "<!-- header --><!--[if mso]><table><tr><td><![endif]-->"
+            "<p>Hello</p>"
+            "<!--[if !mso]><!--><p>Not Outlook</p><!--<![endif]-->"
+            "<![if !vml]><p>No VML</p><![endif]>"
+        )
+
+        self.assertEqual(result, "<p>Hello</p><p>Not Outlook</p><p>No VML</p>")
+        self.assertEqual(removed, {"comment": 1, "conditional_comment": 5})
+
+    def test_tracking_pixels_are_dropped(self):
+        result, removed = sanitize_html(
+            '<p><img src="https://t.example.com/open.gif" width="1" height="1">'
+            '<img src="https://t.example.com/o.png" width="0px" height="0px" />'
+            '<img src="cid:123" width="100" height="1"></p>'
+        )
+
+        self.assertEqual(result, '<p><img src="cid:123" width="100" height="1"></p>')
+        self.assertEqual(removed, {"tracking_pixel": 2})
+
+    def test_layout_tables_are_flattened(self):
+        result, removed = sanitize_html(
+            '<table role="presentation"><tr><td>Only <b>cell</b></td></tr></table>'
+            "<table><tbody><tr><td><table><tr><td>One</td><td>Two</td></tr>"
+            "</table></td></tr></tbody></table>"
+        )
+
+        self.assertEqual(
+            result, "<div>Only <b>cell</b></div><div><div>One</div><div>Two</div></div>"
+        )
+        self.assertEqual(removed, {"layout_table": 3})
+
+    def test_unclosed_tables_are_kept(self):
+        result, removed = sanitize_html("<table><tr><td>Cell")
+
+        self.assertEqual(result, "<table><tr><td>Cell")
+        self.assertEqual(removed, {})
+
+
+if __name__ == "__main__":
+    unittest.main()